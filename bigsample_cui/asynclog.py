@@ -0,0 +1,188 @@
+'''
+Non-blocking file logging for nutanix.py and consoleview.py.
+Records are queued by the caller and written by a background thread.
+
+Author: Yuichi Ito
+Email: yuichi.ito@nutanix.com
+'''
+
+import copy
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+
+
+class AsyncLogHandler(logging.Handler):
+  # Put records in a bounded queue. Writer thread formats and writes them
+  # to a size rotated file. Caller never waits for disk.
+  # When the queue is full, new records are dropped and counted. Number of
+  # dropped records is written to the file when the writer catches up.
+  # Records failed to be written are counted and reported by handleError().
+  #
+  # queue_size : Max records waiting to be written.
+  # queue_bytes : Max total size of records waiting to be written. Size of a
+  #   record is the length of its message and str/bytes args, plus log_size()
+  #   of args which have it. (REST bodies) 0 doesn't limit.
+  # max_bytes : Rotate the file at this size. 0 never rotates.
+  # backup_count : Number of rotated files kept. (log_file.1, log_file.2 ...)
+
+  def __init__(self, log_file, queue_size=10000, max_bytes=10 * 1024 ** 2, backup_count=3,
+    queue_bytes=64 * 1024 ** 2):
+    super().__init__()
+    self.log_file = os.path.abspath(log_file)
+    self.queue_size = queue_size
+    self.queue_bytes = queue_bytes
+    self.max_bytes = max_bytes
+    self.backup_count = backup_count
+    self.dropped = 0
+    self.written = 0
+    self.errors = 0
+    self._reported_dropped = 0
+    self._queued_bytes = 0
+    self._bytes_lock = threading.Lock()
+    self._queue = queue.Queue(queue_size)
+    self._target = logging.handlers.RotatingFileHandler(self.log_file,
+      maxBytes=max_bytes, backupCount=backup_count, delay=True)
+    self._target.handleError = self._handle_write_error
+    self._thread = threading.Thread(target=self._write_loop, name='AsyncLogWriter')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def setFormatter(self, formatter):
+    super().setFormatter(formatter)
+    self._target.setFormatter(formatter)
+
+  def emit(self, record):
+    # Message is merged with args here like QueueHandler does, so that args
+    # changed by the caller later are logged as they were. Records with args
+    # having log_size() (REST bodies) are merged by the writer. Such args are
+    # snapshots and costly to format. Traceback is always rendered here since
+    # it can't be rendered after the frames are gone.
+    # The record is copied. Other handlers get the original.
+    try:
+      record = copy.copy(record)
+      if not self._has_lazy_args(record):
+        record.msg = record.getMessage()
+        record.args = None
+      if record.exc_info and not record.exc_text:
+        record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+    except Exception:
+      self.handleError(record)
+      return
+    size = self._record_size(record)
+    with self._bytes_lock:
+      if self.queue_bytes and self._queued_bytes > 0 and self._queued_bytes + size > self.queue_bytes:
+        self.dropped += 1
+        return
+      self._queued_bytes += size
+    record.asynclog_size = size
+    try:
+      self._queue.put_nowait(record)
+    except queue.Full:
+      with self._bytes_lock:
+        self._queued_bytes -= size
+        self.dropped += 1
+
+  @staticmethod
+  def _has_lazy_args(record):
+    args = record.args if isinstance(record.args, tuple) else ()
+    return any(hasattr(arg, 'log_size') for arg in args)
+
+  @staticmethod
+  def _record_size(record):
+    size = len(str(record.msg))
+    args = record.args if isinstance(record.args, tuple) else ()
+    for arg in args:
+      if isinstance(arg, (str, bytes)):
+        size += len(arg)
+      elif hasattr(arg, 'log_size'):
+        size += arg.log_size()
+    return size
+
+  def flush(self):
+    # Wait until queued records are written.
+    if self._thread.is_alive():
+      self._queue.join()
+
+  def close(self):
+    # Write the rest and stop the writer. Called by logging at exit too.
+    if self._thread.is_alive():
+      self._queue.put(None)
+      self._thread.join()
+    self._target.close()
+    super().close()
+
+  def stats(self):
+    return {
+      'queued' : self._queue.qsize(),
+      'queued_bytes' : self._queued_bytes,
+      'written' : self.written,
+      'dropped' : self.dropped,
+      'errors' : self.errors,
+    }
+
+  def _handle_write_error(self, record):
+    # Called in the writer thread. By the target when it fails to format or
+    # write, or by _write_loop.
+    self.errors += 1
+    self.handleError(record)
+
+  def _write_loop(self):
+    while True:
+      record = self._queue.get()
+      try:
+        if record is None:
+          return
+        dropped = self.dropped
+        if dropped != self._reported_dropped:
+          self._target.handle(logging.makeLogRecord({'name' : record.name, 'levelno' : logging.WARNING,
+            'levelname' : 'WARNING', 'msg' : '%d log records were dropped. Log queue was full.',
+            'args' : (dropped - self._reported_dropped,)}))
+          self._reported_dropped = dropped
+        # Merged once here. The target formats the record twice. (Rollover check and write)
+        if record.args:
+          record.msg = record.getMessage()
+          record.args = None
+        errors = self.errors
+        self._target.handle(record)
+        if self.errors == errors:
+          self.written += 1
+      except Exception:
+        self._handle_write_error(record)
+      finally:
+        if record is not None:
+          with self._bytes_lock:
+            self._queued_bytes -= getattr(record, 'asynclog_size', 0)
+        self._queue.task_done()
+
+
+_lock = threading.Lock()
+
+def create_logger(name, log_file, level=logging.INFO, formatter='%(message)s',
+  queue_size=10000, max_bytes=10 * 1024 ** 2, backup_count=3, queue_bytes=64 * 1024 ** 2):
+  # Logger "name" writing to log_file through AsyncLogHandler.
+  # Calling again with the same name doesn't add another handler. Level and
+  # format are updated. Different file or queue/rotation settings replace the handler.
+  logger = logging.getLogger(name)
+  logger.setLevel(level)
+  settings = (os.path.abspath(log_file), queue_size, max_bytes, backup_count, queue_bytes)
+  with _lock:
+    handler = None
+    for old_handler in list(logger.handlers):
+      if not isinstance(old_handler, AsyncLogHandler):
+        continue
+      old_settings = (old_handler.log_file, old_handler.queue_size, old_handler.max_bytes,
+        old_handler.backup_count, old_handler.queue_bytes)
+      if handler is None and old_settings == settings:
+        handler = old_handler
+        continue
+      logger.removeHandler(old_handler)
+      old_handler.close()
+    if handler is None:
+      handler = AsyncLogHandler(log_file, queue_size, max_bytes, backup_count, queue_bytes)
+      logger.addHandler(handler)
+    handler.setFormatter(logging.Formatter(formatter))
+  return logger
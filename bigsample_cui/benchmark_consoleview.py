@@ -0,0 +1,126 @@
+'''
+Benchmarks of consoleview.py (Curses based UI framework)
+Only the parts not drawing to the terminal.
+
+Author: Yuichi Ito
+Email: yuichi.ito@nutanix.com
+'''
+
+if __name__ != '__main__':
+  print("Please don't import module \"benchmark_consoleview\". It is only for benchmarking.")
+  print('Abort.')
+  exit(1)
+
+import random
+import time
+import tracemalloc
+
+from consoleview import NameSearch, FrameRenderer
+
+
+def make_names(num_names):
+  # "tenantN-env-app-NNN" style names. Many of them share long parts.
+  random.seed(0)
+  names = []
+  for i in range(num_names):
+    names.append('tenant{}-{}-{}-{:03d}'.format(random.randint(0, 40),
+      random.choice(['prod', 'dev', 'stg']), random.choice(['web', 'db', 'cache', 'api', 'batch']),
+      random.randint(0, 999)))
+  return names
+
+
+def print_latency(title, latencies):
+  latencies = sorted(latencies)
+  average = sum(latencies) / len(latencies)
+  p95 = latencies[int(len(latencies) * 0.95)]
+  print('  {:<22} avg {:7.3f}ms  p95 {:7.3f}ms'.format(title, average * 1000, p95 * 1000))
+
+
+def benchmark_name_search(num_names=50000, num_queries=300):
+  names = make_names(num_names)
+  print('NameSearch. {} names'.format(len(set(names))))
+
+  start = time.perf_counter()
+  search = NameSearch(names)
+  elapsed = time.perf_counter() - start
+  # Measured separately. tracemalloc slows the build down.
+  del search
+  tracemalloc.start()
+  search = NameSearch(names)
+  (current, peak) = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  print('  build                  {:7.1f}ms  {:.1f}MiB'.format(elapsed * 1000, current / 1024 ** 2))
+
+  random.seed(1)
+  samples = random.sample(names, num_queries)
+  cases = [
+    ('prefix', [name[:random.randint(3, 12)] for name in samples]),
+    ('substring', [name[random.randint(1, 8):][:random.randint(3, 8)] for name in samples]),
+    ('fuzzy', [''.join(c for c in name if random.random() < 0.4) for name in samples]),
+  ]
+  for (title, queries) in cases:
+    latencies = []
+    for query in queries:
+      # Query not narrowing the last one. Nothing is reused.
+      search.search('~')
+      start = time.perf_counter()
+      search.search(query)
+      latencies.append(time.perf_counter() - start)
+    print_latency(title, latencies)
+
+  # Query typed one char at a time, as on the input form.
+  for (title, queries) in cases:
+    latencies = []
+    for query in queries:
+      search.search('~')
+      for i in range(1, len(query) + 1):
+        start = time.perf_counter()
+        search.search(query[:i])
+        latencies.append(time.perf_counter() - start)
+    print_latency(title + ' (typing)', latencies)
+
+
+class NullWindow:
+  # Stand-in of stdscr. Counts cells given to addstr().
+  def __init__(self, height=24, width=80):
+    self.size = (height, width)
+    self.cells = 0
+  def getmaxyx(self):
+    return self.size
+  def addstr(self, y, x, text, attr=0):
+    self.cells += len(text)
+  def move(self, y, x): pass
+  def clrtoeol(self): pass
+  def erase(self): pass
+  def refresh(self): pass
+
+
+def benchmark_render(num_frames=1000):
+  # Showtop of main.py. Task progress moves on every 10th frame.
+  def draw(frame, i):
+    for y in range(9):
+      frame.addstr(y, 0, '{}. Item {:<11}: value-{}'.format(y + 1, y, y))
+    frame.addstr(8, 0, '9. Create image     : Running, Progress {}%'.format(i // 10))
+    frame.addstr(10, 0, '1-9 : choose action')
+    frame.addstr(11, 0, 'Esc : Quit')
+  print('FrameRenderer. {} frames'.format(num_frames))
+  for incremental in [False, True]:
+    window = NullWindow()
+    renderer = FrameRenderer(window)
+    start = time.perf_counter()
+    for i in range(num_frames):
+      if not incremental:
+        renderer.invalidate()
+      frame = renderer.new_frame()
+      draw(frame, i)
+      renderer.render(frame)
+    elapsed = time.perf_counter() - start
+    stats = renderer.stats()
+    print('  {:<22} {:7.3f}ms/frame  cells {:7d}  refreshed {}'.format(
+      'incremental' if incremental else 'full redraw', elapsed * 1000 / num_frames,
+      window.cells, stats['frames'] - stats['skipped']))
+
+
+if __name__ == '__main__':
+  benchmark_name_search()
+  benchmark_render()
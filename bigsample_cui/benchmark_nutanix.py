@@ -0,0 +1,179 @@
+'''
+Benchmarks of nutanix.py (Python REST API wrapper)
+Runs against local stand-in server "mock_prism.py". No cluster needed.
+
+Author: Yuichi Ito
+Email: yuichi.ito@nutanix.com
+'''
+
+if __name__ != '__main__':
+  print("Please don't import module \"benchmark_nutanix\". It is only for benchmarking.")
+  print('Abort.')
+  exit(1)
+
+import multiprocessing
+import random
+import time
+import timeit
+import tracemalloc
+
+from nutanix import NutanixRestApiClient, VmRecord, _RequestHooks
+from mock_prism import MockPrism
+
+# PARAM FOR SESSION
+CLUSTER_USER = 'admin'
+CLUSTER_PASSWORD = 'Nutanix/4u!'
+
+
+def make_client(mock, **kwargs):
+  return NutanixRestApiClient('127.0.0.1', CLUSTER_USER, CLUSTER_PASSWORD,
+    port=mock.port, use_https=False, **kwargs)
+
+
+def serve_mock(conn, kwargs):
+  mock = MockPrism(**kwargs).start()
+  conn.send(mock.port)
+  conn.recv()
+  mock.stop()
+
+def start_mock_process(**kwargs):
+  # MockPrism in another process. Its memory isn't counted by tracemalloc.
+  # Return (port, stop function).
+  context = multiprocessing.get_context('fork')
+  (parent_conn, child_conn) = context.Pipe()
+  process = context.Process(target=serve_mock, args=(child_conn, kwargs))
+  process.start()
+  port = parent_conn.recv()
+  def stop():
+    parent_conn.send(None)
+    process.join()
+  return (port, stop)
+
+
+###
+### Benchmarks
+###
+
+def benchmark_lookup(num_vms=5000, num_lookups=100):
+  # Bytes transferred per single entity lookup. Cache disabled(ttl 0) so
+  # that every lookup goes to the server.
+  print('== Lookup: {} VMs, {} lookups =='.format(num_vms, num_lookups))
+  print('{:8} {:8} {:>10} {:>14} {:>10}'.format('api', 'mode', 'requests', 'bytes/lookup', 'ms/lookup'))
+  for legacy in [False, True]:
+    mock = MockPrism(num_vms=num_vms, legacy=legacy).start()
+    try:
+      names = [vm['name'] for vm in random.sample(mock.vms, num_lookups)]
+      for lookup_mode in ['list', 'filter']:
+        session = make_client(mock, entity_cache_ttl=0, lookup_mode=lookup_mode)
+        mock.reset_stats()
+        start = time.perf_counter()
+        for name in names:
+          (success, vdisks) = session.get_vm_disks(name)
+          assert success
+        elapsed = time.perf_counter() - start
+        print('{:8} {:8} {:>10} {:>14.0f} {:>10.2f}'.format('legacy' if legacy else 'current', lookup_mode,
+          mock.num_requests, mock.bytes_sent / num_lookups, elapsed * 1000 / num_lookups))
+    finally:
+      mock.stop()
+  print()
+
+
+def benchmark_stream(num_vms=20000):
+  # Peak memory of listing all vms with config at once(page_size None).
+  # Decoding whole body vs streaming entities with/without field projection.
+  print('== Stream: {} VMs in one response =='.format(num_vms))
+  print('{:24} {:>10} {:>14} {:>10}'.format('mode', 'entities', 'peak KiB', 'seconds'))
+  (port, stop) = start_mock_process(num_vms=num_vms)
+  try:
+    session = NutanixRestApiClient('127.0.0.1', CLUSTER_USER, CLUSTER_PASSWORD, port=port, use_https=False)
+    cases = [
+      ('decode whole body', dict(stream=False)),
+      ('stream', dict(stream=True)),
+      ('stream + fields', dict(stream=True, fields=['name', 'uuid'])),
+    ]
+    for (label, kwargs) in cases:
+      # Keep what a caller would keep. Names only.
+      start = time.perf_counter()
+      names = [vm['name'] for vm in session.iter_vms(page_size=None, include_config=True, **kwargs)]
+      elapsed = time.perf_counter() - start
+      tracemalloc.start()
+      names = [vm['name'] for vm in session.iter_vms(page_size=None, include_config=True, **kwargs)]
+      (_, peak) = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+      print('{:24} {:>10} {:>14.0f} {:>10.2f}'.format(label, len(names), peak / 1024, elapsed))
+  finally:
+    stop()
+  print()
+
+
+def benchmark_records(num_vms=50000):
+  # Memory of a cached inventory. get_vm_info() dicts vs VmRecord.
+  # Raw entities are made before tracing. Both share their strings.
+  print('== Records: {} VMs inventory =='.format(num_vms))
+  print('{:24} {:>14} {:>14} {:>10}'.format('representation', 'KiB', 'bytes/vm', 'seconds'))
+  mock = MockPrism(num_vms=num_vms).start()
+  vms = mock.vms
+  mock.stop()
+  cases = [
+    ('dict', NutanixRestApiClient._make_vm_info),
+    ('VmRecord', VmRecord.from_entity),
+  ]
+  for (label, make) in cases:
+    tracemalloc.start()
+    start = time.perf_counter()
+    inventory = [make(vm) for vm in vms]
+    elapsed = time.perf_counter() - start
+    (size, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{:24} {:>14.0f} {:>14.0f} {:>10.2f}'.format(label, size / 1024, size / num_vms, elapsed))
+    del inventory
+  print()
+
+
+def benchmark_hooks(num_requests=3000, num_dispatches=1000000):
+  # Overhead of lifecycle hooks. Per request over HTTP (mock in another
+  # process) and per dispatch alone (before_request + after_response).
+  print('== Hooks: {} requests, {} dispatches =='.format(num_requests, num_dispatches))
+  print('{:24} {:>12} {:>14}'.format('hooks', 'us/request', 'us/dispatch'))
+  def no_op(info):
+    pass
+  (port, stop) = start_mock_process(num_networks=1)
+  try:
+    for num_hooks in [0, 1, 4]:
+      hooks = {event : [no_op] * num_hooks for event in _RequestHooks.EVENTS}
+      session = NutanixRestApiClient('127.0.0.1', CLUSTER_USER, CLUSTER_PASSWORD, port=port,
+        use_https=False, coalesce_gets=False, hooks=hooks)
+      for i in range(100):
+        session.get_network_names()
+      start = time.perf_counter()
+      for i in range(num_requests):
+        (success, names) = session.get_network_names()
+        assert success
+      per_request = (time.perf_counter() - start) / num_requests
+
+      # Same steps as execute() and observe() do, on the hooks of the client.
+      request_hooks = session._request_hooks
+      def dispatch():
+        hook = None
+        if request_hooks.enabled:
+          hook = {'method' : 'GET', 'version' : 'v2.0', 'endpoint' : '/networks/', 'url' : '',
+            'size_out' : 0, 'start' : 0.0}
+          request_hooks.emit('before_request', hook)
+        if hook is not None:
+          hook['status'] = 200
+          hook['latency'] = 0.0
+          hook['size_in'] = 0
+          request_hooks.emit('after_response', hook)
+      per_dispatch = timeit.timeit(dispatch, number=num_dispatches) / num_dispatches
+      print('{:24} {:>12.1f} {:>14.3f}'.format('{} per event'.format(num_hooks),
+        per_request * 1e6, per_dispatch * 1e6))
+  finally:
+    stop()
+  print()
+
+
+if __name__ == '__main__':
+  benchmark_hooks()
+  benchmark_lookup()
+  benchmark_stream()
+  benchmark_records()
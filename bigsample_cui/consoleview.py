@@ -8,9 +8,19 @@ Email: yuichi.ito@nutanix.com
 import curses
 import logging
 import time
-import json
 import threading
 import traceback
+import array
+import bisect
+import contextlib
+import itertools
+import os
+import re
+import select
+import signal
+import sys
+
+import asynclog
 
 
 ###
@@ -28,6 +38,756 @@ class _VoidLogger():
   def debug(self, message): pass
 
 
+###
+### Prefix Index
+###
+
+class _RadixNode:
+  # Node of PrefixIndex. label : Chars of the edge from parent.
+  # children : {first char of child label : child node}. None if leaf.
+  # size : Number of names in this subtree. terminal : A name ends here.
+  __slots__ = ('label', 'children', 'terminal', 'size')
+
+  def __init__(self, label, terminal=False, size=0):
+    self.label = label
+    self.children = None
+    self.terminal = terminal
+    self.size = size
+
+
+class PrefixIndex:
+  # Set of names as radix tree (compressed trie). Chain of single child nodes
+  # is one node with multi-char label. So number of nodes is less than 2 x names.
+  #
+  # Candidates ["abcdef", "abd", "abcd"] make this tree. (* : a name ends here)
+  #
+  # "ab" -+- "cd"* --- "ef"*
+  #       |
+  #       +- "d"*
+  #
+  # Build once and add()/remove() when inventory changes. Queries walk only
+  # the prefix and then the result.
+  #  - complete(prefix) : Longest common completion. Same as ConsoleView.autocomplete.
+  #  - names(prefix) : Names starting with prefix in sorted order.
+  #  - count(prefix) : Number of them without listing.
+
+  def __init__(self, names=()):
+    self._root = _RadixNode('')
+    for name in names:
+      self.add(name)
+
+  def __len__(self):
+    return self._root.size
+
+  def __contains__(self, name):
+    (node, rest) = self._walk(name)
+    return node is not None and rest == '' and node.terminal
+
+  def __iter__(self):
+    return self.iter_names('')
+
+  def add(self, name):
+    # Return True if added. False if already in.
+    if '\n' in name:
+      raise Exception("Candidate words can't contain NEW-LINE")
+    path = [self._root]
+    node = self._root
+    rest = name
+    while rest:
+      if node.children is None:
+        node.children = {}
+      child = node.children.get(rest[0])
+      if child is None:
+        node.children[rest[0]] = _RadixNode(rest)
+        node = node.children[rest[0]]
+        path.append(node)
+        break
+      label = child.label
+      common = 1
+      limit = min(len(label), len(rest))
+      while common < limit and label[common] == rest[common]:
+        common += 1
+      if common < len(label):
+        # Split the edge at the end of common part.
+        middle = _RadixNode(label[:common], size=child.size)
+        child.label = label[common:]
+        middle.children = {child.label[0] : child}
+        node.children[rest[0]] = middle
+        child = middle
+      path.append(child)
+      node = child
+      rest = rest[common:]
+    if node.terminal:
+      return False
+    node.terminal = True
+    for passed in path:
+      passed.size += 1
+    return True
+
+  def remove(self, name):
+    # Return True if removed. False if not in.
+    path = [self._root]
+    node = self._root
+    rest = name
+    while rest:
+      child = node.children.get(rest[0]) if node.children else None
+      if child is None or not rest.startswith(child.label):
+        return False
+      path.append(child)
+      node = child
+      rest = rest[len(child.label):]
+    if not node.terminal:
+      return False
+    node.terminal = False
+    for passed in path:
+      passed.size -= 1
+
+    # Drop empty leaf, then merge single child into its parent.
+    if node.size == 0 and len(path) > 1:
+      parent = path[-2]
+      del parent.children[node.label[0]]
+      if not parent.children:
+        parent.children = None
+      node = parent
+      path.pop()
+    if node is not self._root and not node.terminal and node.children and len(node.children) == 1:
+      (child,) = node.children.values()
+      node.label += child.label
+      node.children = child.children
+      node.terminal = child.terminal
+    return True
+
+  def update(self, names):
+    # Make the index same as names. Only differences are added/removed.
+    names = set(names)
+    current = set(self)
+    for name in current - names:
+      self.remove(name)
+    for name in names - current:
+      self.add(name)
+
+  def complete(self, prefix):
+    # Extend prefix while all names under it share the next chars.
+    # Stop at a name end or a branch. Unknown prefix is returned as it is.
+    (node, rest) = self._walk(prefix)
+    if node is None:
+      return prefix
+    text = prefix + rest
+    while not node.terminal and node.children and len(node.children) == 1:
+      (node,) = node.children.values()
+      text += node.label
+    return text
+
+  def count(self, prefix):
+    (node, rest) = self._walk(prefix)
+    return 0 if node is None else node.size
+
+  def names(self, prefix, limit=None):
+    # List of names starting with prefix. At most limit names if given.
+    names = []
+    for name in self.iter_names(prefix):
+      if limit is not None and len(names) >= limit:
+        break
+      names.append(name)
+    return names
+
+  def iter_names(self, prefix):
+    (node, rest) = self._walk(prefix)
+    if node is None:
+      return iter(())
+    return self._iter_subtree(prefix + rest, node)
+
+  def _iter_subtree(self, text, node):
+    # Names under node in sorted order. text : Path to the node.
+    # Depth first with explicit stack. Children are pushed in reverse order.
+    stack = [(text, node)]
+    while stack:
+      (text, node) = stack.pop()
+      if node.terminal:
+        yield text
+      if node.children:
+        for key in sorted(node.children, reverse=True):
+          child = node.children[key]
+          stack.append((text + child.label, child))
+
+  def _walk(self, prefix):
+    # Return (node, rest). Node is the first one whose path covers prefix.
+    # rest : Chars of the node label after prefix. (None, '') if no name has prefix.
+    node = self._root
+    while prefix:
+      child = node.children.get(prefix[0]) if node.children else None
+      if child is None:
+        return (None, '')
+      label = child.label
+      if len(prefix) <= len(label):
+        if not label.startswith(prefix):
+          return (None, '')
+        return (child, label[len(prefix):])
+      if not prefix.startswith(label):
+        return (None, '')
+      node = child
+      prefix = prefix[len(label):]
+    return (node, '')
+
+
+###
+### Name Search
+###
+
+class NameSearch:
+  # Substring and fuzzy search of names. Case insensitive.
+  # Built once per inventory snapshot. Make new one when names are changed.
+  #
+  # Ranking of search(query) :
+  #  (1) Names starting with query. Found by bisect on sorted names.
+  #  (2) Names having query after the first char. Found by trigram index.
+  #  (3) Fuzzy. Names having chars of query in order, like "tnt12" for
+  #      "tenant-12". Smaller gaps first. Only when (1) + (2) are fewer than
+  #      fuzzy_below. At most max_fuzzy candidates are checked.
+  # Same rank is in name order.
+  #
+  # N-gram index : {1-3 chars : ids of names having them after the first char}.
+  # Names sharing long prefix ("tenant-env-app-NNN") don't fill the lists
+  # with their prefix. Query up to 3 chars is one list. Longer query checks
+  # only the names of its rarest trigram.
+  # When chars are added to the last query, only its matches are checked.
+  #
+  # Char index : {(char, count) : bits of names having char count times or more}.
+  # Fuzzy candidates are the names having all chars of query. One AND of
+  # big ints per char of query. Checked in name order up to max_fuzzy.
+
+  def __init__(self, names, fuzzy_below=10, max_fuzzy=200):
+    self.fuzzy_below = fuzzy_below
+    self.max_fuzzy = max_fuzzy
+    self._names = sorted(set(names), key=lambda name: (name.lower(), name))
+    self._lower = [name.lower() for name in self._names]
+
+    grams = {}
+    for (i, name) in enumerate(self._lower):
+      name_grams = set(name[1:])
+      name_grams.update([name[j:j + 2] for j in range(1, len(name) - 1)])
+      name_grams.update([name[j:j + 3] for j in range(1, len(name) - 2)])
+      for gram in name_grams:
+        ids = grams.get(gram)
+        if ids is None:
+          ids = grams[gram] = array.array('I')
+        ids.append(i)
+    self._grams = grams
+
+    # Count of char per name as one byte. Lines of all names with other chars
+    # deleted. Up to 255 if some name is that long. Names having count or
+    # more are "1" digits. Reversed, so that bit i is name i.
+    char_bits = {}
+    text = '\n'.join(self._lower)
+    chars = set(text) - {'\n'}
+    longest = max(map(len, self._lower), default=0)
+    for c in chars:
+      counts = map(len, text.translate({ord(other) : None for other in chars if other != c}).split('\n'))
+      if longest > 255:
+        counts = map(min, counts, itertools.repeat(255))
+      counts = bytes(counts)
+      for count in range(1, max(counts) + 1):
+        digits = counts.translate(bytes(0x31 if n >= count else 0x30 for n in range(256)))
+        char_bits[(c, count)] = int(digits[::-1], 2)
+    self._char_bits = char_bits
+
+    self._last = {'query' : None}
+
+  def __len__(self):
+    return len(self._names)
+
+  def search(self, query, limit=10, offset=0):
+    # Return (total, names). Names are ranked [offset:offset + limit] of total matches.
+    query = query.lower()
+    if query == '':
+      return (len(self._names), self._names[offset:offset + limit])
+
+    last = self._last
+    if query != last['query']:
+      lower = self._lower
+      start = bisect.bisect_left(lower, query)
+      end = bisect.bisect_left(lower, query + '\U0010ffff', start)
+      inner = self._inner(query, last)
+      # Names starting with query and also having it later are counted as (1).
+      inner_start = bisect.bisect_left(inner, start)
+      inner_end = bisect.bisect_left(inner, end, inner_start)
+      fuzzy = []
+      if (end - start) + len(inner) - (inner_end - inner_start) < self.fuzzy_below:
+        fuzzy = self._fuzzy(query)
+      last = {
+        'query' : query, 'start' : start, 'end' : end, 'inner' : inner,
+        'inner_start' : inner_start, 'inner_end' : inner_end, 'fuzzy' : fuzzy,
+      }
+      self._last = last
+
+    (start, end, inner) = (last['start'], last['end'], last['inner'])
+    (inner_start, inner_end) = (last['inner_start'], last['inner_end'])
+    total = (end - start) + len(inner) - (inner_end - inner_start) + len(last['fuzzy'])
+    ids = itertools.chain(range(start, end), inner[:inner_start], inner[inner_end:], last['fuzzy'])
+    return (total, [self._names[i] for i in itertools.islice(ids, offset, offset + limit)])
+
+  def _narrowing(self, query, last):
+    # True if matches of query are in the matches of the last query.
+    return last['query'] is not None and query.startswith(last['query'])
+
+  def _inner(self, query, last):
+    # Sorted ids of names having query after the first char.
+    # Some names of (1) may be in it too. search() skips them.
+    if len(query) <= 3:
+      return self._grams.get(query, ())
+
+    candidates = None
+    for j in range(len(query) - 2):
+      ids = self._grams.get(query[j:j + 3])
+      if ids is None:
+        return []
+      if candidates is None or len(ids) < len(candidates):
+        candidates = ids
+    if self._narrowing(query, last) and len(last['inner']) < len(candidates):
+      candidates = last['inner']
+    lower = self._lower
+    return [i for i in candidates if query in lower[i]]
+
+  def _fuzzy(self, query):
+    # Ids of names having chars of query in order but not query itself.
+    # Chars are matched from the left. Sorted by gaps, position and name.
+    pattern = '({0}'.format(re.escape(query[0]))
+    for c in query[1:]:
+      pattern += '[^{0}\n]*{0}'.format(re.escape(c))
+    pattern = re.compile(pattern + ')')
+
+    bits = -1
+    for c in set(query):
+      bits &= self._char_bits.get((c, query.count(c)), 0)
+    candidates = itertools.islice(_iter_bits(bits), self.max_fuzzy)
+
+    lower = self._lower
+    scored = []
+    for i in candidates:
+      match = pattern.search(lower[i])
+      if match is None or query in lower[i]:
+        continue
+      (match_start, match_end) = match.span()
+      scored.append((match_end - match_start - len(query), i))
+    scored.sort()
+    return [i for (gaps, i) in scored]
+
+
+_NONZERO_BYTE = re.compile(b'[^\x00]')
+_BYTE_BITS = [tuple(j for j in range(8) if value >> j & 1) for value in range(256)]
+
+def _iter_bits(bits):
+  # Positions of 1 bits of non-negative int. Ascending.
+  # Zero bytes are skipped by regex. Sparse bits cost little.
+  data = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+  for match in _NONZERO_BYTE.finditer(data):
+    base = match.start() * 8
+    for j in _BYTE_BITS[data[match.start()]]:
+      yield base + j
+
+
+class SearchFilter:
+  # Names of NameSearch matching the text of an input form. One page of them
+  # is shown with their total count. Only the shown page is listed.
+
+  def __init__(self, search, page_size=10):
+    self.search = search
+    self.page_size = page_size
+    self.page = 0
+    self._text = None
+    self._result = (0, [])
+
+  def set_text(self, text):
+    # Back to the first page if the text is changed.
+    if text == self._text:
+      return
+    self.page = 0
+    self._text = text
+    self._result = self.search.search(text, self.page_size)
+
+  @property
+  def total(self):
+    return self._result[0]
+
+  @property
+  def num_pages(self):
+    return max(1, (self.total + self.page_size - 1) // self.page_size)
+
+  def move_page(self, delta):
+    self.page = min(max(self.page + delta, 0), self.num_pages - 1)
+
+  def page_names(self):
+    if self.page == 0:
+      return self._result[1]
+    return self.search.search(self._text, self.page_size, self.page * self.page_size)[1]
+
+
+###
+### Shared State
+###
+
+class _Shared:
+  # Object passed to all functions as "shared". Attributes are set freely.
+  # Setting an attribute to a different value increments the version and
+  # wakes the threads waiting for it (UI loop redraws showtop at once).
+  # In-place changes (list.append() etc.) are not seen. Call touch() after them.
+  # Names starting with "_" are private and don't change the version.
+  #
+  # with shared.batch():    # Change of several attributes is one version.
+  #   shared.task_status = status
+  #   shared.task_percent = percent
+
+  def __init__(self):
+    object.__setattr__(self, '_version', 0)
+    object.__setattr__(self, '_changed', threading.Condition(threading.RLock()))
+    object.__setattr__(self, '_batch_depth', 0)
+    object.__setattr__(self, '_batch_changed', False)
+    object.__setattr__(self, '_wake_fds', [])
+
+  def __setattr__(self, name, value):
+    if name.startswith('_'):
+      object.__setattr__(self, name, value)
+      return
+    old = self.__dict__.get(name, _Shared)
+    object.__setattr__(self, name, value)
+    if old is value:
+      return
+    try:
+      same = type(old) is type(value) and bool(old == value)
+    except Exception:
+      same = False
+    if not same:
+      self.touch()
+
+  def __delattr__(self, name):
+    object.__delattr__(self, name)
+    if not name.startswith('_'):
+      self.touch()
+
+  def __str__(self):
+    # Object dump
+    text = ''
+    for (key, value) in vars(self).items():
+      if key.startswith('_'):
+        continue
+      text += '{} : {}\n'.format(key, value)
+    return text
+
+  def get_version(self):
+    return self._version
+
+  def touch(self):
+    # Tell a change. Done once at the end if in batch().
+    with self._changed:
+      if self._batch_depth > 0:
+        self._batch_changed = True
+        return
+      self._version += 1
+      self._changed.notify_all()
+      for fd in self._wake_fds:
+        try:
+          os.write(fd, b'\0')
+        except (BlockingIOError, OSError):
+          # Pipe is full. Already woken.
+          pass
+
+  @contextlib.contextmanager
+  def batch(self):
+    # Other threads' changes wait until the end of batch.
+    with self._changed:
+      self._batch_depth += 1
+      try:
+        yield self
+      finally:
+        self._batch_depth -= 1
+        if self._batch_depth == 0 and self._batch_changed:
+          self._batch_changed = False
+          self.touch()
+
+  def wait_change(self, version, timeout=None):
+    # Wait until version is different from the given one. Return current version.
+    with self._changed:
+      self._changed.wait_for(lambda: self._version != version, timeout)
+      return self._version
+
+  def _add_wake_fd(self, fd):
+    # A byte is written to fd on each change. For select() of UI loop.
+    with self._changed:
+      self._wake_fds.append(fd)
+
+  def _remove_wake_fd(self, fd):
+    # Not an error if fd isn't added.
+    with self._changed:
+      if fd in self._wake_fds:
+        self._wake_fds.remove(fd)
+
+
+###
+### Rendering
+###
+
+class _Frame:
+  # Screen drawn by showtop or input form. Has addstr(), addch(), move(),
+  # clrtoeol(), erase() of stdscr but only keeps the chars. FrameRenderer
+  # writes the differences from the last frame to the real window.
+  # Other drawing methods raise AttributeError. They would draw on the real
+  # window behind the frame. Others (getkey, timeout ...) go to the real window.
+
+  _UNWRAPPED = frozenset([
+    'addnstr', 'attroff', 'attron', 'attrset', 'bkgd', 'bkgdset', 'border', 'box',
+    'chgat', 'clrtobot', 'delch', 'deleteln', 'echochar', 'hline', 'insch',
+    'insdelln', 'insertln', 'insnstr', 'insstr', 'scroll', 'standend', 'standout', 'vline',
+  ])
+
+  def __init__(self, window):
+    self._window = window
+    (self.height, self.width) = window.getmaxyx()
+    # {y : [chars]} and {y : [attrs]}. attrs only for lines having attr.
+    self.lines = {}
+    self.attrs = {}
+    # (y, x) if cursor is shown. Set by move().
+    self.cursor = None
+    self._y = 0
+    self._x = 0
+
+  def __getattr__(self, name):
+    if name in self._UNWRAPPED:
+      raise AttributeError('Frame has no drawing method "{}". Use addstr() instead.'.format(name))
+    return getattr(self._window, name)
+
+  def getmaxyx(self):
+    return (self.height, self.width)
+
+  def getyx(self):
+    return (self._y, self._x)
+
+  def erase(self):
+    self.lines = {}
+    self.attrs = {}
+
+  def clear(self):
+    self.erase()
+
+  def move(self, y, x):
+    if not (0 <= y < self.height and 0 <= x < self.width):
+      raise curses.error('move() returned ERR')
+    (self._y, self._x) = (y, x)
+    self.cursor = (y, x)
+
+  def clrtoeol(self):
+    (y, x) = (self._y, self._x)
+    if y in self.lines:
+      del self.lines[y][x:]
+    if y in self.attrs:
+      del self.attrs[y][x:]
+
+  def addch(self, *args):
+    # addch(ch), addch(ch, attr), addch(y, x, ch), addch(y, x, ch, attr)
+    # ch is a char or its code. Cursor moves next as addstr().
+    args = list(args)
+    index = 2 if len(args) >= 3 else 0
+    if isinstance(args[index], int):
+      args[index] = chr(args[index])
+    self.addstr(*args)
+
+  def addstr(self, *args):
+    # addstr(text), addstr(text, attr), addstr(y, x, text), addstr(y, x, text, attr)
+    if len(args) >= 3:
+      (y, x, text) = args[:3]
+      attr = args[3] if len(args) > 3 else 0
+    else:
+      (y, x) = (self._y, self._x)
+      text = args[0]
+      attr = args[1] if len(args) > 1 else 0
+    if not (0 <= y < self.height and 0 <= x < self.width):
+      raise curses.error('addstr() returned ERR')
+
+    # Wrap at the right end and clear the rest of line at NEW-LINE as curses does.
+    for char in text:
+      if y >= self.height:
+        raise curses.error('addstr() returned ERR')
+      line = self.lines.setdefault(y, [])
+      attrs = self.attrs.get(y)
+      if char == '\n':
+        del line[x:]
+        if attrs is not None:
+          del attrs[x:]
+        (y, x) = (y + 1, 0)
+        continue
+      if len(line) <= x:
+        line.extend(' ' * (x + 1 - len(line)))
+      line[x] = char
+      if attr or attrs is not None:
+        if attrs is None:
+          attrs = self.attrs[y] = []
+        if len(attrs) <= x:
+          attrs.extend([0] * (x + 1 - len(attrs)))
+        attrs[x] = attr
+      x += 1
+      if x >= self.width:
+        (y, x) = (y + 1, 0)
+    if y >= self.height:
+      # Bottom right cell is written, but cursor can't go next.
+      (self._y, self._x) = (self.height - 1, self.width - 1)
+      raise curses.error('addstr() returned ERR')
+    (self._y, self._x) = (y, x)
+
+  def snapshot(self):
+    # {y : (text, attrs)}. attrs is None if all 0.
+    lines = {}
+    for (y, line) in self.lines.items():
+      if not line:
+        continue
+      attrs = self.attrs.get(y)
+      if attrs is not None:
+        attrs.extend([0] * (len(line) - len(attrs)))
+        attrs = tuple(attrs) if any(attrs) else None
+      lines[y] = (''.join(line), attrs)
+    return lines
+
+
+class FrameRenderer:
+  # Draw frames on a curses window. Only the cells changed from the last
+  # frame are written, and refresh() is skipped if nothing is changed.
+  # Redrawing all after stdscr.clear() made curses repaint the whole
+  # terminal on each refresh. (Flicker over slow SSH)
+  #
+  # renderer = FrameRenderer(stdscr)
+  # frame = renderer.new_frame()
+  # frame.addstr(0, 0, 'text')
+  # renderer.render(frame)
+  #
+  # stats() :
+  #  - frames : Number of render() calls. skipped : Of them, without refresh.
+  #  - lines_written, cells_written, bytes_written : Text written to the window.
+  #    Cursor moves and escape sequences of the terminal are not counted.
+  #  - render_time_avg, render_time_max, render_time_last : Seconds of
+  #    diff + write + refresh.
+
+  def __init__(self, window):
+    self.window = window
+    # {y : (text, attrs)} of the last frame. None if window content is unknown.
+    self._lines = None
+    self._cursor = None
+    self._visibility = None
+    self._size = None
+
+    self.frames = 0
+    self.skipped = 0
+    self.lines_written = 0
+    self.cells_written = 0
+    self.bytes_written = 0
+    self.render_time_total = 0.0
+    self.render_time_max = 0.0
+    self.render_time_last = 0.0
+
+  def new_frame(self):
+    return _Frame(self.window)
+
+  def invalidate(self):
+    # Window was drawn by other code. Next render() writes all.
+    self._lines = None
+    self._visibility = None
+
+  def render(self, frame):
+    # Return True if the window is refreshed.
+    start = time.perf_counter()
+    window = self.window
+    size = (frame.height, frame.width)
+    if size != self._size:
+      self._size = size
+      self._lines = None
+
+    changed = False
+    last_lines = self._lines
+    if last_lines is None:
+      window.erase()
+      last_lines = {}
+      changed = True
+    lines = frame.snapshot()
+    for y in sorted(set(last_lines).union(lines)):
+      old = last_lines.get(y, ('', None))
+      new = lines.get(y, ('', None))
+      if old != new:
+        self._write_line(y, old, new)
+        changed = True
+
+    visibility = 0 if frame.cursor is None else 1
+    if visibility != self._visibility:
+      try:
+        curses.curs_set(visibility)
+      except curses.error:
+        # Terminal can't hide cursor.
+        pass
+      self._visibility = visibility
+      changed = True
+    if frame.cursor != self._cursor:
+      changed = True
+    if changed:
+      if frame.cursor is not None:
+        window.move(*frame.cursor)
+      window.refresh()
+    else:
+      self.skipped += 1
+    self._lines = lines
+    self._cursor = frame.cursor
+
+    elapsed = time.perf_counter() - start
+    self.frames += 1
+    self.render_time_total += elapsed
+    self.render_time_max = max(self.render_time_max, elapsed)
+    self.render_time_last = elapsed
+    return changed
+
+  def stats(self):
+    return {
+      'frames' : self.frames,
+      'skipped' : self.skipped,
+      'lines_written' : self.lines_written,
+      'cells_written' : self.cells_written,
+      'bytes_written' : self.bytes_written,
+      'render_time_avg' : self.render_time_total / self.frames if self.frames else 0.0,
+      'render_time_max' : self.render_time_max,
+      'render_time_last' : self.render_time_last,
+    }
+
+  def _write_line(self, y, old, new):
+    # Write from the first changed cell to the last one. Clear the rest if shorter.
+    (old_text, old_attrs) = old
+    (text, attrs) = new
+    old_attrs = old_attrs or (0,) * len(old_text)
+    attrs = attrs or (0,) * len(text)
+    common = min(len(text), len(old_text))
+    first = 0
+    while first < common and text[first] == old_text[first] and attrs[first] == old_attrs[first]:
+      first += 1
+    end = len(text)
+    if len(text) == len(old_text):
+      while end > first and text[end - 1] == old_text[end - 1] and attrs[end - 1] == old_attrs[end - 1]:
+        end -= 1
+
+    # One addstr() per run of same attr.
+    x = first
+    while x < end:
+      run_end = x + 1
+      while run_end < end and attrs[run_end] == attrs[x]:
+        run_end += 1
+      try:
+        self.window.addstr(y, x, text[x:run_end], attrs[x])
+      except curses.error:
+        # Writing bottom right cell is ERR for curses. But it is written.
+        if (y, run_end) != (self._size[0] - 1, self._size[1]):
+          raise
+      x = run_end
+    if len(text) < len(old_text):
+      self.window.move(y, len(text))
+      self.window.clrtoeol()
+
+    self.lines_written += 1
+    self.cells_written += end - first
+    self.bytes_written += len(text[first:end].encode())
+
+
 ###
 ### Main
 ###
@@ -41,19 +801,25 @@ class ConsoleView:
   KEY_ENTER = 'CV_KEY_ENTER'
   KEY_ESC = 'CV_KEY_ESC'
   KEY_TAB = 'CV_KEY_TAB'
+  # Only returned by show_text_input_form(live=True)
+  KEY_CHANGE = 'CV_KEY_CHANGE'
+  KEY_PAGE_UP = 'CV_KEY_PAGE_UP'
+  KEY_PAGE_DOWN = 'CV_KEY_PAGE_DOWN'
+
+  # FrameRenderer of the current stdscr. Shared by showtop and input forms.
+  _renderer = None
 
   ###
   ### Logger for init
   ###
 
   @staticmethod
-  def create_logger(log_file='consoleview.log', level=logging.INFO, formatter='%(message)s'):
-      logger = logging.getLogger('ConsoleViewLogger')
-      logger.setLevel(level)
-      handler = logging.FileHandler(log_file)  
-      handler.setFormatter(logging.Formatter(formatter))
-      logger.addHandler(handler)
-      return logger
+  def create_logger(log_file='consoleview.log', level=logging.INFO, formatter='%(message)s',
+    queue_size=10000, max_bytes=10 * 1024 ** 2, backup_count=3, queue_bytes=64 * 1024 ** 2):
+      # Written by background thread. UI loop doesn't wait for disk.
+      # Safe to call again. Handler is reused, not added.
+      return asynclog.create_logger('ConsoleViewLogger', log_file, level, formatter,
+        queue_size, max_bytes, backup_count, queue_bytes)
 
   ###
   ### Constructor and destructor
@@ -62,20 +828,8 @@ class ConsoleView:
   def __init__(self, logger=_VoidLogger()):
     logger.debug('ConsoleView.__init__() : Start.')
 
-    # Shared Objects
-    class Shared:
-      def __str__(self):
-        # Object dump
-        text = ''
-        for (key, value) in vars(self).items():
-          text += '{} : {}\n'.format(key, value)
-        return text
-
-    # Params
-    self._refresh_rate = 100
-
     # Private vars
-    self._shared = Shared()
+    self._shared = _Shared()
     self._logger = logger
     self._init_funs = []
     self._util_funs = []
@@ -85,7 +839,6 @@ class ConsoleView:
     self._did_auto_init = False
 
     # Fasten response for Escape Key
-    import os
     os.environ.setdefault('ESCDELAY', '25')
     
     logger.debug('ConsoleView.__init__() : End.')
@@ -138,6 +891,13 @@ class ConsoleView:
     self._keymap[key] = fun
 
 
+  def get_render_stats(self):
+    # FrameRenderer.stats() of showtop and input forms. Empty before start().
+    if ConsoleView._renderer is None:
+      return {}
+    return ConsoleView._renderer.stats()
+
+
   def start(self, debug_showtop=False):
     self._logger.debug('ConsoleView.start() : start')
     # Go in to curses mode with wrapper.
@@ -167,21 +927,33 @@ class ConsoleView:
   ###
 
   @staticmethod
-  def show_text_input_form(stdscr, deco_list, y, x, initial_text, index, warning, logger=_VoidLogger()):
-    
-    # show cursor
-    curses.curs_set(1) 
+  def get_renderer(stdscr):
+    # Same FrameRenderer for same stdscr. Last frame is kept between calls.
+    renderer = ConsoleView._renderer
+    if renderer is None or renderer.window is not stdscr:
+      renderer = FrameRenderer(stdscr)
+      ConsoleView._renderer = renderer
+    return renderer
+
+
+  @staticmethod
+  def show_text_input_form(stdscr, deco_list, y, x, initial_text, index, warning, logger=_VoidLogger(), live=False):
+    # live : Return KEY_CHANGE on each edit of text, and KEY_PAGE_UP/KEY_PAGE_DOWN
+    #   on PageUp/Up and PageDown/Down keys. So caller can update deco_list.
+
+    # Only changed cells are written on each key input. Cursor is shown by move().
+    renderer = ConsoleView.get_renderer(stdscr)
     text = initial_text
 
     while True:
 
       # init
-      stdscr.clear()
+      frame = renderer.new_frame()
       for (dx, dy, dtext) in deco_list:
-        stdscr.addstr(dx, dy, dtext)
-      stdscr.addstr(y, x, text)
-      stdscr.move(y, x + index)
-      stdscr.refresh()
+        frame.addstr(dx, dy, dtext)
+      frame.addstr(y, x, text)
+      frame.move(y, x + index)
+      renderer.render(frame)
 
       # key input 
       key = stdscr.getkey()
@@ -195,6 +967,10 @@ class ConsoleView:
         elif key == 'KEY_RIGHT':
           if len(text) > index:
             index += 1
+        elif live and key in ['KEY_PPAGE', 'KEY_UP']:
+          return (ConsoleView.KEY_PAGE_UP, index, text)
+        elif live and key in ['KEY_NPAGE', 'KEY_DOWN']:
+          return (ConsoleView.KEY_PAGE_DOWN, index, text)
         continue
 
       # Special Keys
@@ -215,56 +991,25 @@ class ConsoleView:
         if index != 0:
           text = text[:index-1] + text[index:]
           index -= 1
+          if live:
+            return (ConsoleView.KEY_CHANGE, index, text)
 
       # Alphabet, Number etc.
       keycode = ord(key)
       if keycode >= 32 and keycode <= 126:
         text = text[:index] + key + text[index:]
         index += 1
+        if live:
+          return (ConsoleView.KEY_CHANGE, index, text)
 
 
   @staticmethod
   def autocomplete(text, candidates, logger=_VoidLogger()):
-    # Autocomplete function with N-Tree Algorithm like T-CAM.
-    # When Candidates are ["abcdef", "abd", "abcd"].
-    # Adds "\n" on each words ["abcdef\n", "abd\n", "abcd\n"].
-    # And then, create this tree.
-    #
-    # "a" --- "b" -+- "c" --- "d" -+- "e" --- "f" --- "\n"
-    #              |               |
-    #              +- "d" --- "\n" +- "\n"
-    #
-    # It will be achieved as recursive dict.
-    #
-    # {
-    #   "a": {
-    #     "b": {
-    #       "c": {
-    #         "d": {
-    #           "\n": {},
-    #           "e": {
-    #             "f": {
-    #               "\n": {}
-    #             }
-    #           }
-    #         }
-    #       },
-    #       "d": {
-    #         "\n": {}
-    #       }
-    #     }
-    #   }
-    # }
+    # Autocomplete text as possible as candidates can.
+    # candidates : List of words or PrefixIndex. Pass PrefixIndex to reuse it
+    #   on each call. List is made into PrefixIndex every time.
     #
-    # And Track it as possible as text can.
-    # (1) Move to the node by text chars.
-    # (2) Check the next nodes
-    #      - If current node has only 1 child and it is not "\n", move to next node
-    #      - Else : End
-    # (3) Add node-char to the text and Move to next node.
-    # (4) Go to (2) 
-    #
-    # With above sample, autocompete will work as,
+    # With candidates ["abcdef", "abd", "abcd"], autocompete will work as,
     #  text    : return-text
     #  - ''    : ab
     #  - a     : ab
@@ -273,80 +1018,21 @@ class ConsoleView:
     #  - abd   : abd
     #  - abc   : abcd
     #  - abcde : abcdef
+    #
+    # See PrefixIndex for the tree.
 
     logger.debug('ConsoleView.autocomplete() : Start.')
-    original_text = text
-
-    # Check whether candidate is ok.
-    for candidate in candidates:
-      if '\n' in candidate:
-        raise Exception("Candidate words can't contain NEW-LINE")
-
-    # Make tree.
-    logger.debug('ConsoleView.autocomplete() : Make tree from candidates.')
-    d = {}
-    for candidate in candidates:
-      candidate += '\n'
-
-      # Move to head node of the tree. And looping by each character
-      current_dict = d
-      for c in candidate:
-
-        if c in current_dict:
-          # The character is in current position -> do nothing.
-          pass
-        else:
-          # Not in current position -> add the char.
-          current_dict[c] = {}
-
-        # Move to next node
-        current_dict = current_dict[c]
-
-    # Dump tree.
-    json_text = json.dumps(d, sort_keys=True, indent=2)
-    logger.debug('ConsoleView.autocomplete() : Tree\n{}'.format(json_text))
-
-    # Check whether able to autocomplete or not. If not, return oritinal text.
-    logger.debug('ConsoleView.autocomplete() : Check whether able to autocomplete or not.')
-    current_dict = d
-    # Looping via each character.
-    for c in text:
-      if c not in current_dict:
-        # Unable to do autocompletion.
-        return text
-
-      # Move to next node.
-      current_dict = current_dict[c]
-
-    # Able to do autocomplete.
-    # Track the tree as possible as text can.
-    logger.debug('ConsoleView.autocomplete() : Track tree as possible as text can.')
-    while True:
-      # no candidate or 2+ candidates. End autocompletion.
-      if '\n' in current_dict:
-        # having 1 or 2+ candidate.
-        # 1  Candidate   -> End.
-        # 2+ Candidates. -> 1 Candidate end at this node. Unable to track next. End.
-        break
-      if len(current_dict) > 1:
-        # 2+ Candidates -> End.
-        break
+    if isinstance(candidates, PrefixIndex):
+      index = candidates
+    else:
+      logger.debug('ConsoleView.autocomplete() : Make tree from candidates.')
+      index = PrefixIndex(candidates)
 
-      # Having only 1 key
-      # Get the char and get next node.
-      (c, next_dict) = next(iter(current_dict.items()))
-
-      # Add char to the text
-      text += c
-
-      # Move to next node.
-      current_dict = next_dict
-        
-    # Done. return autocompleted text.
+    completed_text = index.complete(text)
     logger.debug(
       'ConsoleView.autocomplete() : Original-Text="{}", Autocompleted-Text="{}"'.format(
-        original_text, text))
-    return text
+        text, completed_text))
+    return completed_text
 
 
   ###
@@ -453,57 +1139,113 @@ class ConsoleView:
 
     self._auto_init()
     warning = ''
-
-    # start looping
-    self._logger.debug('ConsoleView._start() : Entering infinite UI loop.')
-    while True:
-      try:
-        stdscr.clear()
-        self._showtop(self._shared, stdscr, warning, self._logger)
-        # hide cursor
-        curses.curs_set(0)
-        stdscr.refresh()
-
-        # Set timeout to refresh top ui periodically.
-        stdscr.timeout(self._refresh_rate) 
-        key = stdscr.getkey()
-        # If no key input happens within refresh-rate, go to "except curses.error".
-
-        # Had key input.
-        # Remove timeout for keymap functions
-        stdscr.timeout(-1)   
-
-        if len(key) != 1:
-          # Special keys. Might be ARROW KEY.
-          logging_debug('ConsoleView.start() : Key input. Special key "{}"'.format(key))
-          continue
-
-        if ord(key) == 27:
-          # Escape key means quit this app. Break infinite loop.
-          logging_debug('ConsoleView._start() : Key input "Escape". Quitting')
-          break
-
-        if key in self._keymap:
-          # Registerd keys. Go to the value function.
-          logging_debug('ConsoleView._start() : Key input. Registered key "{}"'.format(key))
-          fun = self._keymap[key]
-          warning = fun(self._shared, stdscr, self._logger)
-
-        else:
-          # Other keys. Ignore.
-          logging_debug('ConsoleView._start() : Key input. Non-Registerd key "{}"'.format(key))
-
-      except curses.error as e:
-        if str(e) != 'no input':
+    # showtop draws on a frame. Only the difference from the last one is
+    # written, and the screen isn't refreshed if nothing is changed.
+    renderer = ConsoleView.get_renderer(stdscr)
+
+    # No periodic redraw. Loop sleeps until key input or change of shared.
+    # Change of shared and resize of terminal write a byte to wake_w.
+    (wake_r, wake_w) = os.pipe()
+    # Everything below is undone in "finally", even on KeyboardInterrupt.
+    # A closed fd left in shared would get the bytes of a file opened later.
+    resize_installed = False
+    try:
+      os.set_blocking(wake_r, False)
+      os.set_blocking(wake_w, False)
+      self._shared._add_wake_fd(wake_w)
+      resized = []
+      def on_resize(signum, stack):
+        resized.append(signum)
+        try:
+          os.write(wake_w, b'\0')
+        except OSError:
+          pass
+      # Replaces the handler of curses. Size is told to curses by resizeterm() in the loop.
+      # System calls are restarted so getkey() of input forms isn't broken by resize.
+      handle_resize = hasattr(signal, 'SIGWINCH') and threading.current_thread() is threading.main_thread()
+      if handle_resize:
+        previous_handler = signal.signal(signal.SIGWINCH, on_resize)
+        resize_installed = True
+        signal.siginterrupt(signal.SIGWINCH, False)
+      drawn_version = None
+      redraw = True
+
+      # start looping
+      self._logger.debug('ConsoleView._start() : Entering infinite UI loop.')
+      while True:
+        try:
+          if resized:
+            del resized[:]
+            (columns, lines) = os.get_terminal_size(sys.__stdin__.fileno())
+            curses.resizeterm(lines, columns)
+            redraw = True
+
+          version = self._shared.get_version()
+          if redraw or version != drawn_version:
+            frame = renderer.new_frame()
+            self._showtop(self._shared, frame, warning, self._logger)
+            renderer.render(frame)
+            (drawn_version, redraw) = (version, False)
+
+          # Keys already read by curses first. If none, go to "except curses.error".
+          stdscr.timeout(0)
+          key = stdscr.getkey()
+
+          # Had key input. Warning and screen may be changed.
+          # Remove timeout for keymap functions
+          stdscr.timeout(-1)
+          redraw = True
+
+          if len(key) != 1:
+            # Special keys. Might be ARROW KEY.
+            logging_debug('ConsoleView.start() : Key input. Special key "{}"'.format(key))
+            continue
+
+          if ord(key) == 27:
+            # Escape key means quit this app. Break infinite loop.
+            logging_debug('ConsoleView._start() : Key input "Escape". Quitting')
+            break
+
+          if key in self._keymap:
+            # Registerd keys. Go to the value function.
+            logging_debug('ConsoleView._start() : Key input. Registered key "{}"'.format(key))
+            fun = self._keymap[key]
+            warning = fun(self._shared, stdscr, self._logger)
+            # Key function may draw on stdscr directly.
+            renderer.invalidate()
+
+          else:
+            # Other keys. Ignore.
+            logging_debug('ConsoleView._start() : Key input. Non-Registerd key "{}"'.format(key))
+
+        except curses.error as e:
+          if str(e) == 'no input':
+            # Sleep until key input or change of shared. No timeout.
+            select.select([sys.__stdin__.fileno(), wake_r], [], [])
+            try:
+              while os.read(wake_r, 4096):
+                pass
+            except BlockingIOError:
+              pass
+          else:
+            warning = 'Error. Unexpected error happens. Please check log.'
+            self._logger.error('\n' + traceback.format_exc())
+            redraw = True
+            time.sleep(0.1)
+
+        except Exception as e:
           warning = 'Error. Unexpected error happens. Please check log.'
           self._logger.error('\n' + traceback.format_exc())
+          redraw = True
           time.sleep(0.1)
 
-      except Exception as e:
-        warning = 'Error. Unexpected error happens. Please check log.'
-        self._logger.error('\n' + traceback.format_exc())
-        time.sleep(0.1)
-
+    finally:
+      if resize_installed:
+        signal.signal(signal.SIGWINCH, signal.SIG_DFL if previous_handler is None else previous_handler)
+      self._shared._remove_wake_fd(wake_w)
+      os.close(wake_r)
+      os.close(wake_w)
+    self._logger.debug('ConsoleView._start() : Render stats {}'.format(renderer.stats()))
     self._logger.debug('ConsoleView._start() : End.')
 
 
@@ -6,10 +6,13 @@ Author: Yuichi Ito
 Email: yuichi.ito@nutanix.com
 '''
 
-from consoleview import ConsoleView
+from consoleview import ConsoleView, PrefixIndex, NameSearch, SearchFilter
 KEY_ENTER = ConsoleView.KEY_ENTER
 KEY_ESC = ConsoleView.KEY_ESC
 KEY_TAB = ConsoleView.KEY_TAB
+KEY_CHANGE = ConsoleView.KEY_CHANGE
+KEY_PAGE_UP = ConsoleView.KEY_PAGE_UP
+KEY_PAGE_DOWN = ConsoleView.KEY_PAGE_DOWN
 show_text_input_form = ConsoleView.show_text_input_form
 autocomplete = ConsoleView.autocomplete
 
@@ -21,6 +24,9 @@ MAIN_LOG_NAME = 'main_console.log'
 MAIN_LOG_LEVEL = logging.DEBUG
 MAIN_LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s :%(message)s'
 
+# Number of names shown at once on vm name, vdisk label and container inputs.
+NAME_LIST_PAGE_SIZE = 10
+
 
 ###
 ### Custom Exception Class for intended raise.
@@ -50,6 +56,10 @@ def init(shared):
   shared.target_container = ''
   shared.image_name = ''
 
+  # PrefixIndex and NameSearch of names per picker. Kept until session is cleared.
+  shared.name_indexes = {}
+  shared.name_searches = {}
+
   # For both main and thread:poll_task
   shared.task_uuid = ''
   shared.task_percent = 0
@@ -62,6 +72,8 @@ def init(shared):
 
 def clear_session(shared):
   shared.session = None
+  shared.name_indexes = {}
+  shared.name_searches = {}
   shared.vm_name = ''
   shared.vdisk_label = ''
   shared.target_container = ''
@@ -77,6 +89,39 @@ def clear_task(shared):
   shared.task_status = ''
 
 
+def get_name_index(shared, kind, names):
+  # PrefixIndex of names for the picker of kind ("vm", "container" etc).
+  # Made at first time. After that, only differences from names are applied.
+  index = shared.name_indexes.get(kind)
+  if index is None:
+    index = PrefixIndex(names)
+    shared.name_indexes[kind] = index
+  else:
+    index.update(names)
+  return index
+
+
+def get_name_search(shared, kind, names):
+  # NameSearch of names for the picker of kind. Made again only if names are changed.
+  names = frozenset(names)
+  (last_names, search) = shared.name_searches.get(kind, (None, None))
+  if names != last_names:
+    search = NameSearch(names)
+    shared.name_searches[kind] = (names, search)
+  return search
+
+
+def make_name_list_deco(title, name_filter, noun):
+  # deco_list of input form with one page of matching names.
+  deco_list = [
+    (0, 0, title),
+    (3, 0, '{} {}. Page {}/{} (Up/Down)'.format(name_filter.total, noun, name_filter.page + 1, name_filter.num_pages)),
+  ]
+  for (i, name) in enumerate(name_filter.page_names()):
+    deco_list.append((4 + i, 2, name))
+  return deco_list
+
+
 ###
 ### ConsoleView Top UI
 ###
@@ -150,8 +195,10 @@ def poll_task(shared, logger):
       logger.error(error_dict)
       raise IntendedException('Error. Polling task "{}" failed.'.format(shared.task_uuid))
 
-    shared.task_status = task_dict['status']
-    shared.task_percent = task_dict['percent']
+    # One change for showtop. Nothing is redrawn if status is same as last.
+    with shared.batch():
+      shared.task_status = task_dict['status']
+      shared.task_percent = task_dict['percent']
 
   except IntendedException as e:
     pass
@@ -359,26 +406,36 @@ def show_input_vm_name(shared, stdscr, logger):
       logger.error(drror_dict)
       raise IntendedException(error_dict['error'])
 
+    vm_index = shared.get_name_index(shared, 'vm', vms)
+    vm_search = shared.get_name_search(shared, 'vm', vms)
+
     def validate_format(text):
       if text == '':
         return True
-      return text in vms
+      return text in vm_index
 
     # Auto complete at first
-    text = autocomplete(shared.vm_name, vms)
+    text = autocomplete(shared.vm_name, vm_index)
     index = len(text)
     warning = ''
 
-    while True:
-      filtered_vms = list(filter(lambda x: x.startswith(text), vms))
-      deco_list = [
-        (0, 0, 'Please input vm name.'),
-        (4, 0, str(filtered_vms))
-      ]
-
-      (key, index, text) = show_text_input_form(stdscr, deco_list, 1, 0, text, index, warning)
+    # Matching vms (prefix, substring, then fuzzy) are searched on each key input.
+    # One page of them is shown. Enter takes only an exact vm name.
+    vm_filter = SearchFilter(vm_search, NAME_LIST_PAGE_SIZE)
 
-      if key == KEY_ESC:
+    while True:
+      vm_filter.set_text(text)
+      deco_list = make_name_list_deco('Please input vm name.', vm_filter, 'vms')
+
+      (key, index, text) = show_text_input_form(stdscr, deco_list, 1, 0, text, index, warning, live=True)
+
+      if key == KEY_CHANGE:
+        continue
+      elif key == KEY_PAGE_UP:
+        vm_filter.move_page(-1)
+      elif key == KEY_PAGE_DOWN:
+        vm_filter.move_page(1)
+      elif key == KEY_ESC:
         break
       elif key == KEY_ENTER:
         if validate_format(text):
@@ -389,7 +446,7 @@ def show_input_vm_name(shared, stdscr, logger):
         else:
           warning = 'Not good'
       elif key == KEY_TAB:
-        text = autocomplete(text, vms)
+        text = autocomplete(text, vm_index)
         index = len(text)
   
   except IntendedException as e:
@@ -415,26 +472,32 @@ def show_input_vdisk_label(shared, stdscr, logger):
     if not success:
       raise IntendedException('API Failed at getting vdisk labels on vm="{}".'.format(shared.vm_name))
 
+    label_index = shared.get_name_index(shared, 'vdisk', labels)
+    label_filter = SearchFilter(shared.get_name_search(shared, 'vdisk', labels), NAME_LIST_PAGE_SIZE)
+
     def validate_format(text):
       if text == '':
         return True
-      return text in labels
+      return text in label_index
 
     # Auto complete at first
-    text = autocomplete(shared.vdisk_label, labels)
+    text = autocomplete(shared.vdisk_label, label_index)
     index = len(text)
     warning = ''
 
     while True:
-      filtered_vdisks = list(filter(lambda x: x.startswith(text), labels))
-      deco_list = [
-        (0, 0, 'Please input vdisk label.'),
-        (4, 0, str(filtered_vdisks))
-      ]   
-
-      (key, index, text) = show_text_input_form(stdscr, deco_list, 1, 0, text, index, warning)
-
-      if key == KEY_ESC:
+      label_filter.set_text(text)
+      deco_list = make_name_list_deco('Please input vdisk label.', label_filter, 'vdisks')
+
+      (key, index, text) = show_text_input_form(stdscr, deco_list, 1, 0, text, index, warning, live=True)
+
+      if key == KEY_CHANGE:
+        continue
+      elif key == KEY_PAGE_UP:
+        label_filter.move_page(-1)
+      elif key == KEY_PAGE_DOWN:
+        label_filter.move_page(1)
+      elif key == KEY_ESC:
         break
       elif key == KEY_ENTER:
         if validate_format(text):
@@ -444,7 +507,7 @@ def show_input_vdisk_label(shared, stdscr, logger):
         else:
           warning = 'Not good'
       elif key == KEY_TAB:
-        text = autocomplete(text, labels)
+        text = autocomplete(text, label_index)
         index = len(text)
 
   except IntendedException as e:
@@ -470,27 +533,33 @@ def show_input_target_container(shared, stdscr, logger):
     if not success:
       raise IntendedException('API failed. Please try login again.')
 
+    container_index = shared.get_name_index(shared, 'container', containers)
+    container_filter = SearchFilter(shared.get_name_search(shared, 'container', containers), NAME_LIST_PAGE_SIZE)
+
     def validate_format(text):
       if text == '':
         # initialize
         return True
-      return text in containers
+      return text in container_index
 
     # Auto complete at first
-    text = autocomplete(shared.target_container, containers)
+    text = autocomplete(shared.target_container, container_index)
     index = len(text)
     warning = ''
 
     while True:
-      filtered_containers = list(filter(lambda x: x.startswith(text), containers))
-      deco_list = [
-        (0, 0, 'Please input target container name.'),
-        (4, 0, str(filtered_containers))
-      ]   
-
-      (key, index, text) = show_text_input_form(stdscr, deco_list, 1, 0, text, index, warning)
-
-      if key == KEY_ESC:
+      container_filter.set_text(text)
+      deco_list = make_name_list_deco('Please input target container name.', container_filter, 'containers')
+
+      (key, index, text) = show_text_input_form(stdscr, deco_list, 1, 0, text, index, warning, live=True)
+
+      if key == KEY_CHANGE:
+        continue
+      elif key == KEY_PAGE_UP:
+        container_filter.move_page(-1)
+      elif key == KEY_PAGE_DOWN:
+        container_filter.move_page(1)
+      elif key == KEY_ESC:
         break
       elif key == KEY_ENTER:
         if validate_format(text):
@@ -500,7 +569,7 @@ def show_input_target_container(shared, stdscr, logger):
         else:
           warning = 'Not good'
       elif key == KEY_TAB:
-        text = autocomplete(text, containers)
+        text = autocomplete(text, container_index)
         index = len(text)
 
   except IntendedException as e:
@@ -595,9 +664,10 @@ def create_image(shared, stdscr, logger):
       logger.error(error_dict)
       raise IntendedException('Failed to get task status.')
 
-    shared.task_uuid = task_dict['uuid']
-    shared.task_status = task_dict['status']
-    shared.task_percent = task_dict['percent']
+    with shared.batch():
+      shared.task_uuid = task_dict['uuid']
+      shared.task_status = task_dict['status']
+      shared.task_percent = task_dict['percent']
 
   except IntendedException as e:
     error = str(e)
@@ -624,6 +694,8 @@ if __name__ == '__main__':
   # util
   view.add_fun_util('clear_session', clear_session)
   view.add_fun_util('clear_task', clear_task)
+  view.add_fun_util('get_name_index', get_name_index)
+  view.add_fun_util('get_name_search', get_name_search)
 
   # thread
   view.add_fun_thread(poll_task, 1)
@@ -0,0 +1,396 @@
+'''
+Local stand-in of Prism REST API for tests and benchmarks.
+Serves synthetic cluster inventory over plain HTTP. No cluster needed.
+
+Author: Yuichi Ito
+Email: yuichi.ito@nutanix.com
+'''
+
+import base64
+import json
+import socket
+import threading
+import time
+import uuid as uuidlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+  # Clients closing keep-alive connections are normal. Don't print them.
+  daemon_threads = True
+  # Many clients connect at once. Default backlog(5) drops their SYNs.
+  request_queue_size = 128
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    # Open connections. Closed by stop() so that clients can't keep using them.
+    self.connections = set()
+
+  def handle_error(self, request, client_address):
+    pass
+
+  def process_request(self, request, client_address):
+    self.connections.add(request)
+    super().process_request(request, client_address)
+
+  def shutdown_request(self, request):
+    self.connections.discard(request)
+    super().shutdown_request(request)
+
+  def close_connections(self):
+    for request in list(self.connections):
+      try:
+        request.shutdown(socket.SHUT_RDWR)
+      except OSError:
+        pass
+
+
+class MockPrism:
+
+  def __init__(self, num_vms=100, num_networks=5, num_images=3, port=0, latency=0, legacy=False,
+    credential=None):
+    # port 0 : Choose free port. Check self.port after start().
+    # latency : Seconds to sleep on each request. Emulates network round trip.
+    # legacy : Emulate old API. Filters are ignored and uuid addressed GETs are 404.
+    # credential : (username, password). None accepts everything.
+    #   Requests with right basic auth get a session cookie. Requests with the
+    #   cookie pass without credential till expire_sessions(). Others are 401.
+    self.latency = latency
+    self.legacy = legacy
+    self.credential = credential
+    self.num_requests = 0
+    self.num_logins = 0
+    self.num_unauthorized = 0
+    self.bytes_sent = 0
+    self.requests = []
+    self._lock = threading.Lock()
+    self._tasks = {}
+    self._task_results = []
+    self._faults = []
+    self._sessions = set()
+
+    def fixed_uuid(kind, i):
+      return str(uuidlib.uuid5(uuidlib.NAMESPACE_OID, '{}-{}'.format(kind, i)))
+
+    self.cluster = {
+      'uuid' : fixed_uuid('cluster', 0), 'name' : 'mock-cluster', 'timezone' : 'UTC',
+      'isLTS' : True, 'version' : '5.10', 'nccVersion' : '3.7',
+      'clusterRedundancyState' : {'currentRedundancyFactor' : 2, 'desiredRedundancyFactor' : 2},
+      'clusterExternalIPAddress' : '127.0.0.1', 'clusterExternalDataServicesIPAddress' : None,
+      'externalSubnet' : '127.0.0.0/255.0.0.0', 'internalSubnet' : '192.168.5.0/255.255.255.128',
+      'globalNfsWhiteList' : [], 'numNodes' : 3, 'blockSerials' : ['MOCK-BLOCK'],
+      'nameServers' : ['8.8.8.8'], 'ntpServers' : ['ntp.example.com'], 'smtpServer' : None,
+      'storageType' : 'mixed', 'hypervisorTypes' : ['kKvm'],
+    }
+    self.storage_pools = [{'name' : 'default-storage-pool', 'storagePoolUuid' : fixed_uuid('pool', 0)}]
+    self.containers = []
+    for (i, name) in enumerate(['container', 'NutanixManagementShare']):
+      self.containers.append({
+        'name' : name, 'id' : 'mock::{}'.format(i), 'containerUuid' : fixed_uuid('container', i),
+        'storagePoolUuid' : self.storage_pools[0]['storagePoolUuid'],
+        'usageStats' : {'storage.usage_bytes' : '0'},
+      })
+    self.networks = []
+    for i in range(num_networks):
+      self.networks.append({
+        'name' : 'network-{}'.format(i), 'uuid' : fixed_uuid('network', i), 'vlan_id' : i, 'ip_config' : {},
+      })
+    self.images = []
+    for i in range(num_images):
+      self.images.append({
+        'name' : 'image-{}'.format(i), 'uuid' : fixed_uuid('image', i),
+        'vm_disk_id' : fixed_uuid('image-disk', i), 'vm_disk_size' : 10 * 1024 ** 3,
+      })
+    self.vms = []
+    for i in range(num_vms):
+      self.vms.append(self.make_vm('vm-{:05d}'.format(i), fixed_uuid('vm', i),
+        self.networks[i % num_networks]['uuid'] if num_networks else ''))
+
+    handler = self._make_handler()
+    self._server = _QuietHTTPServer(('127.0.0.1', port), handler)
+    self.port = self._server.server_address[1]
+
+  def make_vm(self, name, uuid, network_uuid):
+    return {
+      'name' : name, 'uuid' : uuid, 'memory_mb' : 2048, 'num_vcpus' : 1, 'num_cores_per_vcpu' : 2,
+      'power_state' : 'on', 'timezone' : 'UTC', 'vm_features' : {'AGENT_VM' : False},
+      'vm_disk_info' : [
+        {'disk_address' : {'device_bus' : 'ide', 'disk_label' : 'ide.0'},
+         'is_cdrom' : True, 'flash_mode_enabled' : False, 'is_empty' : True},
+        {'disk_address' : {'device_bus' : 'scsi', 'disk_label' : 'scsi.0', 'vmdisk_uuid' : uuid[::-1]},
+         'is_cdrom' : False, 'flash_mode_enabled' : False, 'is_empty' : False,
+         'storage_container_uuid' : self.containers[0]['containerUuid'], 'size' : 10 * 1024 ** 3},
+      ],
+      'vm_nics' : [
+        {'mac_address' : '50:6b:8d:00:00:00', 'network_uuid' : network_uuid, 'is_connected' : True},
+      ],
+    }
+
+  def start(self):
+    thread = threading.Thread(target=self._server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return self
+
+  def stop(self):
+    self._server.shutdown()
+    self._server.server_close()
+    self._server.close_connections()
+
+  def inject_faults(self, faults):
+    # Fail next requests in order. Each fault is a status code(e.g. 503) to
+    # answer with, or 'reset' to close the connection without response.
+    # Failed requests are counted in num_requests too.
+    with self._lock:
+      self._faults.extend(faults)
+
+  def inject_task_results(self, results):
+    # Next created tasks end with these progressStatus in order.
+    # 'Running' never ends. Others end with 'Succeeded'.
+    with self._lock:
+      self._task_results.extend(results)
+
+  def clear_faults(self):
+    with self._lock:
+      self._faults = []
+
+  def _take_fault(self):
+    with self._lock:
+      if len(self._faults) == 0:
+        return None
+      return self._faults.pop(0)
+
+  def expire_sessions(self):
+    # Forget all session cookies. Next requests with them are 401.
+    with self._lock:
+      self._sessions = set()
+
+  def _authenticate(self, headers):
+    # Return session id to set as cookie, '' if already in a session, None if unauthorized.
+    if self.credential is None:
+      return ''
+    authorization = headers.get('Authorization') or ''
+    if authorization.startswith('Basic '):
+      expected = base64.b64encode('{}:{}'.format(*self.credential).encode('utf-8')).decode('ascii')
+      with self._lock:
+        if authorization[len('Basic '):] != expected:
+          self.num_unauthorized += 1
+          return None
+        self.num_logins += 1
+        session_id = uuidlib.uuid4().hex
+        self._sessions.add(session_id)
+      return session_id
+    cookie = headers.get('Cookie') or ''
+    session_ids = [part.strip()[len('JSESSIONID='):] for part in cookie.split(';')
+      if part.strip().startswith('JSESSIONID=')]
+    with self._lock:
+      if any(session_id in self._sessions for session_id in session_ids):
+        return ''
+      self.num_unauthorized += 1
+    return None
+
+  def reset_stats(self):
+    with self._lock:
+      self.num_logins = 0
+      self.num_unauthorized = 0
+      self.num_requests = 0
+      self.bytes_sent = 0
+      self.requests = []
+
+  ###
+  ### Request routing
+  ###
+
+  def _new_task(self):
+    task_uuid = str(uuidlib.uuid4())
+    with self._lock:
+      result = self._task_results.pop(0) if self._task_results else 'Succeeded'
+      self._tasks[task_uuid] = (time.time(), result)
+    return task_uuid
+
+  def _task(self, task_uuid):
+    # Tasks end 0.5 seconds after creation.
+    (created, result) = self._tasks[task_uuid]
+    done = time.time() - created > 0.5 and result != 'Running'
+    return {
+      'uuid' : task_uuid, 'metaRequest' : {'methodName' : 'MockTask'},
+      'percentageComplete' : 100 if done else 50,
+      'progressStatus' : result if done else 'Running',
+    }
+
+  @staticmethod
+  def _vm_view(vm, query):
+    view = dict(vm)
+    if query.get('include_vm_disk_config', ['false'])[0] != 'true':
+      del view['vm_disk_info']
+    if query.get('include_vm_nic_config', ['false'])[0] != 'true':
+      del view['vm_nics']
+    return view
+
+  def _filter(self, entities, query, param, attribute=None):
+    # "filter=vm_name==x" (v2) or "searchString=x" (v1). Both match substrings
+    # like Prism does. Old API ignores them.
+    if self.legacy or param not in query:
+      return entities
+    value = query[param][0]
+    if attribute is not None:
+      (name, _, value) = value.partition('==')
+      if name != attribute:
+        return entities
+    return [entity for entity in entities if value in entity['name']]
+
+  def _by_uuid(self, entities, path, uuid_key='uuid'):
+    # Return the entity addressed by the last part of path. None if not found.
+    if self.legacy:
+      return None
+    entity_uuid = path.rstrip('/').rsplit('/', 1)[1]
+    for entity in entities:
+      if entity[uuid_key] == entity_uuid:
+        return entity
+    return None
+
+  def _list(self, entities, query=None):
+    # Paging. "offset"/"length" (v2) or "page"/"count" (v0.8, v1). Old API ignores them.
+    total = len(entities)
+    if query and not self.legacy:
+      if 'length' in query:
+        offset = int(query.get('offset', ['0'])[0])
+        entities = entities[offset:offset + int(query['length'][0])]
+      elif 'count' in query:
+        count = int(query['count'][0])
+        page = int(query.get('page', ['1'])[0])
+        entities = entities[(page - 1) * count:page * count]
+    metadata = {'grand_total_entities' : total, 'total_entities' : total, 'count' : len(entities)}
+    return {'metadata' : metadata, 'entities' : entities}
+
+  def route(self, method, path, query, body):
+    # Return (status code, response object)
+    prefix_v08 = '/api/nutanix/v0.8'
+    prefix_v1 = '/api/nutanix/v1'
+    prefix_v2 = '/api/nutanix/v2.0'
+
+    if path in ['/PrismGateway/services/rest/v1/cluster', prefix_v1 + '/cluster', prefix_v1 + '/cluster/']:
+      return (200, self.cluster)
+
+    if path == prefix_v1 + '/storage_pools/':
+      return (200, self._list(self.storage_pools))
+    if path == prefix_v1 + '/containers/':
+      if method == 'POST':
+        return (200, {'value' : True})
+      return (200, self._list(self._filter(self.containers, query, 'searchString')))
+    if path.startswith(prefix_v1 + '/containers/') and method == 'DELETE':
+      return (200, {'value' : True})
+    if path.startswith(prefix_v1 + '/containers/'):
+      container = self._by_uuid(self.containers, path, 'containerUuid')
+      if container is None:
+        return (404, {'message' : 'Container not found.'})
+      return (200, container)
+
+    if path == prefix_v2 + '/networks/':
+      if method == 'POST':
+        network = {'name' : body['name'], 'uuid' : str(uuidlib.uuid4()), 'vlan_id' : body['vlan_id'], 'ip_config' : {}}
+        self.networks.append(network)
+        return (200, {'network_uuid' : network['uuid']})
+      return (200, self._list(self.networks, query))
+    if path.startswith(prefix_v2 + '/networks/') and method == 'DELETE':
+      network_uuid = path.rstrip('/').rsplit('/', 1)[1]
+      self.networks = [network for network in self.networks if network['uuid'] != network_uuid]
+      return (200, {})
+    if path.startswith(prefix_v2 + '/networks/'):
+      network = self._by_uuid(self.networks, path)
+      if network is None:
+        return (404, {'message' : 'Network not found.'})
+      return (200, network)
+
+    if path == prefix_v2 + '/vms/':
+      if method == 'POST':
+        return (201, {'task_uuid' : self._new_task()})
+      vms = self._filter(self.vms, query, 'filter', 'vm_name')
+      response_obj = self._list(vms, query)
+      response_obj['entities'] = [self._vm_view(vm, query) for vm in response_obj['entities']]
+      return (200, response_obj)
+    if path.startswith(prefix_v2 + '/vms/'):
+      vm = self._by_uuid(self.vms, path)
+      if vm is None:
+        return (404, {'message' : 'VM not found.'})
+      return (200, self._vm_view(vm, query))
+
+    if path in [prefix_v2 + '/images/', prefix_v08 + '/images/']:
+      if method == 'POST':
+        return (200, {'taskUuid' : self._new_task()})
+      return (200, self._list(self.images, query))
+    if path.startswith(prefix_v08 + '/images/') and method == 'DELETE':
+      return (200, {'taskUuid' : self._new_task()})
+    if path.startswith(prefix_v2 + '/images/'):
+      image = self._by_uuid(self.images, path)
+      if image is None:
+        return (404, {'message' : 'Image not found.'})
+      return (200, image)
+
+    if path == prefix_v08 + '/tasks/':
+      tasks = [self._task(task_uuid) for task_uuid in list(self._tasks)]
+      if query.get('includeCompleted', ['true'])[0] == 'false':
+        tasks = [task for task in tasks if task['percentageComplete'] != 100]
+      return (200, self._list(tasks, query))
+    if path.startswith(prefix_v08 + '/tasks/'):
+      task_uuid = path.rstrip('/').rsplit('/', 1)[1]
+      if task_uuid not in self._tasks:
+        return (404, {'message' : 'Task {} not found.'.format(task_uuid)})
+      return (200, self._task(task_uuid))
+
+    return (404, {'message' : 'No route for {} {}'.format(method, path)})
+
+  def _make_handler(self):
+    mock = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      # Buffer headers and body and send them at once. Written separately,
+      # the body waits for delayed ACK of the headers.
+      wbufsize = -1
+
+      def log_message(self, format, *args):
+        pass
+
+      def handle_any(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw_body = self.rfile.read(length) if length else b''
+        body = json.loads(raw_body) if raw_body else None
+        url = urlparse(self.path)
+        if mock.latency:
+          time.sleep(mock.latency)
+        session_id = mock._authenticate(self.headers)
+        fault = mock._take_fault() if session_id is not None else None
+        if fault == 'reset':
+          with mock._lock:
+            mock.num_requests += 1
+            mock.requests.append('{} {} (reset)'.format(self.command, self.path))
+          self.close_connection = True
+          self.connection.shutdown(socket.SHUT_RDWR)
+          return
+        if session_id is None:
+          (code, response_obj) = (401, {'message' : 'Unauthorized.'})
+        elif fault is not None:
+          (code, response_obj) = (fault, {'message' : 'Injected fault.'})
+        else:
+          (code, response_obj) = mock.route(self.command, url.path, parse_qs(url.query), body)
+        data = json.dumps(response_obj).encode('utf-8')
+        with mock._lock:
+          mock.num_requests += 1
+          mock.bytes_sent += len(data)
+          mock.requests.append('{} {}'.format(self.command, self.path))
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if session_id:
+          self.send_header('Set-Cookie', 'JSESSIONID={}; Path=/'.format(session_id))
+        self.end_headers()
+        self.wfile.write(data)
+
+      do_GET = handle_any
+      do_POST = handle_any
+      do_PUT = handle_any
+      do_DELETE = handle_any
+
+    return Handler
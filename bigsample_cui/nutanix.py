@@ -6,44 +6,66 @@ Email: yuichi.ito@nutanix.com
 '''
 
 import requests
-from requests.exceptions import RequestException
+import requests.adapters
+from requests.exceptions import RequestException, ConnectTimeout, Timeout
 
 import json
+import copy
+import os
+import sys
+import re
+import bisect
+import codecs
+import urllib.parse
 import traceback
 import logging
 import datetime
+import time
+import threading
+import random
+from concurrent.futures import ThreadPoolExecutor
 
 import urllib3
-from urllib3.exceptions import InsecureRequestWarning
+from urllib3.exceptions import InsecureRequestWarning, ConnectTimeoutError
 urllib3.disable_warnings(InsecureRequestWarning)
 
+import asynclog
+
+# Optional faster json libraries. Used by JSON backend "auto" if installed.
+try:
+  import orjson
+except ImportError:
+  orjson = None
+try:
+  import ujson
+except ImportError:
+  ujson = None
+
 
 class NutanixRestApiClient:
 
   @staticmethod
-  def create_logger(log_file, level=logging.INFO):
-      logger = logging.getLogger('NutanixRestApiClientLogger')
-      logger.setLevel(level)
-      handler = logging.FileHandler(log_file)  
-      handler.setFormatter(logging.Formatter('%(message)s'))
-      logger.addHandler(handler)
-      return logger
-
-  def __init__(self, ip, username, password, logger=None, timeout_connection=2, timeout_read=5):
+  def create_logger(log_file, level=logging.INFO, queue_size=10000, max_bytes=10 * 1024 ** 2, backup_count=3,
+    queue_bytes=64 * 1024 ** 2):
+      # Written by background thread. REST calls don't wait for disk.
+      # Safe to call again (re-login). Handler is reused, not added.
+      # See asynclog.AsyncLogHandler for queue_size, max_bytes, backup_count and queue_bytes.
+      return asynclog.create_logger('NutanixRestApiClientLogger', log_file, level, '%(message)s',
+        queue_size, max_bytes, backup_count, queue_bytes)
+
+  def __init__(self, ip, username, password, logger=None, timeout_connection=2, timeout_read=5,
+    entity_cache_ttl=30, cluster_info_max_age=60, retry_policy=None,
+    log_format='full', log_body_limit=None, json_backend='auto',
+    pool_connections=1, pool_maxsize=10, pool_block=False, warmup_connections=0,
+    auth_mode='basic', lazy=False, lookup_mode='filter', port=9440, use_https=True, coalesce_gets=False,
+    metrics=None, hooks=None):
     TIMEOUT = (timeout_connection, timeout_read)
+    STREAM_CHUNK_SIZE = 64 * 1024
+    base_url = '{}://{}:{}'.format('https' if use_https else 'http', ip, port)
 
-    # Test IP and Port reachability
-    is_port_open = True
-    import socket
-    try:
-      s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-      s.settimeout(timeout_connection) # seconds
-      s.connect((ip, 9440))
-      s.shutdown(2)
-    except Exception as e:
-      is_port_open = False
-    if not is_port_open:
-      raise Exception('Unable to connect Nutanix Cluster "{}". Please check ip and port.'.format(ip))
+    # Encoder/decoder of request and response bodies.
+    json_backend = JsonBackend.select(json_backend)
+    self._json_backend = json_backend
 
     # Make session
     session = requests.Session()
@@ -51,54 +73,211 @@ class NutanixRestApiClient:
     session.verify = False                              
     session.headers.update({'Content-Type': 'application/json; charset=utf-8'})
 
-    # Test session
-    is_requests_ok = True
-    url = 'https://{}:9440/PrismGateway/services/rest/v1/cluster'.format(ip)
-    try:
-      resp = session.get(url, timeout=TIMEOUT)
-    except:
-      is_requests_ok = False
-    if not is_requests_ok:
-      raise Exception('Able to access. But unexpected error happens. Please check server status.')
-    if not resp.ok:
-      raise Exception('Able to access. But unable to get cluster info. Please check your credential.')
+    # Connection pool. Share the client among threads with pool_maxsize >= number of threads.
+    # pool_connections : Number of host pools to keep.
+    # pool_maxsize : Max connections kept alive per host.
+    # pool_block : True waits for free connection instead of opening throwaway one.
+    # Retries are done by RetryPolicy. Not by the adapter.
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections,
+      pool_maxsize=pool_maxsize, pool_block=pool_block, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    # auth_mode 'basic' : Send credential on every request. Prism validates it every time.
+    # auth_mode 'session' : Send credential only to login, then ride the session cookie.
+    #   Login again on 401 (session expired). Only one thread logs in at once,
+    #   others wait for it and reuse the new cookie.
+    if auth_mode not in ['basic', 'session']:
+      raise Exception('Unknown auth mode "{}". Use "basic" or "session".'.format(auth_mode))
+    auth_lock = threading.Lock()
+    auth_state = {'auth_mode' : auth_mode, 'generation' : 0,
+      'logins' : 0, 'reauths' : 0, 'reauth_waits' : 0, 'reauth_failures' : 0}
+
+    # Keep the cluster document of the login as the first cluster snapshot.
+    # get_cluster_info() and its family reuse it till it gets older than max age.
+    self._cluster_info_max_age = cluster_info_max_age
+    self._cluster_snapshot = (0, None)
+
+    # Login(Test session)
+    # lazy False : Login here. Raise if the cluster is unreachable or credential is wrong.
+    # lazy True : Nothing is connected here. The first request (or validate()) logs in.
+    url = '{}/PrismGateway/services/rest/v1/cluster'.format(base_url)
+    connect_lock = threading.Lock()
+    connect_state = {'connected' : False}
+
+    def connect():
+      if connect_state['connected']:
+        return
+      with connect_lock:
+        if connect_state['connected']:
+          return
+        try:
+          resp = session.get(url, timeout=TIMEOUT)
+        except (requests.exceptions.ConnectionError, ConnectTimeout):
+          raise Exception('Unable to connect Nutanix Cluster "{}". Please check ip and port.'.format(ip))
+        except Exception:
+          raise Exception('Able to access. But unexpected error happens. Please check server status.')
+        if not resp.ok:
+          raise Exception('Able to access. But unable to get cluster info. Please check your credential.')
+        auth_state['logins'] += 1
+
+        if auth_state['auth_mode'] == 'session':
+          if len(session.cookies) > 0:
+            session.auth = None
+          else:
+            # No session cookie from the server. Stay with basic auth.
+            auth_state['auth_mode'] = 'basic'
+
+        try:
+          self._cluster_snapshot = (time.time(), json_backend.loads(resp.content))
+        except ValueError:
+          pass
+        if warmup_connections > 0:
+          warm_up(warmup_connections)
+        connect_state['connected'] = True
+    self._connect = connect
+
+    def relogin(generation):
+      # generation : Auth generation seen by the request which got 401.
+      # If someone already logged in after that, just use the new cookie.
+      with auth_lock:
+        if auth_state['generation'] != generation:
+          auth_state['reauth_waits'] += 1
+          return
+        try:
+          resp = session.get(url, auth=(username, password), timeout=TIMEOUT)
+          ok = resp.ok
+        except RequestException:
+          ok = False
+        if not ok:
+          auth_state['reauth_failures'] += 1
+          return
+        auth_state['generation'] += 1
+        auth_state['logins'] += 1
+        auth_state['reauths'] += 1
+
+    def auth_stats():
+      with auth_lock:
+        stats = dict(auth_state)
+      del stats['generation']
+      return stats
+    self._auth_stats = auth_stats
+
+    def warm_up(num_connections):
+      # Pre-open keep-alive connections. Best effort, never raises.
+      # Each request holds its connection (body unread) till all of them got
+      # the response, so none of them can reuse another's connection.
+      # Then the bodies are read and the connections go back to the pool.
+      # Failed requests are not retried. Return idle connections in the pool.
+      num_connections = min(num_connections, pool_maxsize)
+      barrier = threading.Barrier(num_connections)
+      def open_connection():
+        response = None
+        try:
+          response = session.get(url, timeout=TIMEOUT, stream=True)
+          barrier.wait(timeout_connection + timeout_read)
+        except (RequestException, threading.BrokenBarrierError):
+          # Let the others stop waiting. Their connections are still kept.
+          barrier.abort()
+        if response is None:
+          return
+        try:
+          response.content
+        except RequestException:
+          response.close()
+      workers = []
+      for i in range(num_connections):
+        worker = threading.Thread(target=open_connection)
+        worker.start()
+        workers.append(worker)
+      for worker in workers:
+        worker.join()
+
+      num_idle = pool_stats()['connections_idle']
+      if logger is not None and num_idle < num_connections:
+        logger.warning('Warm up opened %d of %d connections.', num_idle, num_connections)
+      return num_idle
+    self._warm_up = warm_up
+
+    def pool_stats():
+      pools = adapter.poolmanager.pools
+      stats = {
+        'pool_maxsize' : pool_maxsize,
+        'pool_block' : pool_block,
+        'num_pools' : 0,
+        'requests' : 0,
+        'connections_created' : 0,
+        'connections_reused' : 0,
+        'connections_idle' : 0,
+      }
+      for key in list(pools.keys()):
+        pool = pools.get(key)
+        if pool is None:
+          continue
+        stats['num_pools'] += 1
+        stats['requests'] += pool.num_requests
+        stats['connections_created'] += pool.num_connections
+        if pool.pool is not None:
+          stats['connections_idle'] += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+      stats['connections_reused'] = max(0, stats['requests'] - stats['connections_created'])
+      return stats
+    self._pool_stats = pool_stats
 
 
     ###
     ### Debug utility for CRUD functions
     ###
 
-    def logging_rest(response):
-      if logger is None:
+    # log_format 'full' : Request and response with headers(DEBUG) and bodies.
+    # log_format 'compact' : One line per request. Method, URL, status, latency, bytes.
+    # log_body_limit : Bodies bigger than it(bytes) are truncated. 0 skips bodies.
+    # Nothing is formatted unless the logger really emits INFO.
+    if log_format not in ['full', 'compact']:
+      raise Exception('Unknown log format "{}". Use "full" or "compact".'.format(log_format))
+
+    def logging_rest(response, request_obj, response_obj, latency):
+      if logger is None or not logger.isEnabledFor(logging.INFO):
         return
-      logger.info('======== {} ========'.format(datetime.datetime.now()))
+      request = response.request
+      request_body = request.body or ''
+      response_body = response.content or b''
+
+      if log_format == 'compact':
+        logger.info('%s %s %s %.1fms out=%dB in=%dB', request.method, request.url,
+          response.status_code, latency * 1000, len(request_body), len(response_body))
+        return
+
+      is_debug = logger.isEnabledFor(logging.DEBUG)
+      logger.info('======== %s ========', datetime.datetime.now())
       logger.info('\n * Request * \n')
-      logger.info('{} {}'.format(response.request.method, response.request.url))
-      for (key, value) in response.request.headers.items():
-        logger.debug('{}: {}'.format(key, value))
-      logger.debug('')
-      if response.request.body:
-        try:
-          indented_json = json.dumps(json.loads(response.request.body), indent=2)
-          logger.info(indented_json)
-        except:
-          logger.info(response.request.body)
+      logger.info('%s %s', request.method, request.url)
+      if is_debug:
+        for (key, value) in request.headers.items():
+          logger.debug('%s: %s', key, value)
+        logger.debug('')
+      if request_body and log_body_limit != 0:
+        logger.info('%s', _LazyRestBody(request_body, request_obj, log_body_limit))
       logger.info('')
 
       logger.info('\n * Response * \n')
-      logger.info('{}'.format(response.status_code))
-      for (key, value) in response.headers.items():
-        logger.debug('{}: {}'.format(key, value))
-      logger.debug('')
-      if response.text:
-        try:
-          indented_json = json.dumps(json.loads(response.text), indent=2)
-          logger.info(indented_json)
-        except:
-          logger.info(response.request.text)
+      logger.info('%s (%.1fms)', response.status_code, latency * 1000)
+      if is_debug:
+        for (key, value) in response.headers.items():
+          logger.debug('%s: %s', key, value)
+        logger.debug('')
+      if response_body and log_body_limit != 0:
+        logger.info('%s', _LazyRestBody(response_body, response_obj, log_body_limit))
       logger.info('\n\n')
 
 
+    def logging_stream(response, latency, size_in, num_entities):
+      # Streamed body isn't kept. One line in any log format.
+      if logger is None or not logger.isEnabledFor(logging.INFO):
+        return
+      request = response.request
+      logger.info('%s %s %s %.1fms in=%dB entities=%d (streamed)', request.method, request.url,
+        response.status_code, latency * 1000, size_in, num_entities)
+
     def logging_error(error_dict):
       if logger is None:
         return
@@ -114,185 +293,227 @@ class NutanixRestApiClient:
     ### To avoid being modifyied session and ip etc from outside.
     ###
 
-    # API v0.8
+    # Retry state is per client. Every REST call below goes through it.
+    if retry_policy is None:
+      retry_policy = RetryPolicy()
+    self._retry_policy = retry_policy
 
-    def get_v08(url, error_dict):
+    def logging_retry(method, url, attempt, delay, reason):
+      if logger is None:
+        return
+      logger.warning('======== {} ========'.format(datetime.datetime.now()))
+      logger.warning('Retry {} {} (attempt {} failed with "{}"). Wait {:.2f}s.'.format(
+        method, url, attempt, reason, delay))
+      logger.warning('\n\n')
+
+    # Request count, errors, retries, bytes and latency per endpoint.
+    # Pass a RequestMetrics to share it among clients.
+    if metrics is None:
+      metrics = RequestMetrics()
+    self._metrics = metrics
+    self._metrics_labels = {'cluster' : ip}
+
+    # Lifecycle hooks. {event : function or list of functions}. See add_hook().
+    request_hooks = _RequestHooks(logger)
+    for (event, functions) in (hooks or {}).items():
+      for function in (functions if isinstance(functions, (list, tuple)) else [functions]):
+        request_hooks.add(event, function)
+    self._request_hooks = request_hooks
+
+    def observe(hook, version, method, url, status, latency, size_out, size_in, error=None):
+      # End of a request. Metrics, then after_response (or on_error if no response).
+      metrics.observe(version, method, url, status, latency, size_out, size_in)
+      if hook is not None:
+        hook['status'] = status
+        hook['latency'] = latency
+        hook['size_in'] = size_in
+        if error is None:
+          request_hooks.emit('after_response', hook)
+        else:
+          hook['error'] = error
+          request_hooks.emit('on_error', hook)
+
+    def execute(method, version, url, data, stream=False):
+      # Return (response, full url, latency, hook). Login, re-login on 401 and retries are done here.
+      # stream : Return when headers arrive. Body is read by the caller.
+      # Failures without response are observed here. Others by the caller with response size.
+      # hook : Dict passed to hooks. None if no hook is registered.
+      full_url = '{}/api/nutanix/{}{}'.format(base_url, version, url)
+      connect()
+      hook = None
+      if request_hooks.enabled:
+        hook = {'method' : method, 'version' : version, 'endpoint' : url, 'url' : full_url,
+          'size_out' : len(data or ''), 'start' : time.time()}
+        request_hooks.emit('before_request', hook)
+      def request():
+        generation = auth_state['generation']
+        response = session.request(method, full_url, data=data, timeout=TIMEOUT, stream=stream)
+        if response.status_code == 401 and auth_state['auth_mode'] == 'session':
+          response.close()
+          relogin(generation)
+          response = session.request(method, full_url, data=data, timeout=TIMEOUT, stream=stream)
+        return response
+      def on_retry(attempt, delay, reason):
+        metrics.observe_retry(version, method, url)
+        logging_retry(method, full_url, attempt, delay, reason)
+        if hook is not None:
+          hook['attempt'] = attempt
+          hook['delay'] = delay
+          hook['reason'] = reason
+          request_hooks.emit('on_retry', hook)
+      start = time.perf_counter()
+      try:
+        response = retry_policy.execute(method, request, on_retry)
+      except Exception as exception:
+        observe(hook, version, method, url, None, time.perf_counter() - start, len(data or ''), 0, exception)
+        raise
+      return (response, full_url, time.perf_counter() - start, hook)
+
+    def raise_for_status(response, error_dict):
+      error_dict['method'] = response.request.method
+      error_dict['url'] = response.request.url
+      error_dict['code'] = response.status_code
+      error_dict['text'] = response.text
+      raise IntendedException('Receive unexpected response code "{}".'.format(response.status_code))
+
+    # coalesce_gets : Opt-in. Identical GETs sent at the same time from some threads
+    #   go to the server only once. Others wait for it and get their own copy of
+    #   the decoded response (or the same error).
+    #   A thread never joins a GET which started before its last write ended,
+    #   so that it always sees what it wrote.
+    single_flight = _SingleFlight()
+    self._single_flight = single_flight
+    last_write = threading.local()
+
+    def send(method, version, url, body_dict, error_dict, allow_empty=False):
+      if not coalesce_gets:
+        return send_once(method, version, url, body_dict, error_dict, allow_empty)
+      if method != 'GET':
+        try:
+          return send_once(method, version, url, body_dict, error_dict, allow_empty)
+        finally:
+          last_write.sequence = single_flight.fence()
+      def get(flight_error_dict):
+        return send_once(method, version, url, None, flight_error_dict, allow_empty)
+      return single_flight.do((version, url, allow_empty), get, error_dict,
+        getattr(last_write, 'sequence', 0))
+
+    def send_once(method, version, url, body_dict, error_dict, allow_empty=False):
+      # Return decoded response body. Decoded once and shared with logging.
+      # allow_empty : return {} instead of raising if body isn't json. (DELETE)
       if not url.startswith('/'): url = '/' + url
-      attempts = 0
-      while attempts < 3:
+      data = None if body_dict is None else json_backend.dumps(body_dict)
+      (response, full_url, latency, hook) = execute(method, version, url, data)
+      observe(hook, version, method, url, response.status_code, latency, len(data or ''), len(response.content))
+
+      response_obj = None
+      decode_error = None
+      if response.ok:
         try:
-          response = session.get('https://{}:9440/api/nutanix/v0.8{}'.format(ip, url), timeout=TIMEOUT)
-          break
-        except RequestException as e:
-          logger.error(e)
-          logger.error('retly')
-          attempts += 1
-      logging_rest(response)
+          response_obj = json_backend.loads(response.content)
+        except ValueError as e:
+          decode_error = e
+      logging_rest(response, body_dict, response_obj, latency)
+
       if not response.ok:
-        error_dict['method'] = response.request.method
-        error_dict['url'] = response.request.url
-        error_dict['code'] = response.status_code
-        error_dict['text'] = response.text
-        raise IntendedException('Receive unexpected response code "{}".'.format(response.status_code))
-      return response.json()
+        raise_for_status(response, error_dict)
+      if decode_error is not None:
+        if not allow_empty:
+          raise decode_error
+        response_obj = {}
+      return response_obj
+
+    def stream(version, url, error_dict, document=None, fields=None):
+      # Generator of the elements of "entities" in the response of GET url.
+      # Decoded one by one while reading the body. Whole body is never in memory.
+      # document : Filled with other top level fields(metadata etc.) at the end.
+      # fields : Keep only these keys of each entity.
+      if not url.startswith('/'): url = '/' + url
+      (response, full_url, latency, hook) = execute('GET', version, url, None, stream=True)
+      size_in = 0
+      try:
+        if not response.ok:
+          size_in = len(response.content)
+          logging_rest(response, None, None, latency)
+          raise_for_status(response, error_dict)
+        parser = _JsonEntityStream(fields)
+        for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+          size_in += len(chunk)
+          yield from parser.feed(chunk)
+        parser.close()
+        logging_stream(response, latency, size_in, parser.num_entities)
+        if document is not None:
+          document.update(parser.document)
+      finally:
+        observe(hook, version, 'GET', url, response.status_code, latency, 0, size_in)
+        response.close()
+
+    # API v0.8
+
+    def get_v08(url, error_dict):
+      return send('GET', 'v0.8', url, None, error_dict)
     self._get_v08 = get_v08
 
+    def stream_v08(url, error_dict, document=None, fields=None):
+      return stream('v0.8', url, error_dict, document, fields)
+    self._stream_v08 = stream_v08
+
     def post_v08(url, body_dict, error_dict):
-      if not url.startswith('/'): url = '/' + url
-      response = session.post('https://{}:9440/api/nutanix/v0.8{}'.format(ip, url), data=json.dumps(body_dict, indent=2), timeout=TIMEOUT)
-      logging_rest(response)
-      if not response.ok:
-        error_dict['method'] = response.request.method
-        error_dict['url'] = response.request.url
-        error_dict['code'] = response.status_code
-        error_dict['text'] = response.text
-        raise IntendedException('Receive unexpected response code "{}".'.format(response.status_code))
-      return response.json()
+      return send('POST', 'v0.8', url, body_dict, error_dict)
     self._post_v08 = post_v08
 
     def put_v08(url, body_dict, error_dict):
-      if not url.startswith('/'): url = '/' + url
-      response = session.put('https://{}:9440/api/nutanix/v0.8{}'.format(ip, url), data=json.dumps(body_dict, indent=2), timeout=TIMEOUT)
-      logging_rest(response)
-      if not response.ok:
-        error_dict['method'] = response.request.method
-        error_dict['url'] = response.request.url
-        error_dict['code'] = response.status_code
-        error_dict['text'] = response.text
-        raise IntendedException('Receive unexpected response code "{}".'.format(response.status_code))
-      return response.json()
+      return send('PUT', 'v0.8', url, body_dict, error_dict)
     self._put_v08 = put_v08
 
     def delete_v08(url, error_dict):
-      if not url.startswith('/'): url = '/' + url
-      response = session.delete('https://{}:9440/api/nutanix/v0.8{}'.format(ip, url), timeout=TIMEOUT)
-      logging_rest(response)
-      if not response.ok:
-        error_dict['method'] = response.request.method
-        error_dict['url'] = response.request.url
-        error_dict['code'] = response.status_code
-        error_dict['text'] = response.text
-        raise IntendedException('Receive unexpected response code "{}".'.format(response.status_code))
-      try:
-        return response.json()
-      except:
-        return {}
+      return send('DELETE', 'v0.8', url, None, error_dict, allow_empty=True)
     self._delete_v08 = delete_v08
 
 
     # API v1
 
     def get_v1(url, error_dict):
-      if not url.startswith('/'): url = '/' + url
-      response = session.get('https://{}:9440/api/nutanix/v1{}'.format(ip, url), timeout=TIMEOUT)
-      logging_rest(response)
-      if not response.ok:
-        error_dict['method'] = response.request.method
-        error_dict['url'] = response.request.url
-        error_dict['code'] = response.status_code
-        error_dict['text'] = response.text
-        raise IntendedException('Receive unexpected response code "{}".'.format(response.status_code))
-      return response.json()
+      return send('GET', 'v1', url, None, error_dict)
     self._get_v1 = get_v1
 
+    def stream_v1(url, error_dict, document=None, fields=None):
+      return stream('v1', url, error_dict, document, fields)
+    self._stream_v1 = stream_v1
+
     def post_v1(url, body_dict, error_dict):
-      if not url.startswith('/'): url = '/' + url
-      response = session.post('https://{}:9440/api/nutanix/v1{}'.format(ip, url), data=json.dumps(body_dict, indent=2), timeout=TIMEOUT)
-      logging_rest(response)
-      if not response.ok:
-        error_dict['method'] = response.request.method
-        error_dict['url'] = response.request.url
-        error_dict['code'] = response.status_code
-        error_dict['text'] = response.text
-        raise IntendedException('Receive unexpected response code "{}".'.format(response.status_code))
-      return response.json()
+      return send('POST', 'v1', url, body_dict, error_dict)
     self._post_v1 = post_v1
 
     def put_v1(url, body_dict, error_dict):
-      if not url.startswith('/'): url = '/' + url
-      response = session.put('https://{}:9440/api/nutanix/v1{}'.format(ip, url), data=json.dumps(body_dict, indent=2), timeout=TIMEOUT)
-      logging_rest(response)
-      if not response.ok:
-        error_dict['method'] = response.request.method
-        error_dict['url'] = response.request.url
-        error_dict['code'] = response.status_code
-        error_dict['text'] = response.text
-        raise IntendedException('Receive unexpected response code "{}".'.format(response.status_code))
-      return response.json()
+      return send('PUT', 'v1', url, body_dict, error_dict)
     self._put_v1 = put_v1
 
     def delete_v1(url, error_dict):
-      if not url.startswith('/'): url = '/' + url
-      response = session.delete('https://{}:9440/api/nutanix/v1{}'.format(ip, url), timeout=TIMEOUT)
-      logging_rest(response)
-      if not response.ok:
-        error_dict['method'] = response.request.method
-        error_dict['url'] = response.request.url
-        error_dict['code'] = response.status_code
-        error_dict['text'] = response.text
-        raise IntendedException('Receive unexpected response code "{}".'.format(response.status_code))
-      try:
-        return response.json()
-      except:
-        return {}
+      return send('DELETE', 'v1', url, None, error_dict, allow_empty=True)
     self._delete_v1 = delete_v1
 
 
     # API v2
 
     def get_v2(url, error_dict):
-      if not url.startswith('/'): url = '/' + url
-      response = session.get('https://{}:9440/api/nutanix/v2.0{}'.format(ip, url), timeout=TIMEOUT)
-      logging_rest(response)
-      if not response.ok:
-        error_dict['method'] = response.request.method
-        error_dict['url'] = response.request.url
-        error_dict['code'] = response.status_code
-        error_dict['text'] = response.text
-        raise IntendedException('Receive unexpected response code "{}".'.format(response.status_code))
-      return response.json()
+      return send('GET', 'v2.0', url, None, error_dict)
     self._get_v2 = get_v2
 
+    def stream_v2(url, error_dict, document=None, fields=None):
+      return stream('v2.0', url, error_dict, document, fields)
+    self._stream_v2 = stream_v2
+
     def post_v2(url, body_dict, error_dict):
-      if not url.startswith('/'): url = '/' + url
-      response = session.post('https://{}:9440/api/nutanix/v2.0{}'.format(ip, url), data=json.dumps(body_dict, indent=2), timeout=TIMEOUT)
-      logging_rest(response)
-      if not response.ok:
-        error_dict['method'] = response.request.method
-        error_dict['url'] = response.request.url
-        error_dict['code'] = response.status_code
-        error_dict['text'] = response.text
-        raise IntendedException('Receive unexpected response code "{}".'.format(response.status_code))
-      return response.json()
+      return send('POST', 'v2.0', url, body_dict, error_dict)
     self._post_v2 = post_v2
 
     def put_v2(url, body_dict, error_dict):
-      if not url.startswith('/'): url = '/' + url
-      response = session.put('https://{}:9440/api/nutanix/v2.0{}'.format(ip, url), data=json.dumps(body_dict, indent=2), timeout=TIMEOUT)
-      logging_rest(response)
-      if not response.ok:
-        error_dict['method'] = response.request.method
-        error_dict['url'] = response.request.url
-        error_dict['code'] = response.status_code
-        error_dict['text'] = response.text
-        raise IntendedException('Receive unexpected response code "{}".'.format(response.status_code))
-      return response.json()
+      return send('PUT', 'v2.0', url, body_dict, error_dict)
     self._put_v2 = put_v2
 
     def delete_v2(url, error_dict):
-      if not url.startswith('/'): url = '/' + url
-      response = session.delete('https://{}:9440/api/nutanix/v2.0{}'.format(ip, url), timeout=TIMEOUT)
-      logging_rest(response)
-      if not response.ok:
-        error_dict['method'] = response.request.method
-        error_dict['url'] = response.request.url
-        error_dict['code'] = response.status_code
-        error_dict['text'] = response.text
-        raise IntendedException('Receive unexpected response code "{}".'.format(response.status_code))
-      try:
-        return response.json()
-      except:
-        return {}
+      return send('DELETE', 'v2.0', url, None, error_dict, allow_empty=True)
     self._delete_v2 = delete_v2
 
 
@@ -306,65 +527,390 @@ class NutanixRestApiClient:
     self._handle_error = handle_error
 
 
+    # Name/UUID index of images, networks, vms and containers.
+    # Shared by the functions which need to resolve name to uuid.
+    self._entity_index = _EntityIndex(entity_cache_ttl)
+
+    # lookup_mode 'filter' : Single entity lookups use server side filter or
+    #   uuid addressed GET if the API has it. Fall back to the list if not.
+    # lookup_mode 'list' : Always download the whole list and index it.
+    if lookup_mode not in ['filter', 'list']:
+      raise Exception('Unknown lookup mode "{}". Use "filter" or "list".'.format(lookup_mode))
+    self._lookup_mode = lookup_mode
+    self._lookup_unsupported = set()
+
+    if not lazy:
+      connect()
+
+
   ###
-  ### Cluster Operation
+  ### Connection
+  ###
+
+  def validate(self):
+    # Login now if not yet. Raise the same exceptions as non-lazy constructor.
+    # For lazy clients which want to fail fast.
+    self._connect()
+
+
+  ###
+  ### Connection Pool
+  ###
+
+  def get_pool_stats(self):
+    # connections_created : TCP/TLS connections opened so far.
+    # connections_reused : Requests which used a kept-alive connection.
+    return self._pool_stats()
+
+  def warm_up(self, num_connections):
+    # Best effort. Capped by pool_maxsize, unreachable cluster is not an error.
+    # Return the number of idle connections in the pool after warming up.
+    return self._warm_up(num_connections)
+
+
+  ###
+  ### Authentication
+  ###
+
+  def get_auth_stats(self):
+    # logins : Times the credential was validated by login. Includes the first one.
+    # reauths : Logins again because the session expired.
+    # reauth_waits : Requests which got 401 and reused the login done by another thread.
+    return self._auth_stats()
+
+
+  ###
+  ### Request Coalescing
+  ###
+
+  def get_coalesce_stats(self):
+    # gets : GETs asked by callers. sent : GETs sent to the server.
+    # saved : GETs which waited for identical one in flight instead of sending.
+    return self._single_flight.stats()
+
+
+  ###
+  ### Metrics
   ###
 
-  def get_cluster_info(self):
+  def metrics(self):
+    # {"GET v2.0 /vms/{uuid}" : {count, errors, retries, bytes_in, bytes_out, latency p50/p95/p99 etc.}}
+    # uuids and numbers in the url are replaced with {uuid} and {id}. Queries are dropped.
+    return self._metrics.snapshot()
+
+  def metrics_prometheus(self, prefix='nutanix_rest'):
+    # Same metrics in Prometheus text format. Labeled with cluster ip.
+    return self._metrics.to_prometheus(prefix, self._metrics_labels)
+
+
+  ###
+  ### Hooks
+  ###
+
+  def add_hook(self, event, function):
+    # function(info) is called on event of every REST request.
+    #   before_request : info has method, version, endpoint, url, size_out, start(epoch seconds)
+    #   on_retry : + attempt, delay, reason. Called before each retry wait.
+    #   after_response : + status, latency(seconds), size_in. Any status code.
+    #   on_error : + status(None), latency, size_in, error(exception). No response at all.
+    # Same dict is passed to all events of one request. Hooks may keep their own
+    # keys there (span etc.). Exceptions in hooks are logged and ignored.
+    self._request_hooks.add(event, function)
+
+  def remove_hook(self, event, function):
+    self._request_hooks.remove(event, function)
+
+  def get_hook_stats(self):
+    # Number of hooks per event and number of exceptions raised by hooks.
+    return self._request_hooks.stats()
+
+
+  ###
+  ### Retry
+  ###
+
+  def get_retry_stats(self):
+    return self._retry_policy.stats()
+
+
+  ###
+  ### Entity Index
+  ###
+
+  # Entity kind : (API getter name, url, uuid key)
+  # VMs are indexed with disk and nic config since get_vm_info etc. need them.
+  _ENTITY_SOURCES = {
+    'image' : ('_get_v2', '/images/', 'uuid'),
+    'network' : ('_get_v2', '/networks/', 'uuid'),
+    'vm' : ('_get_v2', '/vms/?include_vm_disk_config=true&include_vm_nic_config=true', 'uuid'),
+    'container' : ('_get_v1', '/containers/', 'containerUuid'),
+  }
+
+  # Entity kind : (API getter name, url filtered by name, url of uuid)
+  # None if the API has no such endpoint. Name filters may match more than the
+  # name (substring or regex) or be ignored by old versions. Results are
+  # checked by exact name anyway.
+  _ENTITY_LOOKUPS = {
+    'image' : ('_get_v2', None, '/images/{}'),
+    'network' : ('_get_v2', None, '/networks/{}'),
+    'vm' : ('_get_v2', '/vms/?include_vm_disk_config=true&include_vm_nic_config=true&filter=vm_name=={}',
+      '/vms/{}?include_vm_disk_config=true&include_vm_nic_config=true'),
+    'container' : ('_get_v1', '/containers/?searchString={}', '/containers/{}'),
+  }
+
+  # Response codes which mean the lookup endpoint (or parameter) isn't supported.
+  # 404 of uuid addressed GET usually means "no such entity". So not included for it.
+  _LOOKUP_UNSUPPORTED_CODES = (400, 404, 405, 501)
+
+  # Names which can't be put in a filter safely.
+  _LOOKUP_UNSAFE_CHARS = set(',;()[]{}*+?^$|\\=<>!~"\'')
+
+  def get_entity_cache_stats(self):
+    return self._entity_index.stats()
+
+  def clear_entity_cache(self, kind=None):
+    self._entity_index.invalidate(kind)
+
+  def _load_entities(self, kind, error_dict):
+    (getter_name, url, uuid_key) = self._ENTITY_SOURCES[kind]
+    response_dict = getattr(self, getter_name)(url, error_dict)
+    return self._entity_index.load(kind, response_dict['entities'], uuid_key)
+
+  def _get_entities(self, kind, force_refresh, error_dict):
+    # All entities of the kind. From the index if it is fresh.
+    if not force_refresh:
+      (found, entities) = self._entity_index.entities(kind)
+      if found:
+        return entities
+    return self._load_entities(kind, error_dict)
+
+  def _find_entity(self, kind, name='', uuid='', error_dict=None):
+    # Return the raw entity dict which has the name (or uuid). None if not found.
+    # Dictionary lookup while the index is fresh. Otherwise ask the server for
+    # the entity alone (lookup_mode 'filter'). Download the list only when the
+    # API can't answer it alone, or lookup_mode is 'list'.
+    if error_dict is None:
+      error_dict = {}
+    (found, entity) = self._entity_index.find(kind, name, uuid)
+    if found:
+      return entity
+    if self._lookup_mode == 'filter':
+      (done, entity) = self._lookup_entity(kind, name, uuid, error_dict)
+      if done:
+        return entity
+      self._entity_index.count_lookup(fallback=True)
+    self._load_entities(kind, error_dict)
+    (found, entity) = self._entity_index.find(kind, name, uuid, count=False, check_ttl=False)
+    return entity
+
+  def _lookup_entity(self, kind, name, uuid, error_dict):
+    # Ask the server for the entity only. Return (done, entity).
+    # done is False if the list is needed. (No endpoint, old API or ambiguous 404)
+    (getter_name, name_url, uuid_url) = self._ENTITY_LOOKUPS[kind]
+    (_, _, uuid_key) = self._ENTITY_SOURCES[kind]
+    by_name = name != ''
+    url = name_url if by_name else uuid_url
+    if url is None or (kind, by_name) in self._lookup_unsupported:
+      return (False, None)
+    key = name if by_name else uuid
+    if set(key) & self._LOOKUP_UNSAFE_CHARS:
+      return (False, None)
+
+    # Errors of the lookup are not errors of the caller. Keep them out of error_dict.
+    lookup_error_dict = {}
+    try:
+      response_dict = getattr(self, getter_name)(url.format(urllib.parse.quote(key, safe='')), lookup_error_dict)
+    except IntendedException:
+      code = lookup_error_dict.get('code')
+      if code in self._LOOKUP_UNSUPPORTED_CODES and (by_name or code != 404):
+        self._lookup_unsupported.add((kind, by_name))
+      return (False, None)
+    self._entity_index.count_lookup()
+
+    if not by_name:
+      if response_dict.get(uuid_key) != uuid:
+        return (False, None)
+      self._entity_index.put(kind, response_dict, uuid_key)
+      return (True, response_dict)
+    entities = response_dict.get('entities', [])
+    metadata = response_dict.get('metadata', {})
+    is_ignored = (metadata.get('total_entities') == metadata.get('grand_total_entities')
+      and any(name not in entity['name'] for entity in entities))
+    if is_ignored:
+      # Old API returned the whole list. Index it and don't send the filter again.
+      self._lookup_unsupported.add((kind, by_name))
+      self._entity_index.load(kind, entities, uuid_key)
+      (found, entity) = self._entity_index.find(kind, name, count=False, check_ttl=False)
+      return (True, entity)
+    for entity in entities:
+      if entity['name'] == name:
+        self._entity_index.put(kind, entity, uuid_key)
+        return (True, entity)
+    return (True, None)
+
+
+  ###
+  ### Iteration
+  ###
+
+  # Entity kind : (API getter name, API stream name, url, paging style)
+  # paging 'offset' : v2 API. "offset" and "length".
+  # paging 'page' : v0.8 and v1 API. "page"(from 1) and "count".
+  _ITER_SOURCES = {
+    'vm' : ('_get_v2', '_stream_v2', '/vms/', 'offset'),
+    'image' : ('_get_v2', '_stream_v2', '/images/', 'offset'),
+    'network' : ('_get_v2', '_stream_v2', '/networks/', 'offset'),
+    'task' : ('_get_v08', '_stream_v08', '/tasks/', 'page'),
+  }
+
+  # Iterators below yield raw entity dicts one by one, downloading page_size
+  # entities per request. (page_size None : all at once) Only the current page
+  # (and the prefetched next page if prefetch is True) is kept in memory.
+  # stream : Decode entities one by one while reading the body. Only one
+  #   entity is kept in memory. Can't be used with prefetch.
+  # fields : Keep only these keys of each entity.
+  # Unlike other methods, they raise the exception on failure after logging it.
+
+  def iter_vms(self, page_size=100, prefetch=False, include_config=False, stream=False, fields=None):
+    query = 'include_vm_disk_config=true&include_vm_nic_config=true' if include_config else ''
+    return self._iter_entities('vm', page_size, prefetch, stream, fields, query)
+
+  def iter_images(self, page_size=100, prefetch=False, stream=False, fields=None):
+    return self._iter_entities('image', page_size, prefetch, stream, fields)
+
+  def iter_networks(self, page_size=100, prefetch=False, stream=False, fields=None):
+    return self._iter_entities('network', page_size, prefetch, stream, fields)
+
+  def iter_tasks(self, page_size=100, prefetch=False, include_completed=True, stream=False, fields=None):
+    query = '' if include_completed else 'includeCompleted=false'
+    return self._iter_entities('task', page_size, prefetch, stream, fields, query)
+
+  def _iter_entities(self, kind, page_size, prefetch, stream, fields, query=''):
     error_dict = {}
     try:
-      response_dict = self._get_v1('/cluster/', error_dict)
-      return_dict = {
-        # Basic
-        'uuid' : response_dict['uuid'],
-        'name' : response_dict['name'],
-        'timezone' : response_dict['timezone'],
-        'is_lts' : response_dict['isLTS'],
-        'version' : response_dict['version'],
-        'version_ncc' : response_dict['nccVersion'],
-
-        # RF
-        'current_redundancy_factor' : response_dict['clusterRedundancyState']['currentRedundancyFactor'],
-        'desired_redundancy_factor' : response_dict['clusterRedundancyState']['desiredRedundancyFactor'],
-
-        # Network
-        'ip_external' : response_dict['clusterExternalIPAddress'],
-        'ip_iscsi' : response_dict['clusterExternalDataServicesIPAddress'],
-        'network_external' : response_dict['externalSubnet'],
-        'network_internal' : response_dict['internalSubnet'],
-        'nfs_whitelists' : response_dict['globalNfsWhiteList'],
-
-        # Node and Block
-        'num_nodes' : response_dict['numNodes'],
-        'block_serials' : response_dict['blockSerials'],
-        'num_blocks' : len(response_dict['blockSerials']),
-
-        # Servers
-        'name_servers' : response_dict['nameServers'],
-        'ntp_servers' : response_dict['ntpServers'],
-        'smtp_server' : '' if response_dict['smtpServer'] is None else response_dict['smtpServer'],
-
-        # Storage
-        'storage_type' : response_dict['storageType'],
-      }
+      if stream:
+        if prefetch:
+          raise IntendedException('Error. prefetch can not be used with stream.')
+        yield from self._iter_streamed(kind, page_size, fields, query, error_dict)
+        return
+      for page in self._iter_pages(kind, page_size, prefetch, query, error_dict):
+        if fields is None:
+          yield from page
+        else:
+          for entity in page:
+            yield {field:entity[field] for field in fields if field in entity}
+    except Exception as exception:
+      self._handle_error(exception, error_dict)
+      raise
 
-      hypervisors = response_dict['hypervisorTypes']
-      if len(hypervisors) == 1:
-        return_dict['hypervisor'] = hypervisors[0]
-        if return_dict['hypervisor'] == 'kKvm':
-          return_dict['hypervisor'] = 'AHV'
-      else:
-        # needs update here
-        return_dict['hypervisor'] = 'unknown'
+  @staticmethod
+  def _page_url(url, paging, page, page_size, query):
+    params = ''
+    if page_size is not None and paging == 'offset':
+      params = 'offset={}&length={}'.format(page * page_size, page_size)
+    elif page_size is not None:
+      params = 'page={}&count={}'.format(page + 1, page_size)
+    query = '&'.join(param for param in [query, params] if param)
+    return '{}?{}'.format(url, query) if query else url
+
+  @staticmethod
+  def _is_last_page(num_entities, num_yielded, total, page_size):
+    # Short page, total count in metadata reached, or paging ignored by old API.
+    return (page_size is None or num_entities != page_size
+      or (total is not None and num_yielded + num_entities >= total))
+
+  @staticmethod
+  def _get_total(metadata):
+    return metadata.get('total_entities', metadata.get('totalEntities'))
+
+  def _iter_pages(self, kind, page_size, prefetch, query, error_dict):
+    # Yield list of entities per page. Also stop when the same page comes
+    # again, as old API returns everything for any page.
+    (getter_name, _, url, paging) = self._ITER_SOURCES[kind]
+    getter = getattr(self, getter_name)
+
+    def get_page(page):
+      response_dict = getter(self._page_url(url, paging, page, page_size, query), error_dict)
+      return (response_dict.get('entities', []), self._get_total(response_dict.get('metadata', {})))
+
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    try:
+      page = 0
+      num_yielded = 0
+      first_entity = None
+      (entities, total) = get_page(page)
+      while len(entities) > 0:
+        if entities[0] == first_entity:
+          return
+        first_entity = entities[0]
+        is_last = self._is_last_page(len(entities), num_yielded, total, page_size)
+
+        future = None
+        if not is_last and executor is not None:
+          future = executor.submit(get_page, page + 1)
+        yield entities
+        if is_last:
+          return
+        num_yielded += len(entities)
+        page += 1
+        entities = None
+        (entities, total) = future.result() if future is not None else get_page(page)
+    finally:
+      if executor is not None:
+        executor.shutdown(wait=False)
+
+  def _iter_streamed(self, kind, page_size, fields, query, error_dict):
+    # Same as _iter_pages but yield entities decoded one by one.
+    (_, stream_name, url, paging) = self._ITER_SOURCES[kind]
+    stream = getattr(self, stream_name)
+    page = 0
+    num_yielded = 0
+    first_entity = None
+    while True:
+      document = {}
+      num_entities = 0
+      for entity in stream(self._page_url(url, paging, page, page_size, query), error_dict, document, fields):
+        if num_entities == 0:
+          if entity == first_entity:
+            return
+          first_entity = entity
+        num_entities += 1
+        yield entity
+      total = self._get_total(document.get('metadata') or {})
+      if num_entities == 0 or self._is_last_page(num_entities, num_yielded, total, page_size):
+        return
+      num_yielded += num_entities
+      page += 1
+
+
+  ###
+  ### Cluster Operation
+  ###
 
+  def get_cluster_info(self, force_refresh=False):
+    error_dict = {}
+    try:
+      response_dict = self._get_cluster_snapshot(force_refresh, error_dict)
+      return_dict = self._make_cluster_info(response_dict)
       return (True, return_dict)
 
     except Exception as exception:
       self._handle_error(exception, error_dict)
       return (False, error_dict)
 
-  def get_cluster_name(self):
-    (success, dict) = self.get_cluster_info()
+  def _get_cluster_snapshot(self, force_refresh, error_dict):
+    # Download /cluster/ only when the snapshot is too old or refresh is forced.
+    # Lazy client logs in first. Its cluster document becomes the snapshot.
+    self._connect()
+    (loaded_time, response_dict) = self._cluster_snapshot
+    is_old = time.time() - loaded_time >= self._cluster_info_max_age
+    if force_refresh or response_dict is None or is_old:
+      response_dict = self._get_v1('/cluster/', error_dict)
+      self._cluster_snapshot = (time.time(), response_dict)
+    return response_dict
+
+  def get_cluster_name(self, force_refresh=False):
+    (success, dict) = self.get_cluster_info(force_refresh)
     if success:
       return (success, dict['name'])
     return (success, dict)
@@ -372,50 +918,50 @@ class NutanixRestApiClient:
   def change_cluster_name(self):
     return {'error':'Error: Not supported now'}
 
-  def get_hypervisor(self):
-    (success, dict) = self.get_cluster_info()
+  def get_hypervisor(self, force_refresh=False):
+    (success, dict) = self.get_cluster_info(force_refresh)
     if success:
       return (success, dict['hypervisor'])
     return (success, dict)
 
-  def get_version(self):
-    (success, dict) = self.get_cluster_info()
+  def get_version(self, force_refresh=False):
+    (success, dict) = self.get_cluster_info(force_refresh)
     if success:
       return (success, dict['version'])
     return (success, dict)
 
-  def get_name_servers(self):
-    (success, dict) = self.get_cluster_info()
+  def get_name_servers(self, force_refresh=False):
+    (success, dict) = self.get_cluster_info(force_refresh)
     if success:
       return (success, dict['name_servers'])
     return (success, dict)
 
-  def get_ntp_servers(self):
-    (success, dict) = self.get_cluster_info()
+  def get_ntp_servers(self, force_refresh=False):
+    (success, dict) = self.get_cluster_info(force_refresh)
     if success:
       return (success, dict['ntp_servers'])
     return (success, dict)
 
-  def get_block_serials(self):
-    (success, dict) = self.get_cluster_info()
+  def get_block_serials(self, force_refresh=False):
+    (success, dict) = self.get_cluster_info(force_refresh)
     if success:
       return (success, dict['block_serials'])
     return (success, dict)
 
-  def get_num_nodes(self):
-    (success, dict) = self.get_cluster_info()
+  def get_num_nodes(self, force_refresh=False):
+    (success, dict) = self.get_cluster_info(force_refresh)
     if success:
       return (success, dict['num_nodes'])
     return (success, dict)
 
-  def get_desired_redundancy_factor(self):
-    (success, dict) = self.get_cluster_info()
+  def get_desired_redundancy_factor(self, force_refresh=False):
+    (success, dict) = self.get_cluster_info(force_refresh)
     if success:
       return (success, dict['desired_redundancy_factor'])
     return (success, dict)
 
-  def get_current_redundancy_factor(self):
-    (success, dict) = self.get_cluster_info()
+  def get_current_redundancy_factor(self, force_refresh=False):
+    (success, dict) = self.get_cluster_info(force_refresh)
     if success:
       return (success, dict['current_redundancy_factor'])
     return (success, dict)
@@ -457,24 +1003,16 @@ class NutanixRestApiClient:
       return (False, error_dict)
 
 
-  def get_container_info(self, name):
+  def get_container_info(self, name, as_record=False):
+    # as_record : Return ContainerRecord instead of dict.
     error_dict = {}
     try:
-      response_dict = self._get_v1('/containers/', error_dict)
-      container_info = {}
-      for cont in response_dict['entities']:
-        if cont['name'] != name:
-          continue
-        container_info = {
-          'uuid':cont['containerUuid'],
-          'id':cont['id'],
-          'storagepool_uuid':cont['storagePoolUuid'],
-          'usage':cont['usageStats']['storage.usage_bytes']
-        }
-        break  
-      if len(container_info) == 0:
+      cont = self._find_entity('container', name=name, error_dict=error_dict)
+      if cont is None:
         raise IntendedException('Error. Unable to find container "{}"'.format(name))
-      return (True, container_info)
+      if as_record:
+        return (True, ContainerRecord.from_entity(cont))
+      return (True, self._make_container_info(cont))
       
     except Exception as exception:
       self._handle_error(exception, error_dict)
@@ -485,32 +1023,12 @@ class NutanixRestApiClient:
     try:
       # Get storage pool uuid.
       response_dict = self._get_v1('/storage_pools/', error_dict)
-      storagepool_dict = {}
-      for storagepool in response_dict['entities']:
-        storagepool_dict[storagepool['name']] = storagepool['storagePoolUuid']
-      storagepool_uuid = ''
-      if storagepool_name == '':
-        if len(storagepool_dict) != 1:
-          raise IntendedException('Error. Needs to provide storagepool name if having 2+ pools.')
-        storagepool_uuid = storagepool_dict.popitem()[1]
-      else:
-        if storagepool_name not in storagepool_dict:
-          raise IntendedException('Error. Storagepool name "{}" doesn\'t exist.'.format(storagepool_name))
-        storagepool_uuid = storagepool_dict[storagepool_name]
+      storagepool_uuid = self._select_storagepool_uuid(response_dict['entities'], storagepool_name)
 
       # Create container
-      body_dict = {
-        "id": None,
-        "name": container_name,
-        "storagePoolId": storagepool_uuid,
-        "totalExplicitReservedCapacity": 0,
-        "advertisedCapacity": None,
-        "compressionEnabled": True,
-        "compressionDelayInSecs": 0,
-        "fingerPrintOnWrite": "OFF",
-        "onDiskDedup": "OFF"
-      }
+      body_dict = self._make_container_body(container_name, storagepool_uuid)
       response_dict = self._post_v1('/containers/', body_dict, error_dict)
+      self._entity_index.invalidate('container')
       return (True, response_dict['value'])
 
     except Exception as exception:
@@ -524,17 +1042,14 @@ class NutanixRestApiClient:
     error_dict = {}
     try:
       # Get uuid from name
-      response_dict = self._get_v1('/containers/', error_dict)
-      container_uuid = ''
-      for cont in response_dict['entities']:
-        if cont['name'] == name:
-          container_uuid = cont['containerUuid']
-          break
-      if container_uuid == '':
+      cont = self._find_entity('container', name=name, error_dict=error_dict)
+      if cont is None:
         raise IntendedException('Error. Unable to find container "{}"'.format(name))
+      container_uuid = cont['containerUuid']
 
       # Delete
       response_dict = self._delete_v1('/containers/{}'.format(container_uuid), error_dict)
+      self._entity_index.invalidate('container')
       return (True, response_dict['value'])
       
     except Exception as exception:
@@ -560,36 +1075,16 @@ class NutanixRestApiClient:
       return (False, error_dict)
 
 
-  def get_network_info(self, name):
+  def get_network_info(self, name, as_record=False):
+    # as_record : Return NetworkRecord instead of dict.
     error_dict = {}
     try:
-      response_dict = self._get_v2('/networks/', error_dict)
-      network_info = {}
-      for network in response_dict['entities']:
-        if name != network['name']:
-          continue
-        network_info = {
-          'name' : network['name'],
-          'uuid' : network['uuid'],
-          'vlan' : network['vlan_id'],
-          'managed' : False
-        }
-        if 'network_address' in network['ip_config']:
-          network_info['managed'] = True
-          network_info['managed_address'] = network['ip_config']['network_address']
-          network_info['managed_prefix'] = network['ip_config']['prefix_length']
-          network_info['managed_gateway'] = network['ip_config']['default_gateway']
-          network_info['managed_dhcp_address'] = network['ip_config']['dhcp_server_address']
-          network_info['managed_dhcp_options'] = network['ip_config']['dhcp_options']
-          pools = []
-          for pool in network['ip_config']['pool']:
-            words = pool['range'].split(' ')
-            pools.append((words[0], words[1]))
-          network_info['managed_pools'] = pools
-        break
-      if network_info == {}:
+      network = self._find_entity('network', name=name, error_dict=error_dict)
+      if network is None:
         raise IntendedException('Error. Unable to find network "{}"'.format(name))
-      return (True, network_info)
+      if as_record:
+        return (True, NetworkRecord.from_entity(network))
+      return (True, self._make_network_info(network))
 
     except Exception as exception:
       self._handle_error(exception, error_dict)
@@ -599,11 +1094,9 @@ class NutanixRestApiClient:
   def create_network(self, name, vlan):
     error_dict = {}
     try:
-      body_dict = {
-        'name' : name,
-        'vlan_id' : str(vlan)
-      }
+      body_dict = self._make_network_body(name, vlan)
       response_dict = self._post_v2('/networks/', body_dict, error_dict)
+      self._entity_index.invalidate('network')
       return (True, response_dict['network_uuid'])
 
     except Exception as exception:
@@ -614,24 +1107,9 @@ class NutanixRestApiClient:
   def create_network_managed(self, name, vlan, network_address, prefix, gateway, pools, dns=''):
     error_dict = {}
     try:      
-      body_dict = {
-        'name' : name,
-        'vlan_id' : str(vlan),
-        'ip_config': {
-          'dhcp_options': {
-            'domain_name_servers': dns,
-          },
-          'network_address': network_address,
-          'prefix_length': str(prefix),
-          'default_gateway': gateway,
-          "pool": []
-        }
-      }
-      for (from_ip, to_ip) in pools:
-        entity = {'range' : '{} {}'.format(from_ip, to_ip)}
-        body_dict['ip_config']['pool'].append(entity)
-
+      body_dict = self._make_network_body(name, vlan, network_address, prefix, gateway, pools, dns)
       response_dict = self._post_v2('/networks/', body_dict, error_dict)
+      self._entity_index.invalidate('network')
       return (True, response_dict['network_uuid'])
 
     except Exception as exception:
@@ -639,29 +1117,18 @@ class NutanixRestApiClient:
       return (False, error_dict)
 
 
-  def is_network_used(self, name):
+  def is_network_used(self, name, force_refresh=False):
     error_dict = {}
     try:
       # Get uuid
-      response_dict = self._get_v2('/networks/', error_dict)
-      network_uuid = ''
-      for network in response_dict['entities']:
-        if network['name'] == name:
-          network_uuid = network['uuid']
-          break
-      if network_uuid == '':
+      network = self._find_entity('network', name=name, error_dict=error_dict)
+      if network is None:
         raise IntendedException('Error. Unable to find network "{}"'.format(name))
+      network_uuid = network['uuid']
 
       # Check all VMs whether using this network or not.
-      response_dict = self._get_v2('/vms/?include_vm_nic_config=true', error_dict)
-      is_used = False
-      for vm in response_dict['entities']:
-        for nic in vm['vm_nics']:
-          if network_uuid == nic['network_uuid']:
-            is_used = True
-            break
-        if is_used:
-          break
+      network_users = self._get_network_users(force_refresh, error_dict)
+      is_used = network_uuid in network_users
       return (True, is_used)
 
     except Exception as exception:
@@ -669,21 +1136,48 @@ class NutanixRestApiClient:
       return (False, error_dict)
 
 
+  def get_network_usage(self, force_refresh=False):
+    # Usage of all networks at once. Returns (True, {network_name:[vm_name, ...]}).
+    # Unused networks have empty list. Built from one VM listing and cached
+    # with the entity index. (entity_cache_ttl)
+    error_dict = {}
+    try:
+      networks = self._get_entities('network', force_refresh, error_dict)
+      network_users = self._get_network_users(force_refresh, error_dict)
+      usage = {}
+      for network in networks:
+        usage[network['name']] = network_users.get(network['uuid'], [])
+      return (True, usage)
+
+    except Exception as exception:
+      self._handle_error(exception, error_dict)
+      return (False, error_dict)
+
+
+  def _get_network_users(self, force_refresh, error_dict):
+    # network_uuid -> [vm_name, ...]. Reverse index of VM nics.
+    build = self._make_network_users
+    if not force_refresh:
+      (found, network_users) = self._entity_index.derived('vm', 'network_users', build)
+      if found:
+        return network_users
+    self._load_entities('vm', error_dict)
+    (found, network_users) = self._entity_index.derived('vm', 'network_users', build, check_ttl=False)
+    return network_users
+
+
   def delete_network(self, name):
     error_dict = {}
     try:
       # Get uuid
-      response_dict = self._get_v2('/networks/', error_dict)
-      network_uuid = ''
-      for network in response_dict['entities']:
-        if network['name'] == name:
-          network_uuid = network['uuid']
-          break
-      if network_uuid == '':
+      network = self._find_entity('network', name=name, error_dict=error_dict)
+      if network is None:
         raise IntendedException('Error. Unable to find network "{}"'.format(name))
+      network_uuid = network['uuid']
 
       # Delete
       response_dict = self._delete_v2('/networks/{}'.format(network_uuid), error_dict)
+      self._entity_index.invalidate('network')
       return (True, None)
       
     except Exception as exception:
@@ -702,61 +1196,27 @@ class NutanixRestApiClient:
   def get_vm_names(self):
     error_dict = {}
     try:
-      response_dict = self._get_v2('/vms/', error_dict)
+      # Paged. Large clusters time out listing all vms at once.
       vm_names = []
-      for vm in response_dict['entities']:
-        vm_names.append(vm['name'])
+      for page in self._iter_pages('vm', 500, False, '', error_dict):
+        for vm in page:
+          vm_names.append(vm['name'])
       return (True, vm_names)
 
     except Exception as exception:
       self._handle_error(exception, error_dict)
       return (False, error_dict)
 
-  def get_vm_info(self, name):
+  def get_vm_info(self, name, as_record=False):
+    # as_record : Return VmRecord (with DiskRecord and NicRecord) instead of dict.
     error_dict = {}
     try:
-      response_dict = self._get_v2('/vms/?include_vm_disk_config=true&include_vm_nic_config=true', error_dict)
-      vm_info = {}
-      for vm in response_dict['entities']:
-        if vm['name'] != name:
-          continue
-        vm_info = {
-          'name' : vm['name'],
-          'uuid' : vm['uuid'],
-          'memory_mb' : vm['memory_mb'],
-          'num_vcpus' : vm['num_vcpus'],
-          'num_cores' : vm['num_cores_per_vcpu'],
-          'power_state' : vm['power_state'],
-          'timezone' : vm['timezone'],
-          'is_agent' : vm['vm_features'].get('AGENT_VM', False)
-        }
-
-        disks = []
-        for disk in vm['vm_disk_info']:
-          disk_info = {
-            'bus' : disk['disk_address']['device_bus'],
-            'label' : disk['disk_address']['disk_label'],
-            'is_cdrom' : disk['is_cdrom'],
-            'is_flashmode' : disk['flash_mode_enabled'],
-            'is_empty' : disk['is_empty'],
-            'vmdisk_uuid' : disk['disk_address'].get('vmdisk_uuid', ''),
-            'container_uuid' : disk.get('storage_container_uuid', ''),
-            'size' : disk.get('size', 0)
-          }
-          disks.append(disk_info)
-        vm_info['disks'] = disks
-
-        nics = []
-        for nic in vm['vm_nics']:
-          nic_info = {
-            'mac_address' : nic['mac_address'],
-            'network_uuid' : nic['network_uuid'],
-            'is_connected' : nic['is_connected']
-          }
-        vm_info['nics'] = nics
-        break
-      if vm_info == {}:
+      vm = self._find_entity('vm', name=name, error_dict=error_dict)
+      if vm is None:
         raise IntendedException('Error. Unable to find vm "{}"'.format(name))
+      if as_record:
+        return (True, VmRecord.from_entity(vm))
+      vm_info = self._make_vm_info(vm)
       return (True, vm_info)
 
     except Exception as exception:
@@ -773,69 +1233,23 @@ class NutanixRestApiClient:
     error_dict = {}
     try:
       # image uuid
-      response_dict = self._get_v2('/images/', error_dict)
-      vmdisk_uuid = ''
-      vmdisk_size = 0
-      for image in response_dict['entities']:
-        if image['name'] == image_name:
-          vmdisk_uuid = image['vm_disk_id']
-          vmdisk_size = image['vm_disk_size']
-          break
-      if vmdisk_uuid == '':
+      image = self._find_entity('image', name=image_name, error_dict=error_dict)
+      if image is None:
         raise IntendedException('Error. Unable to find image "{}"'.format(image_name))
+      vmdisk_uuid = image['vm_disk_id']
+      vmdisk_size = image['vm_disk_size']
 
       # network uuid
-      response_dict = self._get_v2('/networks/', error_dict)
-      network_uuid = ''
-      for network in response_dict['entities']:
-        if network['name'] == network_name:
-          network_uuid = network['uuid']
-          break
-      if network_uuid == '':
-        raise IntendedException('Error. Unable to find network "{}"'.format(name))
+      network = self._find_entity('network', name=network_name, error_dict=error_dict)
+      if network is None:
+        raise IntendedException('Error. Unable to find network "{}"'.format(network_name))
+      network_uuid = network['uuid']
 
       # create vm with image_uuid and network_uuid
-      body_dict = {
-        "name": name,
-        "memory_mb": memory_mb,
-        "num_vcpus": num_vcpus,
-        "description": "",
-        "num_cores_per_vcpu": num_cores,
-        "vm_disks": [
-          {
-            "is_cdrom": True,
-            "is_empty": True,
-            "disk_address": {
-              "device_bus": "ide"
-            }
-          },
-          {
-            "is_cdrom": False,
-            "disk_address": {
-              "device_bus": "scsi"
-            },
-            "vm_disk_clone": {
-              "disk_address": {
-                "vmdisk_uuid": vmdisk_uuid
-              },
-              "minimum_size": vmdisk_size
-            }
-          }
-        ],
-        "vm_nics": [
-          {
-            "network_uuid": network_uuid,
-            "requested_ip_address": ip_address
-          }
-        ],
-        "affinity": None,
-        "vm_features": {
-          "AGENT_VM": False
-        }
-      }
-      if ip_address == '':
-        del body_dict['vm_nics'][0]['requested_ip_address']
+      body_dict = self._make_vm_from_image_body(name, memory_mb, num_vcpus, num_cores,
+        vmdisk_uuid, vmdisk_size, network_uuid, ip_address)
       response_dict = self._post_v2('/vms/', body_dict, error_dict)
+      self._entity_index.invalidate('vm')
       return (True, response_dict['task_uuid'])
 
     except Exception as exception:
@@ -843,6 +1257,82 @@ class NutanixRestApiClient:
       return (False, error_dict)
 
 
+  def create_vms_from_image(self, vm_specs, max_workers=8, wait=False, wait_timeout=None, wait_interval=0.5):
+    # Create many VMs. vm_specs is list of dict which has same keys as
+    # create_vm_from_image() args. ("ip_address" is optional.)
+    #   {'name':'vm1', 'memory_mb':2048, 'num_vcpus':1, 'num_cores':1,
+    #    'image_name':'IMG', 'network_name':'NET'}
+    #
+    # Each image and network is resolved once for all VMs. POSTs are submitted
+    # by max_workers threads. Returns (all_success, results). results are
+    # (success, task_uuid or error_dict) in the same order as vm_specs.
+    # wait=True waits till all tasks end. (Up to wait_timeout seconds.)
+    # Then VMs whose task failed or timed out are (False, error_dict) too.
+    # error_dict has 'task_uuid' and 'task' (TaskWaiter result dict).
+    error_dict = {}
+    try:
+      # Resolve names once.
+      images = {}
+      networks = {}
+      for spec in vm_specs:
+        image_name = spec['image_name']
+        if image_name not in images:
+          images[image_name] = self._find_entity('image', name=image_name, error_dict=error_dict)
+        network_name = spec['network_name']
+        if network_name not in networks:
+          networks[network_name] = self._find_entity('network', name=network_name, error_dict=error_dict)
+
+      def create(spec):
+        error_dict = {}
+        try:
+          image = images[spec['image_name']]
+          if image is None:
+            raise IntendedException('Error. Unable to find image "{}"'.format(spec['image_name']))
+          network = networks[spec['network_name']]
+          if network is None:
+            raise IntendedException('Error. Unable to find network "{}"'.format(spec['network_name']))
+          body_dict = self._make_vm_from_image_body(spec['name'], spec['memory_mb'], spec['num_vcpus'],
+            spec['num_cores'], image['vm_disk_id'], image['vm_disk_size'], network['uuid'],
+            spec.get('ip_address', ''))
+          response_dict = self._post_v2('/vms/', body_dict, error_dict)
+          return (True, response_dict['task_uuid'])
+
+        except Exception as exception:
+          self._handle_error(exception, error_dict)
+          return (False, error_dict)
+
+      # Submit
+      with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(create, vm_specs))
+      self._entity_index.invalidate('vm')
+
+      if wait:
+        waiter = TaskWaiter(self, min_interval=wait_interval)
+        for (success, task_uuid) in results:
+          if success:
+            waiter.add(task_uuid, wait_timeout)
+        task_results = waiter.wait_all()
+        for (i, (success, task_uuid)) in enumerate(results):
+          if not success:
+            continue
+          task = task_results[task_uuid]
+          if task['succeeded']:
+            continue
+          if task['timeout']:
+            message = 'Error. Task "{}" didn\'t end within {} seconds.'.format(task_uuid, wait_timeout)
+          else:
+            message = 'Error. Task "{}" ended with "{}".'.format(task_uuid, task['status'])
+          error_dict = {'task_uuid':task_uuid, 'task':task}
+          self._handle_error(IntendedException(message), error_dict)
+          results[i] = (False, error_dict)
+
+      all_success = all(success for (success, _) in results)
+      return (all_success, results)
+
+    except Exception as exception:
+      self._handle_error(exception, error_dict)
+      return (False, error_dict)
+
   def update_vm(self, name):
     return (False, {'error':'Error. Not supported now.'})
 
@@ -869,17 +1359,10 @@ class NutanixRestApiClient:
   def get_vm_disks(self, vm_name):
     error_dict = {}
     try:
-      response_dict = self._get_v2('/vms/?include_vm_disk_config=true', error_dict)
-      for vm in response_dict['entities']:
-        if vm['name'] != vm_name:
-          continue
-        vdisks = []
-        for vdisk in vm['vm_disk_info']:
-          if vdisk['is_cdrom']:
-            continue
-          vdisks.append(vdisk['disk_address']['disk_label'])
-        return (True, vdisks)
-      raise IntendedException('Error. Unable to find the vm "{}"'.format(name))
+      vm = self._find_entity('vm', name=vm_name, error_dict=error_dict)
+      if vm is None:
+        raise IntendedException('Error. Unable to find the vm "{}"'.format(vm_name))
+      return (True, self._make_vm_disks(vm))
 
     except Exception as exception:
       self._handle_error(exception, error_dict)
@@ -908,28 +1391,17 @@ class NutanixRestApiClient:
     error_dict = {}
     try:
       # Get container UUID
-      response_dict = self._get_v1('/containers/', error_dict)
-      target_container_uuid = ''
-      for cont in response_dict['entities']:
-        if cont['name'] == target_container:
-          target_container_uuid = cont['containerUuid']
-          break
-      if target_container_uuid == '':
+      cont = self._find_entity('container', name=target_container, error_dict=error_dict)
+      if cont is None:
         raise IntendedException('Unable to find container "{}"'.format(target_container))
+      target_container_uuid = cont['containerUuid']
 
       # Upload
       is_iso = file_url.lower().endswith('.iso')
       image_type = 'ISO_IMAGE' if is_iso else 'DISK_IMAGE'
-      body_dict = {
-        "name": image_name,
-        "annotation": "",
-        "imageType": image_type,
-        "imageImportSpec": {
-          "containerUuid": target_container_uuid,
-          "url": file_url,
-        }
-      }
+      body_dict = self._make_image_body(image_name, image_type, target_container_uuid, file_url)
       response_dict = self._post_v08('/images/', body_dict, error_dict)
+      self._entity_index.invalidate('image')
       return (True, response_dict['taskUuid'])
 
     except Exception as exception:
@@ -941,48 +1413,26 @@ class NutanixRestApiClient:
     error_dict = {}
     try:
       # Get vdisk_uuid and source_container_uuid
-      response_dict = self._get_v2('/vms/?include_vm_disk_config=true', error_dict)
-      vdisk_uuid = ''
-      source_container_uuid = ''
-      for vm in response_dict['entities']:
-        if vm['name'] != vm_name:
-          continue
-        for vdisk in vm['vm_disk_info']:
-          if vdisk['disk_address']['disk_label'] != vm_disk:
-            continue
-          vdisk_uuid = vdisk['disk_address']['vmdisk_uuid']
-          source_container_uuid = vdisk['storage_container_uuid']
-          break
-        break
+      vm = self._find_entity('vm', name=vm_name, error_dict=error_dict)
+      (vdisk_uuid, source_container_uuid) = self._find_vdisk(vm, vm_disk)
       if vdisk_uuid == '':
         raise Exception('Error: Unable to find VM "{}" which has vDisk "{}"'.format(vm_name, vm_disk))
 
       # Get souce_container_name and target_container_uuid
-      response_dict = self._get_v1('/containers/', error_dict)
-      source_container_name = ''
-      target_container_uuid = ''
-      for cont in response_dict['entities']:
-        if cont['containerUuid'] == source_container_uuid:
-          source_container_name = cont['name']
-        if cont['name'] == target_container:
-          target_container_uuid = cont['containerUuid']
-      if source_container_name == '':
+      source_cont = self._find_entity('container', uuid=source_container_uuid, error_dict=error_dict)
+      if source_cont is None:
         raise IntendedException('Error: Unable to find source container name from uuid="{}".'.format(source_container_uuid))
-      if target_container_uuid == '':
+      source_container_name = source_cont['name']
+      target_cont = self._find_entity('container', name=target_container, error_dict=error_dict)
+      if target_cont is None:
         raise IntendedException('Error: Unable to find container "{}"'.format(target_container))
+      target_container_uuid = target_cont['containerUuid']
 
       # Upload image from VM vDisk
       nfs_url = 'nfs://127.0.0.1/{}/.acropolis/vmdisk/{}'.format(source_container_name, vdisk_uuid)
-      body_dict = {
-        "name": image_name,
-        "annotation": "",
-        "imageType": 'DISK_IMAGE',
-        "imageImportSpec": {
-          "containerUuid": target_container_uuid,
-          "url": nfs_url,
-        }
-      }
+      body_dict = self._make_image_body(image_name, 'DISK_IMAGE', target_container_uuid, nfs_url)
       response_dict = self._post_v08('/images/', body_dict, error_dict)
+      self._entity_index.invalidate('image')
       return (True, response_dict['taskUuid'])
       
     except Exception as exception:
@@ -994,17 +1444,14 @@ class NutanixRestApiClient:
     error_dict = {}
     try:
       # Get image UUID
-      response_dict = self._get_v08('/images/', error_dict)
-      image_uuid = ''
-      for image in response_dict['entities']:
-        if image['name'] == name:
-          image_uuid = image['uuid']
-          break
-      if image_uuid == '':
+      image = self._find_entity('image', name=name, error_dict=error_dict)
+      if image is None:
         raise IntendedException('Error: Unable to find image "{}"'.format(name))
+      image_uuid = image['uuid']
 
       # Delete
       response_dict = self._delete_v08('/images/{}'.format(image_uuid), error_dict)
+      self._entity_index.invalidate('image')
       return (True, response_dict['taskUuid'])
 
     except Exception as exception:
@@ -1016,16 +1463,14 @@ class NutanixRestApiClient:
   ### Task Operation
   ###
 
-  def get_task_status(self, task_uuid):
+  def get_task_status(self, task_uuid, as_record=False):
+    # as_record : Return TaskRecord instead of dict.
     error_dict = {}
     try:
       response_dict = self._get_v08('/tasks/{}'.format(task_uuid), error_dict)
-      return_dict = {
-        'uuid': response_dict['uuid'],
-        'method': response_dict['metaRequest']['methodName'],
-        'percent': response_dict.get('percentageComplete', 0),
-        'status': response_dict['progressStatus'],
-      }
+      if as_record:
+        return (True, TaskRecord.from_entity(response_dict))
+      return_dict = self._make_task_status(response_dict)
       return (True, return_dict)
 
     except Exception as exception:
@@ -1033,19 +1478,32 @@ class NutanixRestApiClient:
       return (False, error_dict)
 
 
-  def get_tasks_status(self):
+  def wait_tasks(self, task_uuids, timeout=None, callback=None):
+    # Wait till all tasks end. Returns (all_succeeded, {task_uuid:result_dict}).
+    # See TaskWaiter about result_dict.
+    error_dict = {}
+    try:
+      waiter = TaskWaiter(self)
+      for task_uuid in task_uuids:
+        waiter.add(task_uuid, timeout, callback)
+      results = waiter.wait_all()
+      all_succeeded = all(result['succeeded'] for result in results.values())
+      return (all_succeeded, results)
+
+    except Exception as exception:
+      self._handle_error(exception, error_dict)
+      return (False, error_dict)
+
+
+  def get_tasks_status(self, as_record=False):
+    # as_record : Return list of TaskRecord instead of dicts.
     error_dict = {}
     try:
       response_dict = self._get_v08('/tasks/?includeCompleted=false', error_dict)
+      make = TaskRecord.from_entity if as_record else self._make_task_status
       task_list = []
       for entity in response_dict['entities']:
-        entity_dict = {
-          'uuid': entity['uuid'],
-          'method': entity['metaRequest']['methodName'],
-          'percent': entity.get('percentageComplete', 0),
-          'status': entity['progressStatus'],
-        }
-        task_list.append(entity_dict)
+        task_list.append(make(entity))
       return (True, task_list)
 
     except Exception as exception:
@@ -1053,9 +1511,1373 @@ class NutanixRestApiClient:
       return (False, error_dict)
 
 
+  ###
+  ### Response/Request builders. Shared with nutanix_async.py.
+  ###
+
+  @staticmethod
+  def _make_cluster_info(response_dict):
+    return_dict = {
+      # Basic
+      'uuid' : response_dict['uuid'],
+      'name' : response_dict['name'],
+      'timezone' : response_dict['timezone'],
+      'is_lts' : response_dict['isLTS'],
+      'version' : response_dict['version'],
+      'version_ncc' : response_dict['nccVersion'],
+
+      # RF
+      'current_redundancy_factor' : response_dict['clusterRedundancyState']['currentRedundancyFactor'],
+      'desired_redundancy_factor' : response_dict['clusterRedundancyState']['desiredRedundancyFactor'],
+
+      # Network
+      'ip_external' : response_dict['clusterExternalIPAddress'],
+      'ip_iscsi' : response_dict['clusterExternalDataServicesIPAddress'],
+      'network_external' : response_dict['externalSubnet'],
+      'network_internal' : response_dict['internalSubnet'],
+      'nfs_whitelists' : response_dict['globalNfsWhiteList'],
+
+      # Node and Block
+      'num_nodes' : response_dict['numNodes'],
+      'block_serials' : response_dict['blockSerials'],
+      'num_blocks' : len(response_dict['blockSerials']),
+
+      # Servers
+      'name_servers' : response_dict['nameServers'],
+      'ntp_servers' : response_dict['ntpServers'],
+      'smtp_server' : '' if response_dict['smtpServer'] is None else response_dict['smtpServer'],
+
+      # Storage
+      'storage_type' : response_dict['storageType'],
+    }
+
+    hypervisors = response_dict['hypervisorTypes']
+    if len(hypervisors) == 1:
+      return_dict['hypervisor'] = hypervisors[0]
+      if return_dict['hypervisor'] == 'kKvm':
+        return_dict['hypervisor'] = 'AHV'
+    else:
+      # needs update here
+      return_dict['hypervisor'] = 'unknown'
+
+    return return_dict
+
+  @staticmethod
+  def _select_storagepool_uuid(storagepools, storagepool_name=''):
+    # storagepool_name '' : The only pool.
+    storagepool_dict = {}
+    for storagepool in storagepools:
+      storagepool_dict[storagepool['name']] = storagepool['storagePoolUuid']
+    if storagepool_name == '':
+      if len(storagepool_dict) != 1:
+        raise IntendedException('Error. Needs to provide storagepool name if having 2+ pools.')
+      return storagepool_dict.popitem()[1]
+    if storagepool_name not in storagepool_dict:
+      raise IntendedException('Error. Storagepool name "{}" doesn\'t exist.'.format(storagepool_name))
+    return storagepool_dict[storagepool_name]
+
+  @staticmethod
+  def _make_container_info(cont):
+    return {
+      'uuid':cont['containerUuid'],
+      'id':cont['id'],
+      'storagepool_uuid':cont['storagePoolUuid'],
+      'usage':cont['usageStats']['storage.usage_bytes']
+    }
+
+  @staticmethod
+  def _make_container_body(container_name, storagepool_uuid):
+    return {
+      "id": None,
+      "name": container_name,
+      "storagePoolId": storagepool_uuid,
+      "totalExplicitReservedCapacity": 0,
+      "advertisedCapacity": None,
+      "compressionEnabled": True,
+      "compressionDelayInSecs": 0,
+      "fingerPrintOnWrite": "OFF",
+      "onDiskDedup": "OFF"
+    }
+
+  @staticmethod
+  def _make_network_info(network):
+    network_info = {
+      'name' : network['name'],
+      'uuid' : network['uuid'],
+      'vlan' : network['vlan_id'],
+      'managed' : False
+    }
+    if 'network_address' in network['ip_config']:
+      network_info['managed'] = True
+      network_info['managed_address'] = network['ip_config']['network_address']
+      network_info['managed_prefix'] = network['ip_config']['prefix_length']
+      network_info['managed_gateway'] = network['ip_config']['default_gateway']
+      network_info['managed_dhcp_address'] = network['ip_config']['dhcp_server_address']
+      network_info['managed_dhcp_options'] = network['ip_config']['dhcp_options']
+      pools = []
+      for pool in network['ip_config']['pool']:
+        words = pool['range'].split(' ')
+        pools.append((words[0], words[1]))
+      network_info['managed_pools'] = pools
+    return network_info
+
+  @staticmethod
+  def _make_network_body(name, vlan, network_address=None, prefix=None, gateway=None, pools=(), dns=''):
+    # network_address None : Unmanaged network.
+    body_dict = {
+      'name' : name,
+      'vlan_id' : str(vlan)
+    }
+    if network_address is None:
+      return body_dict
+    body_dict['ip_config'] = {
+      'dhcp_options': {
+        'domain_name_servers': dns,
+      },
+      'network_address': network_address,
+      'prefix_length': str(prefix),
+      'default_gateway': gateway,
+      "pool": []
+    }
+    for (from_ip, to_ip) in pools:
+      entity = {'range' : '{} {}'.format(from_ip, to_ip)}
+      body_dict['ip_config']['pool'].append(entity)
+    return body_dict
+
+  @staticmethod
+  def _make_network_users(uuid_to_vm):
+    # network_uuid -> [vm_name, ...] from {vm_uuid:vm} with nic config.
+    network_users = {}
+    for vm in uuid_to_vm.values():
+      for nic in vm.get('vm_nics', []):
+        network_users.setdefault(nic['network_uuid'], []).append(vm['name'])
+    return network_users
+
+  @staticmethod
+  def _make_vm_disks(vm):
+    vdisks = []
+    for vdisk in vm['vm_disk_info']:
+      if vdisk['is_cdrom']:
+        continue
+      vdisks.append(vdisk['disk_address']['disk_label'])
+    return vdisks
+
+  @staticmethod
+  def _find_vdisk(vm, vm_disk):
+    # Return (vdisk_uuid, container_uuid) of the disk labeled vm_disk. ('', '') if not found.
+    if vm is not None:
+      for vdisk in vm['vm_disk_info']:
+        if vdisk['disk_address']['disk_label'] != vm_disk:
+          continue
+        return (vdisk['disk_address']['vmdisk_uuid'], vdisk['storage_container_uuid'])
+    return ('', '')
+
+  @staticmethod
+  def _make_image_body(image_name, image_type, container_uuid, url):
+    return {
+      "name": image_name,
+      "annotation": "",
+      "imageType": image_type,
+      "imageImportSpec": {
+        "containerUuid": container_uuid,
+        "url": url,
+      }
+    }
+
+  @staticmethod
+  def _make_vm_info(vm):
+    vm_info = {
+      'name' : vm['name'],
+      'uuid' : vm['uuid'],
+      'memory_mb' : vm['memory_mb'],
+      'num_vcpus' : vm['num_vcpus'],
+      'num_cores' : vm['num_cores_per_vcpu'],
+      'power_state' : vm['power_state'],
+      'timezone' : vm['timezone'],
+      'is_agent' : vm['vm_features'].get('AGENT_VM', False)
+    }
+
+    disks = []
+    for disk in vm['vm_disk_info']:
+      disk_info = {
+        'bus' : disk['disk_address']['device_bus'],
+        'label' : disk['disk_address']['disk_label'],
+        'is_cdrom' : disk['is_cdrom'],
+        'is_flashmode' : disk['flash_mode_enabled'],
+        'is_empty' : disk['is_empty'],
+        'vmdisk_uuid' : disk['disk_address'].get('vmdisk_uuid', ''),
+        'container_uuid' : disk.get('storage_container_uuid', ''),
+        'size' : disk.get('size', 0)
+      }
+      disks.append(disk_info)
+    vm_info['disks'] = disks
+
+    nics = []
+    for nic in vm['vm_nics']:
+      nic_info = {
+        'mac_address' : nic['mac_address'],
+        'network_uuid' : nic['network_uuid'],
+        'is_connected' : nic['is_connected']
+      }
+      nics.append(nic_info)
+    vm_info['nics'] = nics
+    return vm_info
+
+  @staticmethod
+  def _make_vm_from_image_body(name, memory_mb, num_vcpus, num_cores, vmdisk_uuid, vmdisk_size,
+    network_uuid, ip_address=''):
+    body_dict = {
+      "name": name,
+      "memory_mb": memory_mb,
+      "num_vcpus": num_vcpus,
+      "description": "",
+      "num_cores_per_vcpu": num_cores,
+      "vm_disks": [
+        {
+          "is_cdrom": True,
+          "is_empty": True,
+          "disk_address": {
+            "device_bus": "ide"
+          }
+        },
+        {
+          "is_cdrom": False,
+          "disk_address": {
+            "device_bus": "scsi"
+          },
+          "vm_disk_clone": {
+            "disk_address": {
+              "vmdisk_uuid": vmdisk_uuid
+            },
+            "minimum_size": vmdisk_size
+          }
+        }
+      ],
+      "vm_nics": [
+        {
+          "network_uuid": network_uuid,
+          "requested_ip_address": ip_address
+        }
+      ],
+      "affinity": None,
+      "vm_features": {
+        "AGENT_VM": False
+      }
+    }
+    if ip_address == '':
+      del body_dict['vm_nics'][0]['requested_ip_address']
+    return body_dict
+
+  @staticmethod
+  def _make_task_status(entity):
+    return {
+      'uuid': entity['uuid'],
+      'method': entity['metaRequest']['methodName'],
+      'percent': entity.get('percentageComplete', 0),
+      'status': entity['progressStatus'],
+    }
+
+
 ###
 ### Custome Exception Classes
 ###
 
 class IntendedException(Exception):
-  pass
\ No newline at end of file
+  pass
+
+
+###
+### Records
+###
+
+class Record:
+  # Base of compact entity records. Values are kept in __slots__ instead of a
+  # dict per entity. Readable like the info dicts ( record['name'], get(),
+  # keys(), items(), "in" ) and as attributes ( record.name ).
+  # Optional fields which are not set don't appear in keys().
+  __slots__ = ()
+
+  def __init__(self, **kwargs):
+    for (key, value) in kwargs.items():
+      setattr(self, key, value)
+
+  def __getitem__(self, key):
+    if key not in self.__slots__:
+      raise KeyError(key)
+    try:
+      return getattr(self, key)
+    except AttributeError:
+      raise KeyError(key)
+
+  def __setitem__(self, key, value):
+    if key not in self.__slots__:
+      raise KeyError(key)
+    setattr(self, key, value)
+
+  def __contains__(self, key):
+    return key in self.__slots__ and hasattr(self, key)
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def __len__(self):
+    return len(self.keys())
+
+  def __eq__(self, other):
+    if isinstance(other, (Record, dict)):
+      return self.to_dict() == (other.to_dict() if isinstance(other, Record) else other)
+    return NotImplemented
+
+  def __repr__(self):
+    return '{}({})'.format(type(self).__name__, self.to_dict())
+
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def keys(self):
+    return [key for key in self.__slots__ if hasattr(self, key)]
+
+  def values(self):
+    return [getattr(self, key) for key in self.keys()]
+
+  def items(self):
+    return [(key, getattr(self, key)) for key in self.keys()]
+
+  def to_dict(self):
+    # Same dict as the non-record API returns. Nested records become dicts too.
+    return_dict = {}
+    for (key, value) in self.items():
+      if isinstance(value, list):
+        value = [item.to_dict() if isinstance(item, Record) else item for item in value]
+      return_dict[key] = value
+    return return_dict
+
+
+class DiskRecord(Record):
+  __slots__ = ('bus', 'label', 'is_cdrom', 'is_flashmode', 'is_empty', 'vmdisk_uuid', 'container_uuid', 'size')
+
+  @classmethod
+  def from_entity(cls, disk):
+    # disk : Element of "vm_disk_info" of v2 vm.
+    record = cls()
+    address = disk['disk_address']
+    record.bus = sys.intern(address['device_bus'])
+    record.label = sys.intern(address['disk_label'])
+    record.is_cdrom = disk['is_cdrom']
+    record.is_flashmode = disk['flash_mode_enabled']
+    record.is_empty = disk['is_empty']
+    record.vmdisk_uuid = address.get('vmdisk_uuid', '')
+    record.container_uuid = disk.get('storage_container_uuid', '')
+    record.size = disk.get('size', 0)
+    return record
+
+
+class NicRecord(Record):
+  __slots__ = ('mac_address', 'network_uuid', 'is_connected')
+
+  @classmethod
+  def from_entity(cls, nic):
+    # nic : Element of "vm_nics" of v2 vm.
+    record = cls()
+    record.mac_address = nic['mac_address']
+    record.network_uuid = nic['network_uuid']
+    record.is_connected = nic['is_connected']
+    return record
+
+
+class VmRecord(Record):
+  __slots__ = ('name', 'uuid', 'memory_mb', 'num_vcpus', 'num_cores', 'power_state', 'timezone', 'is_agent',
+    'disks', 'nics')
+
+  @classmethod
+  def from_entity(cls, vm):
+    # vm : v2 vm entity with disk and nic config. (iter_vms(include_config=True) etc.)
+    # Repeated short strings like power state are interned and shared among records.
+    record = cls()
+    record.name = vm['name']
+    record.uuid = vm['uuid']
+    record.memory_mb = vm['memory_mb']
+    record.num_vcpus = vm['num_vcpus']
+    record.num_cores = vm['num_cores_per_vcpu']
+    record.power_state = sys.intern(vm['power_state'])
+    record.timezone = sys.intern(vm['timezone'])
+    record.is_agent = vm['vm_features'].get('AGENT_VM', False)
+    record.disks = [DiskRecord.from_entity(disk) for disk in vm['vm_disk_info']]
+    record.nics = [NicRecord.from_entity(nic) for nic in vm['vm_nics']]
+    return record
+
+
+class NetworkRecord(Record):
+  # managed_* are set only if the network is managed(IPAM).
+  __slots__ = ('name', 'uuid', 'vlan', 'managed', 'managed_address', 'managed_prefix', 'managed_gateway',
+    'managed_dhcp_address', 'managed_dhcp_options', 'managed_pools')
+
+  @classmethod
+  def from_entity(cls, network):
+    # network : v2 network entity.
+    record = cls()
+    record.name = network['name']
+    record.uuid = network['uuid']
+    record.vlan = network['vlan_id']
+    record.managed = False
+    ip_config = network['ip_config']
+    if 'network_address' in ip_config:
+      record.managed = True
+      record.managed_address = ip_config['network_address']
+      record.managed_prefix = ip_config['prefix_length']
+      record.managed_gateway = ip_config['default_gateway']
+      record.managed_dhcp_address = ip_config['dhcp_server_address']
+      record.managed_dhcp_options = ip_config['dhcp_options']
+      pools = []
+      for pool in ip_config['pool']:
+        words = pool['range'].split(' ')
+        pools.append((words[0], words[1]))
+      record.managed_pools = pools
+    return record
+
+
+class ContainerRecord(Record):
+  __slots__ = ('uuid', 'id', 'storagepool_uuid', 'usage')
+
+  @classmethod
+  def from_entity(cls, container):
+    # container : v1 container entity.
+    record = cls()
+    record.uuid = container['containerUuid']
+    record.id = container['id']
+    record.storagepool_uuid = container['storagePoolUuid']
+    record.usage = container['usageStats']['storage.usage_bytes']
+    return record
+
+
+class TaskRecord(Record):
+  __slots__ = ('uuid', 'method', 'percent', 'status')
+
+  @classmethod
+  def from_entity(cls, task):
+    # task : v0.8 task entity.
+    record = cls()
+    record.uuid = task['uuid']
+    record.method = sys.intern(task['metaRequest']['methodName'])
+    record.percent = task.get('percentageComplete', 0)
+    record.status = sys.intern(task['progressStatus'])
+    return record
+
+
+###
+### Task Waiter
+###
+
+class TaskWaiter:
+  # Track many tasks at once. One poll is one GET of incomplete task list,
+  # whatever the number of tracked tasks is. Task which drops off the list
+  # is confirmed by GET /tasks/<uuid> to know whether it succeeded or failed.
+  #
+  # Polling interval starts at min_interval and grows by "backoff" times on
+  # each poll till max_interval. It gets back to min_interval when some
+  # task ends. Failed polls also wait, not to hammer Prism.
+  #
+  # Result dict of ended task is get_task_status() dict plus
+  #   'succeeded' : True only if progressStatus is "Succeeded".
+  #   'timeout'   : True if the task didn't end within its timeout.
+  #
+  #   waiter = TaskWaiter(session)
+  #   waiter.add(task_uuid1)
+  #   waiter.add(task_uuid2, timeout=600, callback=fun)
+  #   results = waiter.wait_all()
+
+  SUCCEEDED = 'Succeeded'
+  ENDED = ['Succeeded', 'Failed', 'Aborted']
+
+  def __init__(self, client, min_interval=0.5, max_interval=10, backoff=1.5, max_confirm_failures=3):
+    # max_confirm_failures : Give up the task as "Unknown" if GET /tasks/<uuid>
+    #   keeps failing after it dropped off the list. (e.g. It wasn't a task uuid.)
+    self._client = client
+    self.max_confirm_failures = max_confirm_failures
+    self._confirm_failures = {}
+    self.min_interval = min_interval
+    self.max_interval = max_interval
+    self.backoff = backoff
+    self._interval = min_interval
+    self._pending = {}   # task_uuid -> (deadline or None, callback or None)
+    self._progress = {}  # task_uuid -> last seen status dict
+    self._results = {}   # task_uuid -> result dict
+    self.num_polls = 0
+
+  def add(self, task_uuid, timeout=None, callback=None):
+    # callback(result_dict) is called when the task ends.
+    deadline = None if timeout is None else time.time() + timeout
+    self._pending[task_uuid] = (deadline, callback)
+
+  def pending(self):
+    return list(self._pending)
+
+  def progress(self, task_uuid):
+    # Last seen status dict of the pending task. None if not seen yet.
+    return self._progress.get(task_uuid)
+
+  def results(self):
+    return dict(self._results)
+
+  def poll(self):
+    # Poll once. Return list of result dicts of tasks which ended now.
+    if len(self._pending) == 0:
+      return []
+    self.num_polls += 1
+    (success, tasks) = self._client.get_tasks_status()
+    if not success:
+      return self._expire()
+
+    running = set()
+    for task in tasks:
+      if task['uuid'] in self._pending:
+        running.add(task['uuid'])
+        self._progress[task['uuid']] = task
+
+    ended = []
+    for task_uuid in list(self._pending):
+      if task_uuid in running:
+        continue
+      (success, status) = self._client.get_task_status(task_uuid)
+      if not success:
+        # Not visible yet or API error. Check it on next poll.
+        failures = self._confirm_failures.get(task_uuid, 0) + 1
+        self._confirm_failures[task_uuid] = failures
+        if failures >= self.max_confirm_failures:
+          status = {'uuid':task_uuid, 'method':'', 'percent':0, 'status':'Unknown'}
+          ended.append(self._finish(task_uuid, status, False))
+        continue
+      if status['percent'] != 100 and status['status'] not in self.ENDED:
+        # Created after the list was made.
+        self._progress[task_uuid] = status
+        continue
+      ended.append(self._finish(task_uuid, status, False))
+    return ended + self._expire()
+
+  def wait_any(self, timeout=None):
+    # Wait till at least one task ends. Return list of ended result dicts.
+    return self._wait(timeout, wait_all=False)
+
+  def wait_all(self, timeout=None):
+    # Wait till all tasks end. Return {task_uuid:result_dict} of ended tasks.
+    # Tasks still running after timeout stay in pending().
+    self._wait(timeout, wait_all=True)
+    return self.results()
+
+  def _wait(self, timeout, wait_all):
+    start = time.time()
+    ended = []
+    while len(self._pending) > 0:
+      ended_now = self.poll()
+      ended += ended_now
+      if len(ended_now) > 0:
+        self._interval = self.min_interval
+        if not wait_all:
+          break
+      else:
+        self._interval = min(self.max_interval, self._interval * self.backoff)
+      if len(self._pending) == 0:
+        break
+
+      sleep = self._interval
+      if timeout is not None:
+        left = timeout - (time.time() - start)
+        if left <= 0:
+          break
+        sleep = min(sleep, left)
+      sleep = min(sleep, self._time_to_next_deadline())
+      time.sleep(max(0, sleep))
+    return ended
+
+  def _time_to_next_deadline(self):
+    deadlines = [deadline for (deadline, _) in self._pending.values() if deadline is not None]
+    if len(deadlines) == 0:
+      return self.max_interval
+    return min(deadlines) - time.time()
+
+  def _expire(self):
+    ended = []
+    now = time.time()
+    for (task_uuid, (deadline, _)) in list(self._pending.items()):
+      if deadline is None or deadline > now:
+        continue
+      status = self._progress.get(task_uuid) or {'uuid':task_uuid, 'method':'', 'percent':0, 'status':'Unknown'}
+      ended.append(self._finish(task_uuid, status, True))
+    return ended
+
+  def _finish(self, task_uuid, status, timeout):
+    (_, callback) = self._pending.pop(task_uuid)
+    self._progress.pop(task_uuid, None)
+    self._confirm_failures.pop(task_uuid, None)
+    result = dict(status)
+    result['succeeded'] = (not timeout) and status['status'] == self.SUCCEEDED
+    result['timeout'] = timeout
+    self._results[task_uuid] = result
+    if callback is not None:
+      callback(result)
+    return result
+
+
+###
+### JSON Backend
+###
+
+class JsonBackend:
+  # Encoder/decoder for REST bodies. Standard json module, compact separators.
+  # Bodies on the wire are compact. Only the REST log pretty-prints them.
+  #
+  # JsonBackend.select('auto') picks orjson, ujson, json in this order
+  # by what is installed. Any object having dumps() and loads() works too.
+
+  name = 'json'
+
+  def dumps(self, obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+  def loads(self, data):
+    return json.loads(data)
+
+  @staticmethod
+  def select(backend='auto'):
+    if backend == 'auto':
+      if orjson is not None:
+        return _OrjsonBackend()
+      if ujson is not None:
+        return _UjsonBackend()
+      return JsonBackend()
+    if backend == 'json':
+      return JsonBackend()
+    if backend == 'orjson':
+      if orjson is None:
+        raise Exception('JSON backend "orjson" is not installed.')
+      return _OrjsonBackend()
+    if backend == 'ujson':
+      if ujson is None:
+        raise Exception('JSON backend "ujson" is not installed.')
+      return _UjsonBackend()
+    if hasattr(backend, 'dumps') and hasattr(backend, 'loads'):
+      return backend
+    raise Exception('Unknown JSON backend "{}".'.format(backend))
+
+
+class _OrjsonBackend(JsonBackend):
+  name = 'orjson'
+
+  def dumps(self, obj):
+    # bytes (utf-8). Requests sends it as it is.
+    return orjson.dumps(obj)
+
+  def loads(self, data):
+    return orjson.loads(data)
+
+
+class _UjsonBackend(JsonBackend):
+  name = 'ujson'
+
+  def dumps(self, obj):
+    return ujson.dumps(obj)
+
+  def loads(self, data):
+    return ujson.loads(data)
+
+
+###
+### Retry Policy
+###
+
+class RetryPolicy:
+  # Retry rule shared by all REST calls of one client.
+  #
+  # - GET, PUT and DELETE are idempotent. Retry on any connection error,
+  #   timeout or one of retry_statuses (Prism returns 5xx under load).
+  # - POST is not. Retry only when connection couldn't be established,
+  #   since the request surely didn't reach Prism then.
+  #
+  # Wait before n-th retry is backoff_base * 2^(n-1) capped by backoff_max.
+  # "jitter" part of it is randomized to avoid synchronized retries.
+  #
+  # Retry budget works like token bucket. Each request deposits budget_ratio
+  # token and each retry withdraws 1 token (max budget tokens). When Prism is
+  # down, retries stop soon instead of multiplying the load.
+
+  IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+  def __init__(self, max_attempts=3, backoff_base=0.5, backoff_max=8.0, jitter=0.5,
+    retry_statuses=(500, 502, 503, 504), budget=10, budget_ratio=0.2):
+    self.max_attempts = max_attempts
+    self.backoff_base = backoff_base
+    self.backoff_max = backoff_max
+    self.jitter = jitter
+    self.retry_statuses = retry_statuses
+    self.budget = budget
+    self.budget_ratio = budget_ratio
+
+    self._lock = threading.Lock()
+    self._tokens = float(budget)
+    self._requests = 0
+    self._attempts = 0
+    self._retries = 0
+    self._recovered = 0
+    self._give_ups = 0
+    self._budget_exhausted = 0
+
+  def execute(self, method, request, on_retry=None):
+    # Call request() till it returns non retryable response or gives up.
+    # Return the last response. Raise the last exception if it never responds.
+    self.begin()
+    attempt = 0
+    while True:
+      attempt += 1
+      try:
+        response = request()
+      except RequestException as e:
+        retryable = isinstance(e, (requests.exceptions.ConnectionError, Timeout))
+        delay = self.retry_after_error(method, attempt, retryable, self._is_connect_error(e))
+        if delay is None:
+          raise
+        reason = e
+      else:
+        delay = self.retry_after_response(method, attempt, response.status_code)
+        if delay is None:
+          return response
+        reason = 'status {}'.format(response.status_code)
+
+      if on_retry is not None:
+        on_retry(attempt, delay, reason)
+      time.sleep(delay)
+
+  # Steps of execute() for clients which can't pass a blocking request().
+  # (nutanix_async.py) Call begin() once per request, then one of retry_after_*()
+  # per attempt. They return the wait before next attempt, or None to stop.
+  # retryable : Connection error or timeout. connect_error : Request wasn't sent.
+
+  def begin(self):
+    with self._lock:
+      self._requests += 1
+      self._tokens = min(float(self.budget), self._tokens + self.budget_ratio)
+
+  def retry_after_error(self, method, attempt, retryable, connect_error):
+    with self._lock:
+      self._attempts += 1
+    if method not in self.IDEMPOTENT_METHODS:
+      retryable = connect_error
+    if not (retryable and self._take_retry(attempt)):
+      return None
+    return self.backoff(attempt)
+
+  def retry_after_response(self, method, attempt, status):
+    with self._lock:
+      self._attempts += 1
+    if method not in self.IDEMPOTENT_METHODS or status not in self.retry_statuses:
+      if attempt > 1 and status < 400:
+        with self._lock:
+          self._recovered += 1
+      return None
+    if not self._take_retry(attempt):
+      return None
+    return self.backoff(attempt)
+
+  def backoff(self, attempt):
+    delay = min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1)))
+    return delay * (1 - self.jitter) + random.uniform(0, delay * self.jitter)
+
+  def stats(self):
+    with self._lock:
+      return {
+        'requests' : self._requests,
+        'attempts' : self._attempts,
+        'retries' : self._retries,
+        'recovered' : self._recovered,
+        'give_ups' : self._give_ups,
+        'budget_exhausted' : self._budget_exhausted,
+        'budget_tokens' : self._tokens,
+      }
+
+  def _take_retry(self, attempt):
+    with self._lock:
+      if attempt >= self.max_attempts:
+        self._give_ups += 1
+        return False
+      if self._tokens < 1:
+        self._budget_exhausted += 1
+        self._give_ups += 1
+        return False
+      self._tokens -= 1
+      self._retries += 1
+      return True
+
+  @staticmethod
+  def _is_connect_error(error):
+    # True only if TCP/TLS connection couldn't be made. (Request wasn't sent.)
+    if isinstance(error, ConnectTimeout):
+      return True
+    if not isinstance(error, requests.exceptions.ConnectionError) or len(error.args) == 0:
+      return False
+    reason = getattr(error.args[0], 'reason', error.args[0])
+    return isinstance(reason, ConnectTimeoutError)
+
+
+###
+### Request Metrics
+###
+
+class RequestMetrics:
+  # Request metrics per (API version, method, endpoint). Endpoint is the url
+  # path with uuids and numbers replaced by {uuid} and {id}, without query.
+  # So "/vms/<uuid>?include_vm_nic_config=true" is counted as "/vms/{uuid}".
+  #
+  # Latency is kept in a histogram of fixed buckets (1ms to 1min, x1.5 each).
+  # Percentiles are interpolated in the bucket. Accurate within the bucket
+  # width (50%), and never bigger than the max observed.
+
+  LATENCY_BUCKETS = tuple(0.001 * 1.5 ** i for i in range(28))
+
+  _UUID = re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}')
+  _NUMBER = re.compile(r'(?<=/)[0-9]+(?=/|$)')
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._endpoints = {}  # (version, method, endpoint) -> stats dict
+    self._normalized = {}  # url -> endpoint
+
+  def normalize(self, url):
+    endpoint = self._normalized.get(url)
+    if endpoint is None:
+      endpoint = url.split('?', 1)[0]
+      endpoint = self._UUID.sub('{uuid}', endpoint)
+      endpoint = self._NUMBER.sub('{id}', endpoint)
+      if len(self._normalized) < 10000:
+        self._normalized[url] = endpoint
+    return endpoint
+
+  def observe(self, version, method, url, status, latency, size_out, size_in):
+    # status : None if no response. (Connection error etc.) Counted as error.
+    index = bisect.bisect_left(self.LATENCY_BUCKETS, latency)
+    with self._lock:
+      stats = self._get(version, method, url)
+      stats['count'] += 1
+      if status is None or status >= 400:
+        stats['errors'] += 1
+      stats['bytes_out'] += size_out
+      stats['bytes_in'] += size_in
+      stats['latency_sum'] += latency
+      stats['latency_max'] = max(stats['latency_max'], latency)
+      stats['buckets'][index] += 1
+
+  def observe_retry(self, version, method, url):
+    with self._lock:
+      self._get(version, method, url)['retries'] += 1
+
+  def reset(self):
+    with self._lock:
+      self._endpoints.clear()
+
+  def snapshot(self):
+    # {"GET v2.0 /vms/" : {version, method, endpoint, count, errors, retries,
+    #   bytes_out, bytes_in, latency_avg, latency_max, p50, p95, p99}}. Seconds.
+    with self._lock:
+      items = [(key, dict(stats, buckets=list(stats['buckets']))) for (key, stats) in self._endpoints.items()]
+    snapshot = {}
+    for ((version, method, endpoint), stats) in sorted(items):
+      buckets = stats.pop('buckets')
+      count = stats['count']
+      stats['latency_avg'] = stats.pop('latency_sum') / count if count else 0
+      for (name, quantile) in [('p50', 0.5), ('p95', 0.95), ('p99', 0.99)]:
+        stats[name] = self._percentile(buckets, count, quantile, stats['latency_max'])
+      snapshot['{} {} {}'.format(method, version, endpoint)] = dict(
+        {'version' : version, 'method' : method, 'endpoint' : endpoint}, **stats)
+    return snapshot
+
+  def to_prometheus(self, prefix='nutanix_rest', labels=None):
+    # Prometheus text exposition format. labels : Added to every sample.
+    with self._lock:
+      items = [(key, dict(stats, buckets=list(stats['buckets']))) for (key, stats) in self._endpoints.items()]
+    counters = [
+      ('requests_total', 'count', 'Requests sent to Prism.'),
+      ('errors_total', 'errors', 'Requests failed with error status or without response.'),
+      ('retries_total', 'retries', 'Retries of requests.'),
+      ('request_bytes_total', 'bytes_out', 'Bytes of request bodies.'),
+      ('response_bytes_total', 'bytes_in', 'Bytes of response bodies.'),
+    ]
+    lines = []
+    for (name, key, help_text) in counters:
+      lines.append('# HELP {}_{} {}'.format(prefix, name, help_text))
+      lines.append('# TYPE {}_{} counter'.format(prefix, name))
+      for ((version, method, endpoint), stats) in sorted(items):
+        label_text = self._labels(labels, version, method, endpoint)
+        lines.append('{}_{}{{{}}} {}'.format(prefix, name, label_text, stats[key]))
+
+    name = '{}_latency_seconds'.format(prefix)
+    lines.append('# HELP {} Latency of requests including retries.'.format(name))
+    lines.append('# TYPE {} histogram'.format(name))
+    for ((version, method, endpoint), stats) in sorted(items):
+      label_text = self._labels(labels, version, method, endpoint)
+      cumulative = 0
+      for (bound, num) in zip(self.LATENCY_BUCKETS, stats['buckets']):
+        cumulative += num
+        lines.append('{}_bucket{{{},le="{:.6g}"}} {}'.format(name, label_text, bound, cumulative))
+      lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, label_text, stats['count']))
+      lines.append('{}_sum{{{}}} {:.6f}'.format(name, label_text, stats['latency_sum']))
+      lines.append('{}_count{{{}}} {}'.format(name, label_text, stats['count']))
+    return '\n'.join(lines) + '\n'
+
+  def write_prometheus(self, path, prefix='nutanix_rest', labels=None):
+    # For textfile collector of node_exporter. Replaced atomically.
+    temp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+    with open(temp_path, 'w') as f:
+      f.write(self.to_prometheus(prefix, labels))
+    os.replace(temp_path, path)
+
+  def _get(self, version, method, url):
+    key = (version, method, self.normalize(url))
+    stats = self._endpoints.get(key)
+    if stats is None:
+      stats = {
+        'count' : 0, 'errors' : 0, 'retries' : 0, 'bytes_out' : 0, 'bytes_in' : 0,
+        'latency_sum' : 0.0, 'latency_max' : 0.0,
+        'buckets' : [0] * (len(self.LATENCY_BUCKETS) + 1),
+      }
+      self._endpoints[key] = stats
+    return stats
+
+  def _percentile(self, buckets, count, quantile, latency_max):
+    if count == 0:
+      return 0.0
+    rank = quantile * count
+    cumulative = 0
+    for (index, num) in enumerate(buckets):
+      if num == 0 or cumulative + num < rank:
+        cumulative += num
+        continue
+      lower = self.LATENCY_BUCKETS[index - 1] if index > 0 else 0.0
+      upper = self.LATENCY_BUCKETS[index] if index < len(self.LATENCY_BUCKETS) else latency_max
+      value = lower + (upper - lower) * (rank - cumulative) / num
+      return min(value, latency_max)
+    return latency_max
+
+  @staticmethod
+  def _labels(labels, version, method, endpoint):
+    all_labels = dict(labels or {}, version=version, method=method, endpoint=endpoint)
+    texts = []
+    for (key, value) in all_labels.items():
+      value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+      texts.append('{}="{}"'.format(key, value))
+    return ','.join(texts)
+
+
+###
+### Private Utility Classes
+###
+
+class _LazyRestBody:
+  # Body of request/response for the REST log. Formatted by str() which
+  # logging calls only when the record is really emitted.
+  # Decoded object is reused if available, so json is not parsed again.
+  # The record may wait in the log queue. So only what is logged is kept:
+  # bodies over limit are cut here, and big decoded objects are dropped
+  # (decoded again by the log writer) since they are far bigger than bytes.
+
+  KEEP_DECODED_BYTES = 64 * 1024
+
+  def __init__(self, raw, decoded, limit):
+    self._size = len(raw)
+    if limit is not None and len(raw) > limit:
+      raw = raw[:limit]
+      decoded = None
+    elif len(raw) > self.KEEP_DECODED_BYTES:
+      decoded = None
+    self._raw = raw
+    self._decoded = decoded
+    self._limit = limit
+
+  def log_size(self):
+    # Bytes kept by this object. Used by asynclog to bound the queue.
+    return len(self._raw)
+
+  def __str__(self):
+    raw = self._raw
+    if isinstance(raw, bytes):
+      raw = raw.decode('utf-8', errors='replace')
+    if self._limit is not None and self._size > self._limit:
+      return '{}\n... (truncated. {} bytes)'.format(raw, self._size)
+    decoded = self._decoded
+    if decoded is None:
+      try:
+        decoded = json.loads(raw)
+      except ValueError:
+        return raw
+    return json.dumps(decoded, indent=2)
+
+
+class _SingleFlight:
+  # Run function once for concurrent calls with the same key. Calls which come
+  # while it runs wait for it and get their own deep copy of its result,
+  # or its exception and error_dict.
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._flights = {}  # key -> flight dict
+    self._sequence = 0  # Counts flights started and fences.
+    self._calls = 0
+    self._saved = 0
+
+  def fence(self):
+    # Return sequence for "after" of do(). Flights started before are not joined.
+    with self._lock:
+      self._sequence += 1
+      return self._sequence
+
+  def do(self, key, function, error_dict, after=0):
+    # function(error_dict) is called by the first caller only.
+    # after : Sequence from fence(). Join only a flight started after it.
+    with self._lock:
+      self._calls += 1
+      flight = self._flights.get(key)
+      is_leader = flight is None or flight['sequence'] <= after
+      if is_leader:
+        self._sequence += 1
+        flight = {
+          'event' : threading.Event(),
+          'sequence' : self._sequence,
+          'joiners' : 0,
+          'results' : [],
+          'exception' : IntendedException('Error. Identical request in flight was interrupted.'),
+          'error_dict' : {},
+        }
+        # Replaces older flight of the key. Its joiners still wait for it.
+        self._flights[key] = flight
+      else:
+        flight['joiners'] += 1
+        self._saved += 1
+
+    if is_leader:
+      try:
+        result = function(flight['error_dict'])
+        flight['exception'] = None
+      except Exception as exception:
+        flight['exception'] = exception
+      finally:
+        with self._lock:
+          if self._flights.get(key) is flight:
+            del self._flights[key]
+        # Nobody joins from here. Copy before the caller gets the original.
+        try:
+          if flight['exception'] is None:
+            flight['results'] = [copy.deepcopy(result) for i in range(flight['joiners'])]
+        finally:
+          flight['event'].set()
+    else:
+      flight['event'].wait()
+      if flight['exception'] is None:
+        result = flight['results'].pop()
+
+    error_dict.update(flight['error_dict'])
+    if flight['exception'] is not None:
+      raise flight['exception']
+    return result
+
+  def stats(self):
+    with self._lock:
+      return {
+        'gets' : self._calls,
+        'sent' : self._calls - self._saved,
+        'saved' : self._saved,
+        'in_flight' : len(self._flights),
+      }
+
+
+class _RequestHooks:
+  # Functions called on request lifecycle events. Each gets one dict per request.
+  # Lists are replaced, not modified. So emit() calls them without lock.
+  # "enabled" is checked by the caller before making the dict at all.
+
+  EVENTS = ('before_request', 'after_response', 'on_error', 'on_retry')
+
+  def __init__(self, logger=None):
+    self._logger = logger
+    self._hooks = {event : () for event in self.EVENTS}
+    self._lock = threading.Lock()
+    self.enabled = False
+    self.errors = 0
+
+  def add(self, event, function):
+    self._check(event)
+    with self._lock:
+      self._hooks[event] = self._hooks[event] + (function,)
+      self.enabled = True
+
+  def remove(self, event, function):
+    self._check(event)
+    with self._lock:
+      hooks = list(self._hooks[event])
+      if function in hooks:
+        hooks.remove(function)
+      self._hooks[event] = tuple(hooks)
+      self.enabled = any(self._hooks.values())
+
+  def emit(self, event, info):
+    # Broken hook must not break the request. Logged and counted.
+    for function in self._hooks[event]:
+      try:
+        function(info)
+      except Exception:
+        with self._lock:
+          self.errors += 1
+        if self._logger is not None:
+          self._logger.warning('Hook %s %r failed.\n%s', event, function, traceback.format_exc())
+
+  def stats(self):
+    with self._lock:
+      stats = {event : len(self._hooks[event]) for event in self.EVENTS}
+      stats['errors'] = self.errors
+    return stats
+
+  def _check(self, event):
+    if event not in self._hooks:
+      raise Exception('Unknown hook event "{}". Use one of {}.'.format(event, ', '.join(self.EVENTS)))
+
+
+class _JsonEntityStream:
+  # Incremental parser of a list response {"metadata":{...}, "entities":[{...}, ...]}.
+  # feed() bytes as they arrive and get each element of "entities" as soon as
+  # it is complete. Other top level fields are kept in self.document.
+  # Only the unparsed tail of the body is buffered.
+  # Values are decoded in place by raw_decode() of the standard json decoder.
+  # A value which fails to decode is retried with more data. So one element
+  # may be decoded twice when it spans chunks.
+
+  _SPACES = re.compile(r'\s*')
+  _SCALAR = re.compile(r'[^,}\]\s]*')
+  _NOTHING = object()
+
+  def __init__(self, fields=None, key='entities'):
+    self._fields = fields
+    self._key = key
+    self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+    self._json_decoder = json.JSONDecoder()
+    self._buffer = ''
+    self._pos = 0
+    self._state = 'start'
+    self._current_key = None
+    self.document = {}
+    self.num_entities = 0
+
+  def feed(self, data, final=False):
+    self._buffer = self._buffer[self._pos:] + self._text_decoder.decode(data, final)
+    self._pos = 0
+    while True:
+      (progress, entity) = self._step()
+      if not progress:
+        return
+      if entity is not self._NOTHING:
+        yield entity
+
+  def close(self):
+    for entity in self.feed(b'', final=True):
+      pass
+    if self._state != 'done':
+      raise ValueError('Incomplete JSON document. Stopped at "{}".'.format(self._state))
+
+  def _step(self):
+    # Parse one token. Return (progress, entity). progress is False if more data is needed.
+    # entity is _NOTHING unless an element of entities is completed.
+    buffer = self._buffer
+    pos = self._SPACES.match(buffer, self._pos).end()
+    self._pos = pos
+    if pos >= len(buffer):
+      return (False, self._NOTHING)
+    char = buffer[pos]
+    state = self._state
+
+    if state == 'start':
+      self._expect(char, '{')
+      self._state = 'key'
+    elif state == 'key':
+      if char == '}':
+        self._state = 'done'
+      else:
+        self._expect(char, '"')
+        decoded = self._decode(buffer, pos)
+        if decoded is None:
+          return (False, self._NOTHING)
+        (self._current_key, self._pos) = decoded
+        self._state = 'colon'
+        return (True, self._NOTHING)
+    elif state == 'colon':
+      self._expect(char, ':')
+      self._state = 'array' if self._current_key == self._key else 'value'
+    elif state == 'array' and char == '[':
+      self._state = 'first_element'
+    elif state in ['value', 'array']:
+      decoded = self._decode(buffer, pos)
+      if decoded is None:
+        return (False, self._NOTHING)
+      (self.document[self._current_key], self._pos) = decoded
+      self._state = 'next_key'
+      return (True, self._NOTHING)
+    elif state == 'first_element' and char == ']':
+      self._state = 'next_key'
+    elif state in ['first_element', 'element']:
+      decoded = self._decode(buffer, pos)
+      if decoded is None:
+        return (False, self._NOTHING)
+      (entity, self._pos) = decoded
+      if self._fields is not None:
+        entity = {field:entity[field] for field in self._fields if field in entity}
+      self.num_entities += 1
+      self._state = 'next_element'
+      return (True, entity)
+    elif state == 'next_element':
+      self._expect(char, ',]')
+      self._state = 'element' if char == ',' else 'next_key'
+    elif state == 'next_key':
+      self._expect(char, ',}')
+      self._state = 'key' if char == ',' else 'done'
+    else:
+      raise ValueError('Unexpected "{}" after the end of JSON document.'.format(char))
+    self._pos = pos + 1
+    return (True, self._NOTHING)
+
+  def _expect(self, char, chars):
+    if char not in chars:
+      raise ValueError('Expected "{}" but "{}" in state "{}".'.format(chars, char, self._state))
+
+  def _decode(self, buffer, pos):
+    # Return (value, end) of the JSON value starting at pos. None if not complete yet.
+    # Numbers etc. may look complete when cut. Wait for the delimiter after them.
+    is_scalar = buffer[pos] not in '{["'
+    if is_scalar and self._SCALAR.match(buffer, pos).end() >= len(buffer):
+      return None
+    try:
+      return self._json_decoder.raw_decode(buffer, pos)
+    except ValueError:
+      if is_scalar:
+        raise
+      return None
+
+
+class _EntityIndex:
+  # Per entity kind, keeps "name -> uuid" and "uuid -> entity" dicts of the
+  # last downloaded list. Entries expire after ttl seconds (0 disables cache)
+  # and are invalidated by the client itself after its own create/delete calls.
+  # If 2+ entities have same name, first one wins as same as the list scan.
+
+  def __init__(self, ttl):
+    self._ttl = ttl
+    self._lock = threading.Lock()
+    self._tables = {}   # kind -> (loaded_time, name_to_uuid, uuid_to_entity)
+    self._derived = {}  # kind -> {key:(table, value)}. Indexes built from the table.
+    self._singles = {}  # kind -> (name_to_uuid, uuid_to_(loaded_time, entity)). Looked up one by one.
+    self._hits = 0
+    self._misses = 0
+    self._loads = 0
+    self._invalidations = 0
+    self._lookups = 0
+    self._lookup_fallbacks = 0
+
+  def load(self, kind, entities, uuid_key):
+    name_to_uuid = {}
+    uuid_to_entity = {}
+    for entity in entities:
+      uuid = entity[uuid_key]
+      uuid_to_entity[uuid] = entity
+      name_to_uuid.setdefault(entity['name'], uuid)
+    with self._lock:
+      self._tables[kind] = (time.time(), name_to_uuid, uuid_to_entity)
+      self._derived.pop(kind, None)
+      self._singles.pop(kind, None)
+      self._loads += 1
+    return list(uuid_to_entity.values())
+
+  def put(self, kind, entity, uuid_key):
+    # Keep an entity looked up alone. Found by find() but not part of entities().
+    uuid = entity[uuid_key]
+    with self._lock:
+      (name_to_uuid, uuid_to_entry) = self._singles.setdefault(kind, ({}, {}))
+      name_to_uuid[entity['name']] = uuid
+      uuid_to_entry[uuid] = (time.time(), entity)
+
+  def count_lookup(self, fallback=False):
+    with self._lock:
+      if fallback:
+        self._lookup_fallbacks += 1
+      else:
+        self._lookups += 1
+
+  def entities(self, kind):
+    # Return (found, list of entities). found is False if expired.
+    with self._lock:
+      table = self._tables.get(kind)
+      if table is None or time.time() - table[0] >= self._ttl:
+        return (False, None)
+      return (True, list(table[2].values()))
+
+  def derived(self, kind, key, builder, check_ttl=True):
+    # Another index built from the table by builder(uuid_to_entity).
+    # Built once per load and dropped together with the table.
+    # Return (found, value). found is False if the table is expired.
+    with self._lock:
+      table = self._tables.get(kind)
+      if table is None or (check_ttl and time.time() - table[0] >= self._ttl):
+        return (False, None)
+      (built_table, value) = self._derived.get(kind, {}).get(key, (None, None))
+      if built_table is table:
+        return (True, value)
+    value = builder(table[2])
+    with self._lock:
+      if self._tables.get(kind) is table:
+        self._derived.setdefault(kind, {})[key] = (table, value)
+    return (True, value)
+
+  def find(self, kind, name='', uuid='', count=True, check_ttl=True):
+    # Return (found, entity). found is False when the index needs reloading.
+    # check_ttl=False : Search the table just loaded even if ttl is 0.
+    now = time.time()
+    with self._lock:
+      entity = None
+      table = self._tables.get(kind)
+      if table is not None and not (check_ttl and now - table[0] >= self._ttl):
+        (_, name_to_uuid, uuid_to_entity) = table
+        key = name_to_uuid.get(name, '') if name != '' else uuid
+        entity = uuid_to_entity.get(key)
+      if entity is None and kind in self._singles:
+        (name_to_uuid, uuid_to_entry) = self._singles[kind]
+        key = name_to_uuid.get(name, '') if name != '' else uuid
+        (loaded_time, single) = uuid_to_entry.get(key, (0, None))
+        if single is not None and not (check_ttl and now - loaded_time >= self._ttl):
+          entity = single
+      if count:
+        if entity is None:
+          self._misses += 1
+        else:
+          self._hits += 1
+      return (entity is not None, entity)
+
+  def invalidate(self, kind=None):
+    with self._lock:
+      if kind is None:
+        self._tables.clear()
+        self._derived.clear()
+        self._singles.clear()
+      else:
+        self._tables.pop(kind, None)
+        self._derived.pop(kind, None)
+        self._singles.pop(kind, None)
+      self._invalidations += 1
+
+  def stats(self):
+    with self._lock:
+      return {
+        'ttl' : self._ttl,
+        'hits' : self._hits,
+        'misses' : self._misses,
+        'loads' : self._loads,
+        'invalidations' : self._invalidations,
+        'lookups' : self._lookups,
+        'lookup_fallbacks' : self._lookup_fallbacks,
+        'entities' : {kind:len(table[2]) for (kind, table) in self._tables.items()},
+        'singles' : {kind:len(singles[1]) for (kind, singles) in self._singles.items()},
+      }
\ No newline at end of file
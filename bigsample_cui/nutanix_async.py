@@ -0,0 +1,642 @@
+'''
+Asyncio version of Python wrapper for Nutanix REST API.
+Same (success, dict) results as nutanix.py for the subset below.
+
+Has : cluster getters, storagepool/container/network/vm/image names,
+  container, network and image create/delete, get_container_info,
+  get_network_info, is_network_used, get_network_usage, get_vm_info,
+  get_vm_disks, create_vm_from_image, upload_image,
+  create_image_from_vm_vdisk and task status.
+Doesn't have : iter_*, as_record, create_vms_from_image (use gather()),
+  wait_tasks/TaskWaiter, lookup_mode (lists are always indexed),
+  session auth, metrics and hooks.
+
+Author: Yuichi Ito
+Email: yuichi.ito@nutanix.com
+'''
+
+import aiohttp
+
+import asyncio
+import datetime
+import logging
+import time
+import traceback
+
+from nutanix import NutanixRestApiClient, JsonBackend, IntendedException, RetryPolicy, _EntityIndex
+
+
+class AsyncNutanixRestApiClient:
+
+  def __init__(self, ip, username, password, logger=None, timeout_connection=2, timeout_read=5,
+    max_concurrency=16, pool_size=32, entity_cache_ttl=30, cluster_info_max_age=60, retry_policy=None,
+    json_backend='auto', port=9440, use_https=True):
+    # Nothing is connected here. Call "await login()" or use "async with".
+    # max_concurrency : Max number of requests in flight at once.
+    # pool_size : Max number of connections kept by the shared connection pool.
+    # entity_cache_ttl, cluster_info_max_age and retry_policy work as same as
+    # NutanixRestApiClient. Waits between retries don't hold max_concurrency.
+    self._ip = ip
+    self._auth = aiohttp.BasicAuth(username, password)
+    self._logger = logger
+    self._timeout = aiohttp.ClientTimeout(sock_connect=timeout_connection, sock_read=timeout_read)
+    self._max_concurrency = max_concurrency
+    self._pool_size = pool_size
+    self._json_backend = JsonBackend.select(json_backend)
+    self._base_url = '{}://{}:{}'.format('https' if use_https else 'http', ip, port)
+    self._entity_index = _EntityIndex(entity_cache_ttl)
+    self._entity_locks = {}
+    self._cluster_info_max_age = cluster_info_max_age
+    self._cluster_snapshot = (0, None)
+    self._cluster_lock = None
+    if retry_policy is None:
+      retry_policy = RetryPolicy()
+    self._retry_policy = retry_policy
+    self._session = None
+    self._semaphore = None
+
+  async def __aenter__(self):
+    await self.login()
+    return self
+
+  async def __aexit__(self, exc_type, exc, tb):
+    await self.close()
+
+  async def login(self):
+    connector = aiohttp.TCPConnector(limit=self._pool_size, ssl=False)
+    self._session = aiohttp.ClientSession(connector=connector, auth=self._auth, timeout=self._timeout,
+      headers={'Content-Type': 'application/json; charset=utf-8'})
+    self._semaphore = asyncio.Semaphore(self._max_concurrency)
+    self._cluster_lock = asyncio.Lock()
+
+    # Test session. The cluster document becomes the first cluster snapshot.
+    url = '{}/PrismGateway/services/rest/v1/cluster'.format(self._base_url)
+    try:
+      async with self._session.get(url) as response:
+        ok = response.status < 400
+        content = await response.read()
+    except Exception:
+      await self.close()
+      raise Exception('Unable to connect Nutanix Cluster "{}". Please check ip and port.'.format(self._ip))
+    if not ok:
+      await self.close()
+      raise Exception('Able to access. But unable to get cluster info. Please check your credential.')
+    try:
+      self._cluster_snapshot = (time.time(), self._json_backend.loads(content))
+    except ValueError:
+      pass
+
+  async def close(self):
+    if self._session is not None:
+      await self._session.close()
+      self._session = None
+
+  async def gather(self, *aws):
+    # Await many operations concurrently. Results are in the same order.
+    # Number of requests in flight is limited by max_concurrency.
+    return await asyncio.gather(*aws)
+
+
+  ###
+  ### Private utility
+  ###
+
+  def _logging_rest(self, method, url, status, latency, size_out, size_in):
+    logger = self._logger
+    if logger is None or not logger.isEnabledFor(logging.INFO):
+      return
+    logger.info('%s %s %s %.1fms out=%dB in=%dB', method, url, status, latency * 1000, size_out, size_in)
+
+  def _logging_retry(self, method, url, attempt, delay, reason):
+    logger = self._logger
+    if logger is None:
+      return
+    logger.warning('======== {} ========'.format(datetime.datetime.now()))
+    logger.warning('Retry {} {} (attempt {} failed with "{}"). Wait {:.2f}s.'.format(
+      method, url, attempt, reason, delay))
+    logger.warning('\n\n')
+
+  def _handle_error(self, error, error_dict):
+    error_dict['error'] = str(error)
+    if not isinstance(error, IntendedException):
+      error_dict['stacktrace'] = traceback.format_exc()
+    logger = self._logger
+    if logger is None:
+      return
+    logger.error('======== {} ========'.format(datetime.datetime.now()))
+    logger.error(error_dict['error'])
+    if 'stacktrace' in error_dict:
+      logger.error('')
+      logger.error(error_dict['stacktrace'])
+    logger.error('\n\n')
+
+  async def _send(self, method, version, url, body_dict, error_dict, allow_empty=False):
+    if self._session is None:
+      raise IntendedException('Not logged in. Call login() first.')
+    if not url.startswith('/'): url = '/' + url
+    full_url = '{}/api/nutanix/{}{}'.format(self._base_url, version, url)
+    data = None if body_dict is None else self._json_backend.dumps(body_dict)
+
+    # Same decisions and budget as the sync client. See RetryPolicy.
+    policy = self._retry_policy
+    policy.begin()
+    attempt = 0
+    while True:
+      attempt += 1
+      try:
+        async with self._semaphore:
+          start = time.perf_counter()
+          async with self._session.request(method, full_url, data=data) as response:
+            content = await response.read()
+          latency = time.perf_counter() - start
+      except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        retryable = isinstance(e, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+        delay = policy.retry_after_error(method, attempt, retryable, self._is_connect_error(e))
+        if delay is None:
+          raise
+        reason = e
+      else:
+        self._logging_rest(method, full_url, response.status, latency, len(data or ''), len(content))
+        delay = policy.retry_after_response(method, attempt, response.status)
+        if delay is None:
+          break
+        reason = 'status {}'.format(response.status)
+      self._logging_retry(method, full_url, attempt, delay, reason)
+      await asyncio.sleep(delay)
+
+    if response.status >= 400:
+      error_dict['method'] = method
+      error_dict['url'] = full_url
+      error_dict['code'] = response.status
+      error_dict['text'] = content.decode('utf-8', errors='replace')
+      raise IntendedException('Receive unexpected response code "{}".'.format(response.status))
+    try:
+      return self._json_backend.loads(content)
+    except ValueError:
+      if not allow_empty:
+        raise
+      return {}
+
+  @staticmethod
+  def _is_connect_error(error):
+    # True only if the connection couldn't be made. (Request wasn't sent.)
+    return isinstance(error, (aiohttp.ClientConnectorError, getattr(aiohttp, 'ConnectionTimeoutError', ())))
+
+  async def _load_entities(self, kind, error_dict):
+    # Download the list of the kind and index it.
+    (getter_name, url, uuid_key) = NutanixRestApiClient._ENTITY_SOURCES[kind]
+    version = 'v1' if getter_name == '_get_v1' else 'v2.0'
+    response_dict = await self._send('GET', version, url, None, error_dict)
+    return self._entity_index.load(kind, response_dict['entities'], uuid_key)
+
+  async def _get_entities(self, kind, force_refresh, error_dict):
+    # All entities of the kind. From the index if it is fresh.
+    if not force_refresh:
+      (found, entities) = self._entity_index.entities(kind)
+      if found:
+        return entities
+    return await self._load_entities(kind, error_dict)
+
+  async def _find_entity(self, kind, name='', uuid='', error_dict=None):
+    # Same as NutanixRestApiClient._find_entity with lookup_mode 'list'.
+    # Concurrent misses of one kind wait for a single download instead of
+    # downloading the list each.
+    if error_dict is None:
+      error_dict = {}
+    (found, entity) = self._entity_index.find(kind, name, uuid)
+    if found:
+      return entity
+    lock = self._entity_locks.setdefault(kind, asyncio.Lock())
+    async with lock:
+      (found, entity) = self._entity_index.find(kind, name, uuid, count=False)
+      if found:
+        return entity
+      await self._load_entities(kind, error_dict)
+    (found, entity) = self._entity_index.find(kind, name, uuid, count=False, check_ttl=False)
+    return entity
+
+  async def _iter_pages(self, kind, page_size, query, error_dict):
+    # Async generator of the list of entities per page. Same paging and stop
+    # conditions as NutanixRestApiClient._iter_pages. No prefetch.
+    (getter_name, _, url, paging) = NutanixRestApiClient._ITER_SOURCES[kind]
+    version = {'_get_v1' : 'v1', '_get_v2' : 'v2.0', '_get_v08' : 'v0.8'}[getter_name]
+    page = 0
+    num_yielded = 0
+    first_entity = None
+    while True:
+      page_url = NutanixRestApiClient._page_url(url, paging, page, page_size, query)
+      response_dict = await self._send('GET', version, page_url, None, error_dict)
+      entities = response_dict.get('entities', [])
+      total = NutanixRestApiClient._get_total(response_dict.get('metadata', {}))
+      if len(entities) == 0 or entities[0] == first_entity:
+        return
+      first_entity = entities[0]
+      yield entities
+      if NutanixRestApiClient._is_last_page(len(entities), num_yielded, total, page_size):
+        return
+      num_yielded += len(entities)
+      page += 1
+
+  def get_entity_cache_stats(self):
+    return self._entity_index.stats()
+
+  def get_retry_stats(self):
+    return self._retry_policy.stats()
+
+
+  ###
+  ### Cluster Operation
+  ###
+
+  async def get_cluster_info(self, force_refresh=False):
+    error_dict = {}
+    try:
+      response_dict = await self._get_cluster_snapshot(force_refresh, error_dict)
+      return (True, NutanixRestApiClient._make_cluster_info(response_dict))
+
+    except Exception as exception:
+      self._handle_error(exception, error_dict)
+      return (False, error_dict)
+
+  async def _get_cluster_snapshot(self, force_refresh, error_dict):
+    # Same as NutanixRestApiClient._get_cluster_snapshot. Concurrent getters
+    # of an old snapshot wait for a single download.
+    if not force_refresh:
+      async with self._cluster_lock:
+        (loaded_time, response_dict) = self._cluster_snapshot
+        if response_dict is not None and time.time() - loaded_time < self._cluster_info_max_age:
+          return response_dict
+        response_dict = await self._send('GET', 'v1', '/cluster/', None, error_dict)
+        self._cluster_snapshot = (time.time(), response_dict)
+        return response_dict
+    response_dict = await self._send('GET', 'v1', '/cluster/', None, error_dict)
+    self._cluster_snapshot = (time.time(), response_dict)
+    return response_dict
+
+  async def get_cluster_name(self, force_refresh=False):
+    (success, dict) = await self.get_cluster_info(force_refresh)
+    if success:
+      return (success, dict['name'])
+    return (success, dict)
+
+  async def get_hypervisor(self, force_refresh=False):
+    (success, dict) = await self.get_cluster_info(force_refresh)
+    if success:
+      return (success, dict['hypervisor'])
+    return (success, dict)
+
+  async def get_version(self, force_refresh=False):
+    (success, dict) = await self.get_cluster_info(force_refresh)
+    if success:
+      return (success, dict['version'])
+    return (success, dict)
+
+  async def get_name_servers(self, force_refresh=False):
+    (success, dict) = await self.get_cluster_info(force_refresh)
+    if success:
+      return (success, dict['name_servers'])
+    return (success, dict)
+
+  async def get_ntp_servers(self, force_refresh=False):
+    (success, dict) = await self.get_cluster_info(force_refresh)
+    if success:
+      return (success, dict['ntp_servers'])
+    return (success, dict)
+
+  async def get_block_serials(self, force_refresh=False):
+    (success, dict) = await self.get_cluster_info(force_refresh)
+    if success:
+      return (success, dict['block_serials'])
+    return (success, dict)
+
+  async def get_num_nodes(self, force_refresh=False):
+    (success, dict) = await self.get_cluster_info(force_refresh)
+    if success:
+      return (success, dict['num_nodes'])
+    return (success, dict)
+
+  async def get_desired_redundancy_factor(self, force_refresh=False):
+    (success, dict) = await self.get_cluster_info(force_refresh)
+    if success:
+      return (success, dict['desired_redundancy_factor'])
+    return (success, dict)
+
+  async def get_current_redundancy_factor(self, force_refresh=False):
+    (success, dict) = await self.get_cluster_info(force_refresh)
+    if success:
+      return (success, dict['current_redundancy_factor'])
+    return (success, dict)
+
+
+  ###
+  ### Names
+  ###
+
+  async def _get_names(self, version, url):
+    error_dict = {}
+    try:
+      response_dict = await self._send('GET', version, url, None, error_dict)
+      names = []
+      for entity in response_dict['entities']:
+        names.append(entity['name'])
+      return (True, names)
+
+    except Exception as exception:
+      self._handle_error(exception, error_dict)
+      return (False, error_dict)
+
+  async def get_storagepool_names(self):
+    return await self._get_names('v1', '/storage_pools/')
+
+  async def get_container_names(self):
+    return await self._get_names('v1', '/containers/')
+
+  async def get_network_names(self):
+    return await self._get_names('v2.0', '/networks/')
+
+  async def get_vm_names(self):
+    error_dict = {}
+    try:
+      # Paged like NutanixRestApiClient.get_vm_names. Large clusters time out listing all vms at once.
+      vm_names = []
+      async for page in self._iter_pages('vm', 500, '', error_dict):
+        for vm in page:
+          vm_names.append(vm['name'])
+      return (True, vm_names)
+
+    except Exception as exception:
+      self._handle_error(exception, error_dict)
+      return (False, error_dict)
+
+  async def get_image_names(self):
+    return await self._get_names('v0.8', '/images/')
+
+
+  ###
+  ### Container Operation
+  ###
+
+  async def get_container_info(self, name):
+    error_dict = {}
+    try:
+      cont = await self._find_entity('container', name=name, error_dict=error_dict)
+      if cont is None:
+        raise IntendedException('Error. Unable to find container "{}"'.format(name))
+      return (True, NutanixRestApiClient._make_container_info(cont))
+
+    except Exception as exception:
+      self._handle_error(exception, error_dict)
+      return (False, error_dict)
+
+  async def create_container(self, container_name, storagepool_name=''):
+    error_dict = {}
+    try:
+      response_dict = await self._send('GET', 'v1', '/storage_pools/', None, error_dict)
+      storagepool_uuid = NutanixRestApiClient._select_storagepool_uuid(response_dict['entities'], storagepool_name)
+      body_dict = NutanixRestApiClient._make_container_body(container_name, storagepool_uuid)
+      response_dict = await self._send('POST', 'v1', '/containers/', body_dict, error_dict)
+      self._entity_index.invalidate('container')
+      return (True, response_dict['value'])
+
+    except Exception as exception:
+      self._handle_error(exception, error_dict)
+      return (False, error_dict)
+
+  async def delete_container(self, name):
+    error_dict = {}
+    try:
+      cont = await self._find_entity('container', name=name, error_dict=error_dict)
+      if cont is None:
+        raise IntendedException('Error. Unable to find container "{}"'.format(name))
+      response_dict = await self._send('DELETE', 'v1', '/containers/{}'.format(cont['containerUuid']),
+        None, error_dict, allow_empty=True)
+      self._entity_index.invalidate('container')
+      return (True, response_dict['value'])
+
+    except Exception as exception:
+      self._handle_error(exception, error_dict)
+      return (False, error_dict)
+
+
+  ###
+  ### Network Operation
+  ###
+
+  async def get_network_info(self, name):
+    error_dict = {}
+    try:
+      network = await self._find_entity('network', name=name, error_dict=error_dict)
+      if network is None:
+        raise IntendedException('Error. Unable to find network "{}"'.format(name))
+      return (True, NutanixRestApiClient._make_network_info(network))
+
+    except Exception as exception:
+      self._handle_error(exception, error_dict)
+      return (False, error_dict)
+
+  async def create_network(self, name, vlan):
+    return await self._create_network(NutanixRestApiClient._make_network_body(name, vlan))
+
+  async def create_network_managed(self, name, vlan, network_address, prefix, gateway, pools, dns=''):
+    return await self._create_network(NutanixRestApiClient._make_network_body(
+      name, vlan, network_address, prefix, gateway, pools, dns))
+
+  async def _create_network(self, body_dict):
+    error_dict = {}
+    try:
+      response_dict = await self._send('POST', 'v2.0', '/networks/', body_dict, error_dict)
+      self._entity_index.invalidate('network')
+      return (True, response_dict['network_uuid'])
+
+    except Exception as exception:
+      self._handle_error(exception, error_dict)
+      return (False, error_dict)
+
+  async def is_network_used(self, name, force_refresh=False):
+    error_dict = {}
+    try:
+      network = await self._find_entity('network', name=name, error_dict=error_dict)
+      if network is None:
+        raise IntendedException('Error. Unable to find network "{}"'.format(name))
+      network_users = await self._get_network_users(force_refresh, error_dict)
+      return (True, network['uuid'] in network_users)
+
+    except Exception as exception:
+      self._handle_error(exception, error_dict)
+      return (False, error_dict)
+
+  async def get_network_usage(self, force_refresh=False):
+    error_dict = {}
+    try:
+      networks = await self._get_entities('network', force_refresh, error_dict)
+      network_users = await self._get_network_users(force_refresh, error_dict)
+      usage = {}
+      for network in networks:
+        usage[network['name']] = network_users.get(network['uuid'], [])
+      return (True, usage)
+
+    except Exception as exception:
+      self._handle_error(exception, error_dict)
+      return (False, error_dict)
+
+  async def _get_network_users(self, force_refresh, error_dict):
+    build = NutanixRestApiClient._make_network_users
+    if not force_refresh:
+      (found, network_users) = self._entity_index.derived('vm', 'network_users', build)
+      if found:
+        return network_users
+    await self._load_entities('vm', error_dict)
+    (found, network_users) = self._entity_index.derived('vm', 'network_users', build, check_ttl=False)
+    return network_users
+
+  async def delete_network(self, name):
+    error_dict = {}
+    try:
+      network = await self._find_entity('network', name=name, error_dict=error_dict)
+      if network is None:
+        raise IntendedException('Error. Unable to find network "{}"'.format(name))
+      await self._send('DELETE', 'v2.0', '/networks/{}'.format(network['uuid']), None, error_dict, allow_empty=True)
+      self._entity_index.invalidate('network')
+      return (True, None)
+
+    except Exception as exception:
+      self._handle_error(exception, error_dict)
+      return (False, error_dict)
+
+
+  ###
+  ### VM Operation
+  ###
+
+  async def get_vm_info(self, name):
+    error_dict = {}
+    try:
+      vm = await self._find_entity('vm', name=name, error_dict=error_dict)
+      if vm is None:
+        raise IntendedException('Error. Unable to find vm "{}"'.format(name))
+      return (True, NutanixRestApiClient._make_vm_info(vm))
+
+    except Exception as exception:
+      self._handle_error(exception, error_dict)
+      return (False, error_dict)
+
+  async def create_vm_from_image(self, name, memory_mb, num_vcpus, num_cores, image_name, network_name, ip_address=''):
+    error_dict = {}
+    try:
+      image = await self._find_entity('image', name=image_name, error_dict=error_dict)
+      if image is None:
+        raise IntendedException('Error. Unable to find image "{}"'.format(image_name))
+      network = await self._find_entity('network', name=network_name, error_dict=error_dict)
+      if network is None:
+        raise IntendedException('Error. Unable to find network "{}"'.format(network_name))
+
+      body_dict = NutanixRestApiClient._make_vm_from_image_body(name, memory_mb, num_vcpus, num_cores,
+        image['vm_disk_id'], image['vm_disk_size'], network['uuid'], ip_address)
+      response_dict = await self._send('POST', 'v2.0', '/vms/', body_dict, error_dict)
+      self._entity_index.invalidate('vm')
+      return (True, response_dict['task_uuid'])
+
+    except Exception as exception:
+      self._handle_error(exception, error_dict)
+      return (False, error_dict)
+
+
+  async def get_vm_disks(self, vm_name):
+    error_dict = {}
+    try:
+      vm = await self._find_entity('vm', name=vm_name, error_dict=error_dict)
+      if vm is None:
+        raise IntendedException('Error. Unable to find the vm "{}"'.format(vm_name))
+      return (True, NutanixRestApiClient._make_vm_disks(vm))
+
+    except Exception as exception:
+      self._handle_error(exception, error_dict)
+      return (False, error_dict)
+
+
+  ###
+  ### Image Operation
+  ###
+
+  async def upload_image(self, file_url, target_container, image_name):
+    error_dict = {}
+    try:
+      cont = await self._find_entity('container', name=target_container, error_dict=error_dict)
+      if cont is None:
+        raise IntendedException('Unable to find container "{}"'.format(target_container))
+      image_type = 'ISO_IMAGE' if file_url.lower().endswith('.iso') else 'DISK_IMAGE'
+      body_dict = NutanixRestApiClient._make_image_body(image_name, image_type, cont['containerUuid'], file_url)
+      response_dict = await self._send('POST', 'v0.8', '/images/', body_dict, error_dict)
+      self._entity_index.invalidate('image')
+      return (True, response_dict['taskUuid'])
+
+    except Exception as exception:
+      self._handle_error(exception, error_dict)
+      return (False, error_dict)
+
+  async def create_image_from_vm_vdisk(self, vm_name, vm_disk, target_container, image_name):
+    error_dict = {}
+    try:
+      vm = await self._find_entity('vm', name=vm_name, error_dict=error_dict)
+      (vdisk_uuid, source_container_uuid) = NutanixRestApiClient._find_vdisk(vm, vm_disk)
+      if vdisk_uuid == '':
+        raise IntendedException('Error: Unable to find VM "{}" which has vDisk "{}"'.format(vm_name, vm_disk))
+      source_cont = await self._find_entity('container', uuid=source_container_uuid, error_dict=error_dict)
+      if source_cont is None:
+        raise IntendedException('Error: Unable to find source container name from uuid="{}".'.format(source_container_uuid))
+      target_cont = await self._find_entity('container', name=target_container, error_dict=error_dict)
+      if target_cont is None:
+        raise IntendedException('Error: Unable to find container "{}"'.format(target_container))
+
+      nfs_url = 'nfs://127.0.0.1/{}/.acropolis/vmdisk/{}'.format(source_cont['name'], vdisk_uuid)
+      body_dict = NutanixRestApiClient._make_image_body(image_name, 'DISK_IMAGE', target_cont['containerUuid'], nfs_url)
+      response_dict = await self._send('POST', 'v0.8', '/images/', body_dict, error_dict)
+      self._entity_index.invalidate('image')
+      return (True, response_dict['taskUuid'])
+
+    except Exception as exception:
+      self._handle_error(exception, error_dict)
+      return (False, error_dict)
+
+  async def delete_image(self, name):
+    error_dict = {}
+    try:
+      image = await self._find_entity('image', name=name, error_dict=error_dict)
+      if image is None:
+        raise IntendedException('Error: Unable to find image "{}"'.format(name))
+      response_dict = await self._send('DELETE', 'v0.8', '/images/{}'.format(image['uuid']),
+        None, error_dict, allow_empty=True)
+      self._entity_index.invalidate('image')
+      return (True, response_dict['taskUuid'])
+
+    except Exception as exception:
+      self._handle_error(exception, error_dict)
+      return (False, error_dict)
+
+
+  ###
+  ### Task Operation
+  ###
+
+  async def get_task_status(self, task_uuid):
+    error_dict = {}
+    try:
+      response_dict = await self._send('GET', 'v0.8', '/tasks/{}'.format(task_uuid), None, error_dict)
+      return (True, NutanixRestApiClient._make_task_status(response_dict))
+
+    except Exception as exception:
+      self._handle_error(exception, error_dict)
+      return (False, error_dict)
+
+  async def get_tasks_status(self):
+    error_dict = {}
+    try:
+      response_dict = await self._send('GET', 'v0.8', '/tasks/?includeCompleted=false', None, error_dict)
+      task_list = []
+      for entity in response_dict['entities']:
+        task_list.append(NutanixRestApiClient._make_task_status(entity))
+      return (True, task_list)
+
+    except Exception as exception:
+      self._handle_error(exception, error_dict)
+      return (False, error_dict)
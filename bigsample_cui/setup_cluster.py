@@ -1,5 +1,4 @@
-from nutanix import NutanixRestApiClient
-import time
+from nutanix import NutanixRestApiClient, TaskWaiter
 import logging
 
 ###
@@ -134,18 +133,14 @@ class Utility:
         raise Exception('Error happens on deleting container "{}".'.format(existing_container))  
 
     # create containers which doesn't exist.
-    task_list = []
+    # Container creation ends in the API call. No task to wait.
     for container in containers:
       if container in existing_containers:
         continue
       print('   Creating container "{}"'.format(container))
-      (success, taskuuid) = session.create_container(container)
+      (success, _) = session.create_container(container)
       if not success:
         raise Exception('Error happens on creating container "{}".'.format(container))
-      task_list.append(taskuuid)
-
-    # wait till end
-    Utility.wait_tasks(session, task_list)
 
 
   @staticmethod
@@ -192,13 +187,13 @@ class Utility:
       network_names.append(network[0])
 
     # delete useless network
+    (success, network_usage) = session.get_network_usage()
+    if not success:
+      raise Exception('Error happens on getting network usage.')
     for existing_network in existing_networks:
       if existing_network in network_names:
         continue
-      (success, used) = session.is_network_used(existing_network)
-      if not success:
-        raise Exception('Error happens on getting existing networks.')
-      if used:
+      if len(network_usage.get(existing_network, [])) > 0:
         continue
 
       print('   Deleting useless network "{}"'.format(existing_network))
@@ -212,7 +207,7 @@ class Utility:
       raise Exception('Error happens on getting hypervisor.')
 
     # add new network
-    task_list = []
+    # Network creation ends in the API call. It returns network uuid, not task.
     for network in networks:
       name = network[0]
       if name in existing_networks:
@@ -221,55 +216,39 @@ class Utility:
       print('   Creating network "{}"'.format(name))
       if len(network) == 2:
         (name, vlan) = network
-        (success, taskuuid) = session.create_network(name, vlan)
+        (success, _) = session.create_network(name, vlan)
         if not success:
           raise Exception('Error happens on creating network "{}"'.format(name))
       else:
         (ip, vlan, network, prefix, gateway, pool, dns) = network
         if hypervisor != 'AHV':
-          (success, taskuuid) = session.create_network(name, vlan)
+          (success, _) = session.create_network(name, vlan)
           if not success:
             raise Exception('Error happens on creating network "{}"'.format(name))
         else:
-          (success, taskuuid) = session.create_network_managed(name, vlan, network, prefix, gateway, pool, dns)
+          (success, _) = session.create_network_managed(name, vlan, network, prefix, gateway, pool, dns)
           if not success:
             raise Exception('Error happens on creating network "{}"'.format(name))
 
-      task_list.append(taskuuid)
-
-    # wait till end
-    Utility.wait_tasks(session, task_list)
-
   @staticmethod
   def wait_tasks(session, uuids, interval=5):
-    first = True
-    while(True):
-      (success, tasks) = session.get_tasks_status()
-      if not success:
-        print(tasks)
-        continue
-        #raise Exception('Error happens on getting tasks status.')
-
-      finished = True
-      for task in tasks:
-        if task['uuid'] in uuids:
-          if first:
-            print('Wait till all tasks end. Polling interval {}s.'.format(interval))
-            first = False
-          print('{} {}% : {}'.format(task['method'], task['percent'], task['uuid']))
-          finished = False
-        else:
-          # Child or other task
-          pass
-
-      if finished:
-        break
-      else:
-        print('--')
-      time.sleep(interval)
-
-    if not first:
-      print('All tasks end.')
+    if len(uuids) == 0:
+      return
+    print('Wait till all tasks end. Polling interval {}s at most.'.format(interval))
+
+    def show_result(result):
+      print('{} {} : {}'.format(result['method'], result['status'], result['uuid']))
+
+    waiter = TaskWaiter(session, max_interval=interval)
+    for uuid in uuids:
+      waiter.add(uuid, callback=show_result)
+    results = waiter.wait_all()
+    print('All tasks end.')
+
+    # Failed, Aborted and Unknown(unable to confirm) tasks stop the setup.
+    failed_uuids = [uuid for (uuid, result) in results.items() if not result['succeeded']]
+    if len(failed_uuids) > 0:
+      raise Exception('Error happens on tasks "{}".'.format(failed_uuids))
 
 
 
@@ -0,0 +1,202 @@
+'''
+Test module for asynclog.py (Non-blocking file logging)
+
+Author: Yuichi Ito
+Email: yuichi.ito@nutanix.com
+'''
+
+if __name__ != '__main__':
+  print("Please don't import module \"test_asynclog\". It is only for testing.")
+  print('Abort.')
+  exit(1)
+
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import asynclog
+
+
+def log_path(name):
+  return os.path.join(tempfile.mkdtemp(), name)
+
+
+###
+### Tests
+###
+
+def test_write():
+  path = log_path('write.log')
+  logger = asynclog.create_logger('test_asynclog_write', path, logging.DEBUG, '%(levelname)s %(message)s')
+  logger.info('hello %s', 'world')
+  try:
+    raise ValueError('boom')
+  except ValueError:
+    logger.exception('failed')
+  logger.handlers[0].flush()
+  text = open(path).read()
+  print(text)
+  assert 'INFO hello world' in text
+  assert 'ValueError: boom' in text
+
+
+def test_create_logger_twice():
+  # Re-login calls create_logger again. Lines must not be duplicated.
+  path = log_path('twice.log')
+  for i in range(3):
+    logger = asynclog.create_logger('test_asynclog_twice', path)
+  logger.info('once')
+  logger.handlers[0].flush()
+  print(len(logger.handlers), open(path).read().count('once'))
+  assert len(logger.handlers) == 1
+  assert open(path).read().count('once') == 1
+
+  other_path = log_path('other.log')
+  logger = asynclog.create_logger('test_asynclog_twice', other_path)
+  logger.info('moved')
+  logger.handlers[0].flush()
+  assert len(logger.handlers) == 1
+  assert 'moved' in open(other_path).read()
+  assert 'moved' not in open(path).read()
+
+
+def test_drop_when_full():
+  # Writer is held. Records over queue_size are dropped, not waited for.
+  path = log_path('drop.log')
+  logger = asynclog.create_logger('test_asynclog_drop', path, queue_size=10)
+  handler = logger.handlers[0]
+  gate = threading.Event()
+  class Blocked:
+    # Has log_size(). So formatted by the writer, not by the caller.
+    def log_size(self):
+      return 7
+    def __str__(self):
+      gate.wait()
+      return 'blocked'
+  logger.info('%s', Blocked())
+  time.sleep(0.1)
+  start = time.perf_counter()
+  for i in range(100):
+    logger.info('line %d', i)
+  elapsed = time.perf_counter() - start
+  gate.set()
+  handler.flush()
+  print(handler.stats(), '{:.1f}ms'.format(elapsed * 1000))
+  assert handler.dropped == 90
+  assert elapsed < 0.1
+  logger.info('after')
+  handler.flush()
+  assert '90 log records were dropped' in open(path).read()
+
+
+def test_drop_when_bytes_full():
+  # Writer is held. Records are dropped when queued args exceed queue_bytes.
+  path = log_path('drop_bytes.log')
+  logger = asynclog.create_logger('test_asynclog_drop_bytes', path, queue_bytes=10000)
+  handler = logger.handlers[0]
+  gate = threading.Event()
+  class Blocked:
+    # Has log_size(). So formatted by the writer, not by the caller.
+    def log_size(self):
+      return 7
+    def __str__(self):
+      gate.wait()
+      return 'blocked'
+  class Body:
+    def log_size(self):
+      return 3000
+    def __str__(self):
+      return 'body'
+  logger.info('%s', Blocked())
+  time.sleep(0.1)
+  for i in range(10):
+    logger.info('%s', Body())
+  print(handler.stats())
+  assert handler.stats()['queued_bytes'] <= 10000
+  assert handler.dropped == 7
+  gate.set()
+  handler.flush()
+  assert handler.stats()['queued_bytes'] == 0
+
+  # One record bigger than queue_bytes is still written if the queue is empty.
+  logger.info('%s', 'x' * 20000)
+  handler.flush()
+  assert handler.dropped == 7
+  assert 'x' * 20000 in open(path).read()
+
+
+def test_rotation():
+  path = log_path('rotate.log')
+  logger = asynclog.create_logger('test_asynclog_rotate', path, max_bytes=1024, backup_count=2)
+  for i in range(200):
+    logger.info('x' * 50)
+  logger.handlers[0].flush()
+  files = sorted(os.listdir(os.path.dirname(path)))
+  print(files)
+  assert files == ['rotate.log', 'rotate.log.1', 'rotate.log.2']
+  assert os.path.getsize(path) <= 1024
+
+
+def test_format_in_caller():
+  # Args are merged into the message by the caller. Later changes aren't logged.
+  # Args with log_size() are left to the writer.
+  path = log_path('format.log')
+  logger = asynclog.create_logger('test_asynclog_format', path)
+  handler = logger.handlers[0]
+  gate = threading.Event()
+  class Body:
+    formatted = 0
+    def log_size(self):
+      return 4
+    def __str__(self):
+      gate.wait()
+      Body.formatted += 1
+      return 'body'
+  logger.info('%s', Body())
+  values = ['before']
+  logger.info('values %s', values)
+  values[0] = 'after'
+  assert Body.formatted == 0
+  gate.set()
+  handler.flush()
+  text = open(path).read()
+  print(text)
+  assert Body.formatted == 1
+  assert 'values [\'before\']' in text and 'after' not in text
+
+
+def test_errors():
+  # Broken records are reported by handleError() and counted. Others are still written.
+  path = log_path('errors.log')
+  logger = asynclog.create_logger('test_asynclog_errors', path)
+  handler = logger.handlers[0]
+  reported = []
+  handler.handleError = reported.append
+  class Broken:
+    def log_size(self):
+      return 6
+    def __str__(self):
+      raise ValueError('broken')
+  logger.info('%d', 'not a number')
+  logger.info('%s', Broken())
+  logger.info('still written')
+  handler.flush()
+  stats = handler.stats()
+  print(stats, reported)
+  assert len(reported) == 2
+  assert stats['errors'] == 1 and stats['written'] == 1
+  assert 'still written' in open(path).read()
+
+
+if __name__ == '__main__':
+  print('Test start')
+  test_write()
+  test_create_logger_twice()
+  test_drop_when_full()
+  test_drop_when_bytes_full()
+  test_rotation()
+  test_format_in_caller()
+  test_errors()
+  print('Test end')
@@ -10,7 +10,7 @@ if __name__ != '__main__':
   print('Abort.')
   exit(1)
 
-from consoleview import ConsoleView
+from consoleview import ConsoleView, PrefixIndex, NameSearch, SearchFilter, FrameRenderer, _Shared
 KEY_ENTER = ConsoleView.KEY_ENTER
 KEY_ESC = ConsoleView.KEY_ESC
 KEY_TAB = ConsoleView.KEY_TAB
@@ -18,6 +18,8 @@ show_text_input_form = ConsoleView.show_text_input_form
 autocomplete = ConsoleView.autocomplete
 
 import logging
+import random
+import time
 TEST_LOG_NAME = 'test.log'
 TEST_LOG_LEVEL = logging.DEBUG
 TEST_LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s :%(message)s'
@@ -30,7 +32,224 @@ def test_autocomplete():
   candidates = ['abcdef', 'abd', 'abcd']
   new_text = autocomplete(text, candidates, debug=True)
 
+def test_prefix_index():
+  index = PrefixIndex(['abcdef', 'abd', 'abcd'])
+  for (text, expected) in [('', 'ab'), ('a', 'ab'), ('abx', 'abx'), ('abd', 'abd'), ('abc', 'abcd'), ('abcde', 'abcdef')]:
+    result = autocomplete(text, index)
+    print(repr(text), repr(result))
+    assert result == expected
+  assert index.names('abc') == ['abcd', 'abcdef']
+  assert index.count('ab') == 3
+
+  index.add('abce')
+  index.remove('abd')
+  print(list(index))
+  assert list(index) == ['abcd', 'abcdef', 'abce']
+  assert index.complete('') == 'abc'
+  assert 'abd' not in index
+
+def test_name_search():
+  names = ['web-01', 'web-02', 'db-web-cache', 'Db-Main', 'worker-eb', 'app-01']
+  search = NameSearch(names)
+  # Prefix matches first, then substring, then fuzzy.
+  (total, result) = search.search('web')
+  print('web', total, result)
+  assert result == ['web-01', 'web-02', 'db-web-cache', 'worker-eb']
+  (total, result) = search.search('DB')
+  print('DB', total, result)
+  assert result == ['Db-Main', 'db-web-cache']
+  (total, result) = search.search('wb')
+  print('wb', total, result)
+  # Fewer skipped chars first.
+  assert result == ['db-web-cache', 'web-01', 'web-02', 'worker-eb']
+  assert search.search('xyz') == (0, [])
+  assert search.search('web', limit=2, offset=1) == (4, ['web-02', 'db-web-cache'])
+
+  # Same result when typed one char at a time.
+  for text in ['d', 'db', 'db-', 'db-m']:
+    print(text, search.search(text))
+  assert search.search('db-m') == NameSearch(names).search('db-m')
+
+
+def test_name_search_incremental():
+  # Typed one char at a time gives the same result as a new NameSearch.
+  # 'ten' has enough matches to skip fuzzy. 'tenx' must still find fuzzy ones.
+  names = ['tenant-1', 'tenant-2', 'tenant-3', 't-e-n-x']
+  search = NameSearch(names, fuzzy_below=3)
+  print(search.search('ten'), search.search('tenx'))
+  assert search.search('ten') == (3, ['tenant-1', 'tenant-2', 'tenant-3'])
+  assert search.search('tenx') == (1, ['t-e-n-x'])
+
+  random.seed(0)
+  names = ['{}-{}-{}'.format(random.choice(['web', 'db', 'app', 'tenant']),
+    random.choice(['prod', 'dev']), random.randint(0, 300)) for i in range(500)]
+  for max_fuzzy in [1000, 5]:
+    search = NameSearch(names, fuzzy_below=10, max_fuzzy=max_fuzzy)
+    for i in range(200):
+      query = ''.join(random.choice('abdeinoprtvw-0123') for j in range(random.randint(1, 6)))
+      for k in range(1, len(query) + 1):
+        result = search.search(query[:k], limit=len(names))
+        assert result == NameSearch(names, 10, max_fuzzy).search(query[:k], limit=len(names)), query[:k]
+
+
+def test_search_filter():
+  names = ['vm-{:03d}'.format(i) for i in range(25)]
+  search_filter = SearchFilter(NameSearch(names), page_size=10)
+  search_filter.set_text('01')
+  print(search_filter.total, search_filter.page_names())
+  assert search_filter.total == 11
+  assert search_filter.page_names()[0] == 'vm-001'
+  search_filter.set_text('vm')
+  search_filter.move_page(2)
+  assert search_filter.page_names() == names[20:]
+
+
+class FakeWindow:
+  # Records what FrameRenderer writes. No terminal needed.
+  def __init__(self, height=5, width=20):
+    self.size = (height, width)
+    self.calls = []
+  def getmaxyx(self):
+    return self.size
+  def addstr(self, y, x, text, attr=0):
+    self.calls.append(('addstr', y, x, text))
+  def move(self, y, x):
+    self.calls.append(('move', y, x))
+  def clrtoeol(self):
+    self.calls.append(('clrtoeol',))
+  def erase(self):
+    self.calls.append(('erase',))
+  def refresh(self):
+    self.calls.append(('refresh',))
+
+
+def test_frame_renderer():
+  window = FakeWindow()
+  renderer = FrameRenderer(window)
+  def draw(progress, warning=''):
+    frame = renderer.new_frame()
+    frame.addstr(0, 0, '1. VM name : vm1')
+    frame.addstr(1, 0, '9. Progress {}%'.format(progress))
+    if warning != '':
+      frame.addstr(2, 0, warning)
+    window.calls = []
+    renderer.render(frame)
+    print(window.calls)
+    return window.calls
+
+  calls = draw(10)
+  assert calls[0] == ('erase',) and calls[-1] == ('refresh',)
+  # Same frame. Nothing is written and not refreshed.
+  assert draw(10) == []
+  # Only changed cells.
+  assert draw(20) == [('addstr', 1, 12, '2'), ('refresh',)]
+  assert draw(100) == [('addstr', 1, 12, '100%'), ('refresh',)]
+  assert draw(100, 'Warning') == [('addstr', 2, 0, 'Warning'), ('refresh',)]
+  assert draw(5) == [('addstr', 1, 12, '5%'), ('move', 1, 14), ('clrtoeol',), ('move', 2, 0), ('clrtoeol',), ('refresh',)]
+  stats = renderer.stats()
+  print(stats)
+  assert stats['frames'] == 6 and stats['skipped'] == 1
+
+  # Drawn by others. All is written again.
+  renderer.invalidate()
+  assert draw(5)[0] == ('erase',)
+
+
+def test_frame_drawing():
+  # addch and clrtoeol are kept in the frame. Other drawing methods are not
+  # passed to the window, since it would be overwritten by the next render.
+  class BorderWindow(FakeWindow):
+    def border(self, *args):
+      self.calls.append(('border',))
+    def hline(self, *args):
+      self.calls.append(('hline',))
+  window = BorderWindow()
+  renderer = FrameRenderer(window)
+  frame = renderer.new_frame()
+  frame.addstr(0, 0, 'abcdef')
+  frame.addch(0, 1, 'X')
+  frame.addch(ord('Y'), 1)
+  frame.move(0, 4)
+  frame.clrtoeol()
+  frame.addch(1, 0, '-')
+  print(frame.snapshot())
+  assert frame.snapshot() == {0 : ('aXYd', (0, 0, 1, 0)), 1 : ('-', None)}
+  for name in ['border', 'hline']:
+    assert not hasattr(frame, name)
+    try:
+      getattr(frame, name)()
+      assert False
+    except AttributeError as e:
+      print(e)
+  assert window.calls == []
+  frame.refresh()
+  assert window.calls == [('refresh',)]
+
+
+def test_shared():
+  import os
+  import threading
+  shared = _Shared()
+  (wake_r, wake_w) = os.pipe()
+  shared._add_wake_fd(wake_w)
+  shared.task_percent = 0
+  version = shared.get_version()
+  # Same value. Not a change.
+  shared.task_percent = 0
+  assert shared.get_version() == version
+  shared.task_percent = 10
+  assert shared.get_version() == version + 1
+  with shared.batch():
+    shared.task_status = 'Running'
+    shared.task_percent = 20
+  assert shared.get_version() == version + 2
+  assert os.read(wake_r, 100) == b'\0' * 3
+  print(shared)
+
+  # Wait from another thread.
+  def worker():
+    time.sleep(0.1)
+    shared.task_percent = 100
+  threading.Thread(target=worker).start()
+  start = time.perf_counter()
+  new_version = shared.wait_change(shared.get_version(), timeout=5)
+  print(new_version, '{:.1f}ms'.format((time.perf_counter() - start) * 1000))
+  assert shared.task_percent == 100
+  shared._remove_wake_fd(wake_w)
+
+
+def test_start_cleanup():
+  # UI loop ended by KeyboardInterrupt still restores SIGWINCH handler and closes its pipe.
+  import os
+  import signal
+  class InterruptedWindow(FakeWindow):
+    def timeout(self, delay):
+      pass
+    def getkey(self):
+      raise KeyboardInterrupt()
+  view = ConsoleView()
+  view.add_fun_showtop(lambda shared, stdscr, warning, logger: stdscr.addstr(0, 0, 'top'))
+  previous_handler = signal.getsignal(signal.SIGWINCH)
+  num_fds = len(os.listdir('/proc/self/fd'))
+  try:
+    view._start(InterruptedWindow(), False)
+    assert False
+  except KeyboardInterrupt:
+    pass
+  print(signal.getsignal(signal.SIGWINCH), view._shared._wake_fds)
+  assert signal.getsignal(signal.SIGWINCH) == previous_handler
+  assert view._shared._wake_fds == []
+  assert len(os.listdir('/proc/self/fd')) == num_fds
+
 
 if __name__ == '__main__':
   logging.basicConfig(filename=TEST_LOG_NAME, level=TEST_LOG_LEVEL, format=TEST_LOG_FORMAT)
+  test_prefix_index()
+  test_name_search()
+  test_name_search_incremental()
+  test_search_filter()
+  test_frame_renderer()
+  test_frame_drawing()
+  test_shared()
+  test_start_cleanup()
   test_autocomplete()
\ No newline at end of file
@@ -34,6 +34,8 @@ def get_initialized_view():
   view.add_fun_init(init)
   view.add_fun_util('clear_session', clear_session)
   view.add_fun_util('clear_task', clear_task)
+  view.add_fun_util('get_name_index', get_name_index)
+  view.add_fun_util('get_name_search', get_name_search)
   view.add_fun_thread(poll_task, 1)
   view.add_fun_showtop(showtop)
   view.add_fun_keycalled('1', show_input_ip)
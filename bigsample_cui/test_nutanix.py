@@ -30,6 +30,123 @@ CLUSTER_PASSWORD = 'Nutanix/4u!'
 def test_login():
   session = NutanixRestApiClient(CLUSTER_IP, CLUSTER_USER, CLUSTER_PASSWORD)
 
+def test_login_compact_log():
+  logger = NutanixRestApiClient.create_logger('test_rest_compact.log', logging.INFO)
+  session = NutanixRestApiClient(CLUSTER_IP, CLUSTER_USER, CLUSTER_PASSWORD, logger,
+    log_format='compact', log_body_limit=4096)
+  session.get_vm_names()
+
+def test_login_json_backend():
+  for backend in ['json', 'auto']:
+    session = NutanixRestApiClient(CLUSTER_IP, CLUSTER_USER, CLUSTER_PASSWORD, json_backend=backend)
+    result = session.get_cluster_name()
+    print(backend, result)
+
+def test_login_pool_warmup():
+  session = NutanixRestApiClient(CLUSTER_IP, CLUSTER_USER, CLUSTER_PASSWORD,
+    pool_maxsize=16, pool_block=True, warmup_connections=8)
+  print(session.get_pool_stats())
+
+
+def test_login_session_auth():
+  session = NutanixRestApiClient(CLUSTER_IP, CLUSTER_USER, CLUSTER_PASSWORD, auth_mode='session')
+  for i in range(10):
+    session.get_cluster_name()
+  print(session.get_auth_stats())
+
+def test_login_lazy():
+  session = NutanixRestApiClient(CLUSTER_IP, CLUSTER_USER, CLUSTER_PASSWORD, lazy=True)
+  session.validate()
+  result = session.get_cluster_name()
+  print(result)
+
+###
+### Connection Pool
+###
+
+def test_get_pool_stats(session):
+  session.get_vm_names()
+  session.get_image_names()
+  result = session.get_pool_stats()
+  print(result)
+
+
+###
+### Request Coalescing
+###
+
+def test_get_coalesce_stats(session):
+  import threading
+  workers = [threading.Thread(target=session.get_tasks_status) for i in range(10)]
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+  result = session.get_coalesce_stats()
+  print(result)
+
+
+###
+### Metrics
+###
+
+def test_metrics(session):
+  session.get_vm_names()
+  session.get_vm_info('rest_test')
+  session.get_task_status('00000000-0000-0000-0000-000000000000')
+  for (key, stats) in session.metrics().items():
+    print(key, stats['count'], stats['errors'], stats['p50'], stats['p99'])
+  print(session.metrics_prometheus())
+
+
+###
+### Hooks
+###
+
+def test_hooks(session):
+  def before_request(info):
+    print('>', info['method'], info['url'])
+  def after_response(info):
+    print('<', info['status'], '{:.1f}ms'.format(info['latency'] * 1000), info['size_in'])
+  session.add_hook('before_request', before_request)
+  session.add_hook('after_response', after_response)
+  session.get_vm_names()
+  session.remove_hook('before_request', before_request)
+  session.remove_hook('after_response', after_response)
+  print(session.get_hook_stats())
+
+
+###
+### Retry
+###
+
+def test_get_retry_stats(session):
+  session.get_vm_names()
+  result = session.get_retry_stats()
+  print(result)
+
+
+###
+### Entity Index
+###
+
+def test_entity_cache(session):
+  session.clear_entity_cache()
+  session.get_vm_info('rest_test')
+  session.get_vm_disks('rest_test')
+  session.get_container_info('container')
+  session.get_container_info('container')
+  result = session.get_entity_cache_stats()
+  print(result)
+
+def test_entity_lookup_mode():
+  for lookup_mode in ['filter', 'list']:
+    session = NutanixRestApiClient(CLUSTER_IP, CLUSTER_USER, CLUSTER_PASSWORD, lookup_mode=lookup_mode)
+    session.get_vm_disks('rest_test')
+    session.get_container_info('container')
+    result = session.get_entity_cache_stats()
+    print(lookup_mode, result)
+
 
 ###
 ### Cluster
@@ -37,6 +154,7 @@ def test_login():
 
 def test_cluster_all(session):
   test_get_cluster_info(session)
+  test_get_cluster_info_force_refresh(session)
   test_get_cluster_name(session)
   test_get_hypervisor(session)
   test_get_version(session)
@@ -51,6 +169,10 @@ def test_get_cluster_info(session):
   result = session.get_cluster_info()
   print(result)
 
+def test_get_cluster_info_force_refresh(session):
+  result = session.get_cluster_info(force_refresh=True)
+  print(result)
+
 def test_get_cluster_name(session):
   result = session.get_cluster_name()
   print(result)
@@ -143,6 +265,10 @@ def test_is_network_used(session):
   result = session.is_network_used('vlan.0')
   print(result)
 
+def test_get_network_usage(session):
+  result = session.get_network_usage()
+  print(result)
+
 def test_create_network_managed(session):
   result = session.create_network_managed('Net-10.149', 0, '10.149.0.0', 17, '10.149.0.1', [('10.149.27.50', '10.149.27.199')], '8.8.8.8')
   print(result)
@@ -165,14 +291,38 @@ def test_get_vm_names(session):
   result = session.get_vm_names()
   print(result)
 
+def test_iter_vms(session):
+  num_vms = 0
+  for vm in session.iter_vms(page_size=50, prefetch=True):
+    num_vms += 1
+  print(num_vms)
+
+def test_iter_vms_stream(session):
+  for vm in session.iter_vms(page_size=None, stream=True, fields=['name', 'uuid', 'power_state']):
+    print(vm)
+
 def test_get_vm_info(session):
   result = session.get_vm_info('rest_test')
   print(result)
 
+def test_get_vm_info_as_record(session):
+  (success, vm) = session.get_vm_info('rest_test', as_record=True)
+  print(success, vm)
+  if success:
+    print(vm.name, vm['power_state'], [disk.label for disk in vm.disks])
+
 def test_create_vm_from_image(session):
   result = session.create_vm_from_image('rest_test', 2048, 1, 2, 'REST_CENT7_IMG', 'REST_NETWORK')
   print(result)
 
+def test_create_vms_from_image(session):
+  specs = []
+  for i in range(10):
+    specs.append({'name':'rest_test_{}'.format(i), 'memory_mb':2048, 'num_vcpus':1, 'num_cores':2,
+      'image_name':'REST_CENT7_IMG', 'network_name':'REST_NETWORK'})
+  result = session.create_vms_from_image(specs, max_workers=4, wait=True, wait_timeout=600)
+  print(result)
+
 
 ###
 ### vDisk
@@ -224,10 +374,19 @@ def test_get_task_status(session):
   result = session.get_task_status(TASK_UUID)
   print(result)
 
+def test_iter_tasks(session):
+  for task in session.iter_tasks(page_size=20, include_completed=False):
+    print(task)
+
 def test_get_tasks_status(session):
   result = session.get_tasks_status()
   print(result)
 
+def test_wait_tasks(session):
+  (success, task_uuid) = session.upload_image('nfs://10.149.245.50/Public/bootcamp/centos7_min_raw', 'container', 'cent7-image-rest3')
+  result = session.wait_tasks([task_uuid], timeout=600, callback=print)
+  print(result)
+
 if __name__ == '__main__':
   logger = NutanixRestApiClient.create_logger('test_rest.log', logging.DEBUG)
   session = NutanixRestApiClient(CLUSTER_IP, CLUSTER_USER, CLUSTER_PASSWORD, logger)
@@ -0,0 +1,246 @@
+'''
+Test module for nutanix_async.py (Asyncio Python REST API wrapper)
+Runs against local stand-in server "mock_prism.py". No cluster needed.
+
+Author: Yuichi Ito
+Email: yuichi.ito@nutanix.com
+'''
+
+if __name__ != '__main__':
+  print("Please don't import module \"test_nutanix_async\". It is only for testing.")
+  print('Abort.')
+  exit(1)
+
+import asyncio
+import logging
+import time
+TEST_LOG_NAME = 'test.log'
+TEST_LOG_LEVEL = logging.DEBUG
+TEST_LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s :%(message)s'
+
+from nutanix import NutanixRestApiClient, RetryPolicy
+from nutanix_async import AsyncNutanixRestApiClient
+from mock_prism import MockPrism
+
+# PARAM FOR SESSION
+CLUSTER_USER = 'admin'
+CLUSTER_PASSWORD = 'Nutanix/4u!'
+
+
+def make_client(mock, **kwargs):
+  return AsyncNutanixRestApiClient('127.0.0.1', CLUSTER_USER, CLUSTER_PASSWORD,
+    port=mock.port, use_https=False, **kwargs)
+
+
+###
+### Tests
+###
+
+async def test_get_cluster_name(mock):
+  async with make_client(mock) as session:
+    result = await session.get_cluster_name()
+    print(result)
+    assert result == (True, 'mock-cluster')
+
+
+async def test_cluster_snapshot(mock):
+  # Login document is the first snapshot. Concurrent getters of an old one download it once.
+  async with make_client(mock, cluster_info_max_age=0.2) as session:
+    mock.reset_stats()
+    results = await session.gather(session.get_cluster_name(), session.get_version(), session.get_hypervisor())
+    assert all(success for (success, _) in results)
+    assert mock.num_requests == 0
+    await asyncio.sleep(0.2)
+    results = await session.gather(*[session.get_cluster_name() for i in range(5)])
+    print(results[0], mock.num_requests)
+    assert mock.num_requests == 1
+    await session.get_cluster_name(force_refresh=True)
+    assert mock.num_requests == 2
+
+
+async def test_get_vm_names(mock):
+  async with make_client(mock) as session:
+    (success, vms) = await session.get_vm_names()
+    print(success, len(vms))
+    assert success and len(vms) == len(mock.vms)
+
+    # Paged. Same names in the same order as the sync client.
+    mock.reset_stats()
+    paged = []
+    async for page in session._iter_pages('vm', 30, '', {}):
+      paged += [vm['name'] for vm in page]
+    print(mock.requests)
+    assert paged == vms
+    assert mock.num_requests == (len(mock.vms) + 29) // 30
+    assert all('offset=' in request and 'length=30' in request for request in mock.requests)
+    (_, sync_vms) = NutanixRestApiClient('127.0.0.1', CLUSTER_USER, CLUSTER_PASSWORD,
+      port=mock.port, use_https=False).get_vm_names()
+    assert paged == sync_vms
+
+
+async def test_get_vm_info_not_found(mock):
+  async with make_client(mock) as session:
+    (success, error_dict) = await session.get_vm_info('no-such-vm')
+    print(success, error_dict)
+    assert not success and 'error' in error_dict
+
+
+async def test_entity_cache_ttl_zero(mock):
+  # ttl 0 disables the cache. Every lookup downloads again and still finds the vm.
+  async with make_client(mock, entity_cache_ttl=0) as session:
+    mock.reset_stats()
+    for i in range(3):
+      (success, vm_info) = await session.get_vm_info('vm-00003')
+      assert success and vm_info['name'] == 'vm-00003'
+    print(session.get_entity_cache_stats())
+    assert mock.num_requests == 3
+
+
+async def test_cluster_getters(mock):
+  async with make_client(mock) as session:
+    results = await session.gather(session.get_name_servers(), session.get_ntp_servers(),
+      session.get_block_serials(), session.get_num_nodes(),
+      session.get_desired_redundancy_factor(), session.get_current_redundancy_factor())
+    print(results)
+    assert results == [(True, ['8.8.8.8']), (True, ['ntp.example.com']), (True, ['MOCK-BLOCK']),
+      (True, 3), (True, 2), (True, 2)]
+
+
+async def test_same_results_as_sync(mock):
+  # Read operations return the same as NutanixRestApiClient.
+  sync_session = NutanixRestApiClient('127.0.0.1', CLUSTER_USER, CLUSTER_PASSWORD,
+    port=mock.port, use_https=False)
+  async with make_client(mock) as session:
+    for (name, args) in [('get_storagepool_names', ()), ('get_container_info', ('container',)),
+      ('get_network_info', ('network-1',)), ('get_vm_disks', ('vm-00001',)),
+      ('is_network_used', ('network-1',)), ('get_network_usage', ())]:
+      result = await getattr(session, name)(*args)
+      print(name, result[0])
+      assert result == getattr(sync_session, name)(*args)
+
+
+async def test_create_delete(mock):
+  async with make_client(mock) as session:
+    results = await session.gather(
+      session.create_container('async-container'),
+      session.create_network('async-net', 100),
+      session.create_network_managed('async-net-managed', 101, '10.0.0.0', 24, '10.0.0.1',
+        [('10.0.0.10', '10.0.0.20')], '8.8.8.8'),
+      session.upload_image('nfs://127.0.0.1/image.iso', 'container', 'async-image'),
+      session.create_image_from_vm_vdisk('vm-00001', 'scsi.0', 'container', 'async-image2'))
+    print(results)
+    assert all(success for (success, _) in results)
+    results = await session.gather(
+      session.delete_network('async-net'),
+      session.delete_image('image-0'),
+      session.delete_container('NutanixManagementShare'))
+    print(results)
+    assert all(success for (success, _) in results)
+    (success, names) = await session.get_network_names()
+    assert 'async-net' not in names and 'async-net-managed' in names
+
+    (success, error_dict) = await session.create_image_from_vm_vdisk('vm-00001', 'scsi.9', 'container', 'x')
+    assert not success
+
+
+async def test_create_vms_concurrently(mock):
+  # 20 creations at once. Image and network lists are downloaded only once each.
+  async with make_client(mock, max_concurrency=4) as session:
+    mock.reset_stats()
+    results = await session.gather(*[
+      session.create_vm_from_image('async-vm-{}'.format(i), 1024, 1, 1, 'image-0', 'network-0')
+      for i in range(20)])
+    print(results[0], mock.num_requests)
+    assert all(success for (success, _) in results)
+    assert mock.num_requests == 22
+
+    (success, task_dict) = await session.get_task_status(results[0][1])
+    print(task_dict)
+    assert success
+
+
+async def test_retry(mock):
+  # Same RetryPolicy as the sync client. GET retried on 5xx and reset, POST is not.
+  # (aiohttp itself resends an idempotent request once if a reused keep-alive
+  # connection is reset. So resets of GET are checked by the result only.)
+  policy = RetryPolicy(max_attempts=3, backoff_base=0.001, backoff_max=0.01)
+  async with make_client(mock, retry_policy=policy) as session:
+    mock.reset_stats()
+    mock.inject_faults([503, 503])
+    (success, _) = await session.get_network_names()
+    print(success, mock.requests, session.get_retry_stats())
+    assert success and mock.num_requests == 3
+    mock.inject_faults(['reset', 503])
+    (success, _) = await session.get_network_names()
+    assert success
+
+    mock.reset_stats()
+    mock.inject_faults([503] * 5)
+    (success, error_dict) = await session.get_network_names()
+    assert not success and error_dict['code'] == 503
+    assert mock.num_requests == 3
+    mock.clear_faults()
+
+    # Image and network are in the entity index. Faults hit the POST.
+    (success, _) = await session.create_vm_from_image('retry-vm', 1024, 1, 1, 'image-0', 'network-0')
+    assert success
+    for fault in [503, 'reset']:
+      mock.reset_stats()
+      mock.inject_faults([fault])
+      (success, _) = await session.create_vm_from_image('retry-vm', 1024, 1, 1, 'image-0', 'network-0')
+      assert not success and mock.num_requests == 1
+    stats = session.get_retry_stats()
+    print(stats)
+    assert stats['give_ups'] == 1
+
+
+async def test_retry_budget(mock):
+  policy = RetryPolicy(max_attempts=10, backoff_base=0.001, backoff_max=0.01, budget=2, budget_ratio=0)
+  async with make_client(mock, retry_policy=policy) as session:
+    mock.reset_stats()
+    mock.inject_faults([503] * 5)
+    (success, _) = await session.get_network_names()
+    assert not success and mock.num_requests == 3
+    mock.clear_faults()
+    assert session.get_retry_stats()['budget_exhausted'] == 1
+
+
+async def test_concurrency_speedup(mock):
+  # Each request takes 0.05s on the server side.
+  mock.latency = 0.05
+  try:
+    async with make_client(mock, max_concurrency=10) as session:
+      start = time.time()
+      results = await session.gather(*[session.get_cluster_name(force_refresh=True) for i in range(20)])
+      elapsed = time.time() - start
+    print('20 requests in {:.2f}s'.format(elapsed))
+    assert all(success for (success, _) in results)
+    assert elapsed < 20 * 0.05
+  finally:
+    mock.latency = 0
+
+
+async def main():
+  mock = MockPrism(num_vms=200).start()
+  try:
+    await test_get_cluster_name(mock)
+    await test_cluster_snapshot(mock)
+    await test_get_vm_names(mock)
+    await test_get_vm_info_not_found(mock)
+    await test_entity_cache_ttl_zero(mock)
+    await test_cluster_getters(mock)
+    await test_same_results_as_sync(mock)
+    await test_create_delete(mock)
+    await test_create_vms_concurrently(mock)
+    await test_retry(mock)
+    await test_retry_budget(mock)
+    await test_concurrency_speedup(mock)
+  finally:
+    mock.stop()
+
+
+if __name__ == '__main__':
+  logging.basicConfig(filename=TEST_LOG_NAME, level=TEST_LOG_LEVEL, format=TEST_LOG_FORMAT)
+  print('Test start')
+  asyncio.run(main())
+  print('Test end')
@@ -0,0 +1,807 @@
+'''
+Test module for nutanix.py (Python REST API wrapper)
+Runs against local stand-in server "mock_prism.py". No cluster needed.
+
+Author: Yuichi Ito
+Email: yuichi.ito@nutanix.com
+'''
+
+if __name__ != '__main__':
+  print("Please don't import module \"test_nutanix_mock\". It is only for testing.")
+  print('Abort.')
+  exit(1)
+
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+TEST_LOG_NAME = 'test.log'
+TEST_LOG_LEVEL = logging.DEBUG
+TEST_LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s :%(message)s'
+
+import requests
+from urllib3.exceptions import NewConnectionError, ReadTimeoutError
+
+from nutanix import NutanixRestApiClient, RetryPolicy, RequestMetrics, TaskWaiter
+from nutanix import _JsonEntityStream, _LazyRestBody, _RequestHooks, _SingleFlight
+from mock_prism import MockPrism
+
+# PARAM FOR SESSION
+CLUSTER_USER = 'admin'
+CLUSTER_PASSWORD = 'Nutanix/4u!'
+
+
+def make_client(mock, **kwargs):
+  return NutanixRestApiClient('127.0.0.1', CLUSTER_USER, CLUSTER_PASSWORD,
+    port=mock.port, use_https=False, **kwargs)
+
+
+###
+### Entity index
+###
+
+def test_entity_cache_ttl_zero(mock):
+  # ttl 0 disables the cache. Every lookup downloads again and still finds the entity.
+  for lookup_mode in ['filter', 'list']:
+    session = make_client(mock, entity_cache_ttl=0, lookup_mode=lookup_mode)
+    mock.reset_stats()
+    for i in range(3):
+      (success, vm_info) = session.get_vm_info('vm-00003')
+      print(lookup_mode, success, vm_info['name'] if success else vm_info)
+      assert success and vm_info['name'] == 'vm-00003'
+      (success, network_info) = session.get_network_info('network-1')
+      assert success and network_info['name'] == 'network-1'
+    assert mock.num_requests == 6
+
+def test_entity_cache_ttl(mock):
+  # Within ttl, the list is downloaded only once.
+  session = make_client(mock, entity_cache_ttl=30, lookup_mode='list')
+  mock.reset_stats()
+  for i in range(3):
+    (success, _) = session.get_network_info('network-1')
+    assert success
+  print(session.get_entity_cache_stats())
+  assert mock.num_requests == 1
+
+
+###
+### Cluster
+###
+
+def test_cluster_snapshot(mock):
+  # The login document is the first snapshot. Getters reuse it within max age.
+  session = make_client(mock, cluster_info_max_age=0.5)
+  mock.reset_stats()
+  for getter in [session.get_cluster_info, session.get_cluster_name, session.get_hypervisor, session.get_version]:
+    (success, _) = getter()
+    assert success
+  print(mock.requests)
+  assert mock.num_requests == 0
+
+  # Downloaded again once after max age. Then reused again.
+  time.sleep(0.6)
+  (success, cluster_info) = session.get_cluster_info()
+  assert success and cluster_info['name'] == mock.cluster['name']
+  (success, _) = session.get_cluster_name()
+  assert success and mock.num_requests == 1
+
+  # force_refresh downloads within max age.
+  (success, _) = session.get_cluster_name(force_refresh=True)
+  print(mock.requests)
+  assert success and mock.num_requests == 2
+
+
+###
+### Connection
+###
+
+def test_lazy_validate(mock):
+  # Lazy client sends nothing till validate() or the first call. Then logs in once.
+  mock.reset_stats()
+  session = make_client(mock, lazy=True)
+  assert mock.num_requests == 0
+  session.validate()
+  session.validate()
+  print(mock.requests)
+  assert mock.num_requests == 1
+  (success, _) = session.get_cluster_name()
+  assert success and mock.num_requests == 1
+
+  mock.reset_stats()
+  session = make_client(mock, lazy=True)
+  (success, names) = session.get_network_names()
+  print(mock.requests)
+  assert success and len(names) == len(mock.networks)
+  assert mock.num_requests == 2
+
+def test_lazy_validate_unreachable():
+  # Unreachable cluster fails at validate(), not at the constructor.
+  dead = MockPrism(num_vms=0).start()
+  dead.stop()
+  session = make_client(dead, lazy=True)
+  try:
+    session.validate()
+    assert False
+  except Exception as e:
+    print(e)
+    assert 'Unable to connect' in str(e)
+  (success, error_dict) = session.get_network_names()
+  print(success, error_dict['error'])
+  assert not success and 'Unable to connect' in error_dict['error']
+
+def test_warm_up(mock):
+  # Each warm up request opens its own connection and leaves it in the pool.
+  session = make_client(mock, pool_maxsize=6, warmup_connections=4)
+  stats = session.get_pool_stats()
+  print(stats)
+  assert stats['connections_idle'] == 4
+  assert stats['connections_created'] == 4
+
+  # Capped by pool_maxsize. The return value is what the pool really has.
+  opened = session.warm_up(10)
+  stats = session.get_pool_stats()
+  print(opened, stats)
+  assert opened == stats['connections_idle'] == 6
+
+  # Best effort. No connection, no exception.
+  dead = MockPrism(num_vms=0).start()
+  dead.stop()
+  session = make_client(dead, lazy=True)
+  assert session.warm_up(4) == 0
+
+
+###
+### Authentication
+###
+
+def test_session_relogin():
+  # Session cookie expires in the middle. Threads hitting 401 at once log in
+  # only once and every call succeeds with the new cookie.
+  mock = MockPrism(num_vms=20, latency=0.005, credential=(CLUSTER_USER, CLUSTER_PASSWORD)).start()
+  try:
+    session = make_client(mock, auth_mode='session', entity_cache_ttl=0)
+    assert mock.num_logins == 1
+    mock.reset_stats()
+    num_threads = 8
+    barrier = threading.Barrier(num_threads + 1)
+    results = []
+    def worker():
+      barrier.wait()
+      for i in range(5):
+        results.append(session.get_network_names()[0])
+    threads = [threading.Thread(target=worker) for i in range(num_threads)]
+    for thread in threads:
+      thread.start()
+    barrier.wait()
+    time.sleep(0.01)
+    mock.expire_sessions()
+    for thread in threads:
+      thread.join()
+    stats = session.get_auth_stats()
+    print(stats, mock.num_logins, mock.num_unauthorized, mock.num_requests)
+    assert results == [True] * (num_threads * 5)
+    assert mock.num_requests == num_threads * 5 + 1 + mock.num_unauthorized
+    assert mock.num_logins == 1
+    assert stats['reauths'] == 1 and stats['reauth_failures'] == 0
+    assert mock.num_unauthorized == stats['reauth_waits'] + 1
+
+    # Password changed. Login again fails once, the call fails, no loop.
+    mock.credential = (CLUSTER_USER, 'changed')
+    mock.expire_sessions()
+    mock.reset_stats()
+    (success, error_dict) = session.get_network_names()
+    stats = session.get_auth_stats()
+    print(success, stats, mock.requests)
+    assert not success
+    assert stats['reauths'] == 1 and stats['reauth_failures'] == 1
+    assert mock.num_logins == 0
+    assert mock.num_requests == 3
+
+    # Wrong credential fails at the constructor.
+    try:
+      NutanixRestApiClient('127.0.0.1', CLUSTER_USER, 'wrong', port=mock.port, use_https=False)
+      assert False
+    except Exception as e:
+      print(e)
+      assert 'credential' in str(e)
+  finally:
+    mock.stop()
+
+
+###
+### Request Coalescing
+###
+
+def test_coalesce_gets(mock):
+  # Identical GETs at once go to the server once. Each caller gets its own object.
+  session = make_client(mock, coalesce_gets=True)
+  mock.reset_stats()
+  mock.latency = 0.2
+  num_threads = 8
+  barrier = threading.Barrier(num_threads)
+  results = [None] * num_threads
+  def worker(i):
+    barrier.wait()
+    results[i] = session._get_v2('/networks/', {})
+  threads = [threading.Thread(target=worker, args=(i,)) for i in range(num_threads)]
+  try:
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+  finally:
+    mock.latency = 0
+  stats = session.get_coalesce_stats()
+  print(mock.requests, stats)
+  assert mock.num_requests == 1
+  assert stats['gets'] == num_threads and stats['sent'] == 1 and stats['saved'] == num_threads - 1
+  assert all(result == results[0] for result in results)
+  assert len(set(id(result) for result in results)) == num_threads
+  assert len(set(id(result['entities']) for result in results)) == num_threads
+  results[0]['entities'].clear()
+  assert all(len(result['entities']) == len(mock.networks) for result in results[1:])
+
+  # Off by default.
+  session = make_client(mock)
+  session.get_network_names()
+  assert session.get_coalesce_stats()['gets'] == 0
+
+def test_single_flight_fence():
+  # A caller joins a flight in progress, but not one which started before its fence.
+  single_flight = _SingleFlight()
+  started = threading.Event()
+  release = threading.Event()
+  def slow(error_dict):
+    started.set()
+    release.wait()
+    return {'value' : 'old'}
+  results = []
+  def call():
+    results.append(single_flight.do('key', slow, {}))
+  leader = threading.Thread(target=call)
+  leader.start()
+  started.wait()
+  joiner = threading.Thread(target=call)
+  joiner.start()
+  while single_flight.stats()['saved'] == 0:
+    time.sleep(0.01)
+
+  after = single_flight.fence()
+  result = single_flight.do('key', lambda error_dict: {'value' : 'new'}, {}, after)
+  assert result == {'value' : 'new'}
+  release.set()
+  leader.join()
+  joiner.join()
+  stats = single_flight.stats()
+  print(results, stats)
+  assert results == [{'value' : 'old'}, {'value' : 'old'}]
+  assert results[0] is not results[1]
+  assert stats['gets'] == 3 and stats['sent'] == 2 and stats['in_flight'] == 0
+
+
+###
+### Retry
+###
+
+def fast_policy(**kwargs):
+  # Same rules as default but waits only some milliseconds.
+  return RetryPolicy(backoff_base=0.001, backoff_max=0.01, **kwargs)
+
+def test_retry_get_recovers(mock):
+  # GET is retried on 5xx and on connection reset.
+  session = make_client(mock, retry_policy=fast_policy(max_attempts=3))
+  mock.reset_stats()
+  mock.inject_faults([503, 'reset'])
+  (success, names) = session.get_network_names()
+  stats = session.get_retry_stats()
+  print(success, mock.requests, stats)
+  assert success and len(names) == len(mock.networks)
+  assert mock.num_requests == 3
+  assert stats['retries'] == 2 and stats['recovered'] == 1
+
+def test_retry_max_attempts(mock):
+  session = make_client(mock, retry_policy=fast_policy(max_attempts=3))
+  mock.reset_stats()
+  mock.inject_faults([503] * 5)
+  (success, error_dict) = session.get_network_names()
+  stats = session.get_retry_stats()
+  print(success, error_dict.get('code'), stats)
+  assert not success and error_dict['code'] == 503
+  assert mock.num_requests == 3
+  assert stats['give_ups'] == 1
+  mock.clear_faults()
+
+def test_retry_budget(mock):
+  # 2 tokens and no deposit. Only 2 retries in total whatever max_attempts is.
+  session = make_client(mock, retry_policy=fast_policy(max_attempts=10, budget=2, budget_ratio=0))
+  mock.reset_stats()
+  mock.inject_faults([503] * 5)
+  (success, _) = session.get_network_names()
+  assert not success
+  assert mock.num_requests == 3
+  mock.clear_faults()
+
+  mock.reset_stats()
+  mock.inject_faults([503])
+  (success, error_dict) = session.get_network_names()
+  stats = session.get_retry_stats()
+  print(success, stats)
+  assert not success and error_dict['code'] == 503
+  assert mock.num_requests == 1
+  assert stats['retries'] == 2 and stats['budget_exhausted'] == 2
+
+def test_retry_post_not_on_response(mock):
+  # POST may have reached Prism. Not retried on 5xx or reset.
+  session = make_client(mock, retry_policy=fast_policy(max_attempts=3))
+  for fault in [503, 'reset']:
+    mock.reset_stats()
+    mock.inject_faults([fault])
+    (success, _) = session.create_network('retry-net', 10)
+    print(fault, success, mock.requests)
+    assert not success
+    assert mock.num_requests == 1
+  assert session.get_retry_stats()['retries'] == 0
+
+def test_retry_post_on_connect_error():
+  # POST is retried if the connection couldn't be made.
+  mock = MockPrism(num_vms=0).start()
+  session = make_client(mock, retry_policy=fast_policy(max_attempts=3))
+  mock.stop()
+  (success, _) = session.create_network('retry-net', 10)
+  stats = session.get_retry_stats()
+  print(success, stats)
+  assert not success
+  assert stats['attempts'] == 3 and stats['retries'] == 2
+
+def test_retry_policy_errors():
+  # Which errors are retried, without server.
+  connect_error = requests.exceptions.ConnectionError(NewConnectionError(None, 'refused'))
+  read_timeout = requests.exceptions.ReadTimeout(ReadTimeoutError(None, '/', 'timeout'))
+  reset = requests.exceptions.ConnectionError(ConnectionResetError('reset'))
+  for (method, error, expected_attempts) in [
+    ('GET', connect_error, 3), ('GET', read_timeout, 3), ('GET', reset, 3),
+    ('POST', connect_error, 3), ('POST', requests.exceptions.ConnectTimeout(), 3),
+    ('POST', read_timeout, 1), ('POST', reset, 1)]:
+    policy = fast_policy(max_attempts=3)
+    attempts = []
+    def request():
+      attempts.append(1)
+      raise error
+    try:
+      policy.execute(method, request)
+      assert False
+    except requests.exceptions.RequestException:
+      pass
+    print(method, type(error).__name__, len(attempts))
+    assert len(attempts) == expected_attempts
+
+def test_retry_backoff():
+  # Doubles from backoff_base till backoff_max. Jitter takes up to "jitter" part off.
+  policy = RetryPolicy(backoff_base=0.5, backoff_max=4, jitter=0)
+  delays = [policy.backoff(attempt) for attempt in range(1, 7)]
+  print(delays)
+  assert delays == [0.5, 1, 2, 4, 4, 4]
+  policy = RetryPolicy(backoff_base=0.5, backoff_max=4, jitter=0.5)
+  for attempt in range(1, 7):
+    full = min(4, 0.5 * 2 ** (attempt - 1))
+    for i in range(100):
+      assert full * 0.5 <= policy.backoff(attempt) <= full
+
+def test_retry_waits_backoff(mock):
+  # Waits are given to on_retry and really slept.
+  session = make_client(mock, retry_policy=RetryPolicy(max_attempts=3, backoff_base=0.05, jitter=0))
+  retries = []
+  session.add_hook('on_retry', lambda hook: retries.append(hook['delay']))
+  mock.inject_faults([503, 503])
+  start = time.time()
+  (success, _) = session.get_network_names()
+  elapsed = time.time() - start
+  print(success, retries, elapsed)
+  assert success
+  assert retries == [0.05, 0.1]
+  assert elapsed >= 0.15
+
+
+
+###
+### VM
+###
+
+def test_create_vms_from_image_wait(mock):
+  # Failed and timed out tasks make their VMs and all_success False.
+  session = make_client(mock)
+  specs = [{'name':'bulk-{}'.format(i), 'memory_mb':1024, 'num_vcpus':1, 'num_cores':1,
+    'image_name':'image-0', 'network_name':'network-0'} for i in range(4)]
+  specs.append(dict(specs[0], name='bulk-x', image_name='no-such-image'))
+
+  (all_success, results) = session.create_vms_from_image(specs, wait=True, wait_timeout=3, wait_interval=0.1)
+  print(all_success, results)
+  assert all_success is False
+  assert [success for (success, _) in results] == [True, True, True, True, False]
+
+  mock.inject_task_results(['Succeeded', 'Failed', 'Running', 'Succeeded'])
+  (all_success, results) = session.create_vms_from_image(specs[:4], max_workers=1,
+    wait=True, wait_timeout=1.5, wait_interval=0.1)
+  print(all_success, results)
+  assert all_success is False
+  assert [success for (success, _) in results] == [True, False, False, True]
+  assert results[1][1]['task']['status'] == 'Failed' and not results[1][1]['task']['timeout']
+  assert results[2][1]['task']['timeout']
+  assert 'task_uuid' in results[2][1] and 'error' in results[2][1]
+
+  mock.inject_task_results(['Failed'])
+  (all_success, results) = session.create_vms_from_image(specs[:2], max_workers=1)
+  print(all_success, results)
+  assert all_success is True
+
+
+
+def test_records(mock):
+  # Record is equal to the dict of the same call. Unknown keys and attributes are rejected.
+  session = make_client(mock)
+  for (getter, name) in [(session.get_vm_info, 'vm-00001'), (session.get_network_info, 'network-1'),
+    (session.get_container_info, 'container')]:
+    (success, info) = getter(name)
+    (record_success, record) = getter(name, as_record=True)
+    print(record)
+    assert success and record_success
+    assert record == info and record.to_dict() == info
+    assert sorted(record.keys()) == sorted(info.keys())
+    assert not hasattr(record, '__dict__')
+    for (key, value) in info.items():
+      assert record[key] == value and record.get(key) == value and key in record
+    try:
+      record.unknown_field = 1
+      assert False
+    except AttributeError:
+      pass
+    try:
+      record['unknown_field'] = 1
+      assert False
+    except KeyError:
+      pass
+    assert 'unknown_field' not in record and record.get('unknown_field') is None
+
+  (_, vm) = session.get_vm_info('vm-00001', as_record=True)
+  assert vm.name == 'vm-00001' and vm.disks[1].label == 'scsi.0'
+  assert vm != dict(vm.to_dict(), name='other')
+  # Unset optional field isn't a key.
+  (_, network) = session.get_network_info('network-1', as_record=True)
+  assert 'managed_pools' not in network and network.get('managed_pools', []) == []
+
+
+
+###
+### Task
+###
+
+def test_task_waiter(mock):
+  session = make_client(mock)
+  mock.inject_task_results(['Succeeded', 'Failed', 'Running'])
+  task_uuids = []
+  for i in range(3):
+    (success, task_uuid) = session.upload_image('nfs://127.0.0.1/image', 'container', 'waiter-{}'.format(i))
+    assert success
+    task_uuids.append(task_uuid)
+
+  waiter = TaskWaiter(session, min_interval=0.1, max_interval=0.2)
+  ended = []
+  waiter.add(task_uuids[0], callback=ended.append)
+  waiter.add(task_uuids[1], callback=ended.append)
+  waiter.add(task_uuids[2], timeout=1.5, callback=ended.append)
+  results = waiter.wait_all()
+  print(results)
+  assert len(ended) == 3 and waiter.pending() == []
+  assert results[task_uuids[0]]['succeeded'] and results[task_uuids[0]]['status'] == 'Succeeded'
+  assert not results[task_uuids[1]]['succeeded'] and results[task_uuids[1]]['status'] == 'Failed'
+  assert not results[task_uuids[1]]['timeout']
+  assert not results[task_uuids[2]]['succeeded'] and results[task_uuids[2]]['timeout']
+
+def test_task_waiter_unknown(mock):
+  # uuid which isn't a task. Given up as "Unknown" after max_confirm_failures.
+  session = make_client(mock)
+  waiter = TaskWaiter(session, min_interval=0.05, max_interval=0.05, max_confirm_failures=2)
+  waiter.add('00000000-0000-0000-0000-000000000000')
+  results = waiter.wait_all()
+  print(results)
+  result = results['00000000-0000-0000-0000-000000000000']
+  assert result['status'] == 'Unknown' and not result['succeeded']
+
+def test_wait_tasks(mock):
+  session = make_client(mock)
+  mock.inject_task_results(['Succeeded', 'Failed'])
+  task_uuids = [session.upload_image('nfs://127.0.0.1/image', 'container', 'wait-{}'.format(i))[1] for i in range(2)]
+  (all_succeeded, results) = session.wait_tasks(task_uuids, timeout=3)
+  print(all_succeeded, results)
+  assert all_succeeded is False
+  (all_succeeded, results) = session.wait_tasks(task_uuids[:1], timeout=3)
+  assert all_succeeded is True
+
+def test_setup_cluster_wait_tasks(mock):
+  # setup_cluster stops on failed tasks instead of going on.
+  from setup_cluster import Utility
+  session = make_client(mock)
+  (_, task_uuid) = session.upload_image('nfs://127.0.0.1/image', 'container', 'setup-ok')
+  Utility.wait_tasks(session, [task_uuid], interval=0.2)
+  mock.inject_task_results(['Failed'])
+  (_, task_uuid) = session.upload_image('nfs://127.0.0.1/image', 'container', 'setup-ng')
+  try:
+    Utility.wait_tasks(session, [task_uuid], interval=0.2)
+    assert False
+  except Exception as e:
+    print(e)
+    assert task_uuid in str(e)
+
+
+
+###
+### Stream parser
+###
+
+def parse_in_chunks(data, chunk_sizes, fields=None):
+  # Feed data cut by chunk_sizes(repeated). Return (entities, parser).
+  parser = _JsonEntityStream(fields)
+  entities = []
+  (pos, i) = (0, 0)
+  while pos < len(data):
+    size = chunk_sizes[i % len(chunk_sizes)]
+    entities += list(parser.feed(data[pos:pos + size]))
+    (pos, i) = (pos + size, i + 1)
+  parser.close()
+  return (entities, parser)
+
+def random_entity(rand, depth=0):
+  tricky = ['a"b', 'x\\y', '{not}', '[nor]', 'a,b:c', '\u3042\u3044', 'tab\t', '', ' } ] , ']
+  entity = {}
+  for i in range(rand.randint(0, 5)):
+    kind = rand.randint(0, 6)
+    if kind == 0:
+      value = rand.choice(tricky) + str(rand.random())
+    elif kind == 1:
+      value = rand.randint(-10 ** 12, 10 ** 12)
+    elif kind == 2:
+      value = rand.choice([True, False, None, 1.5e-7, -0.0])
+    elif kind == 3 and depth < 3:
+      value = random_entity(rand, depth + 1)
+    elif kind == 4 and depth < 3:
+      value = [random_entity(rand, depth + 1) for j in range(rand.randint(0, 3))]
+    else:
+      value = rand.choice(tricky)
+    entity[rand.choice(tricky) + str(i)] = value
+  return entity
+
+def test_json_entity_stream():
+  # Random documents cut at random places give the same entities as json.loads.
+  rand = random.Random(0)
+  for n in range(300):
+    document = {'metadata' : {'total_entities' : n, 'note' : 'entities "[{'}}
+    document['entities'] = [random_entity(rand) for i in range(rand.randint(0, 8))]
+    if rand.random() < 0.5:
+      document['after'] = ['x', {'y' : '}]'}]
+    data = json.dumps(document, ensure_ascii=rand.random() < 0.5, indent=rand.choice([None, 0, 2])).encode('utf-8')
+    chunk_sizes = [rand.randint(1, 64) for i in range(5)]
+    (entities, parser) = parse_in_chunks(data, chunk_sizes)
+    expected = json.loads(data)
+    assert entities == expected['entities'], (data, chunk_sizes)
+    assert parser.num_entities == len(expected['entities'])
+    del expected['entities']
+    assert parser.document == expected, (data, chunk_sizes)
+
+def test_json_entity_stream_cases():
+  for (data, expected_entities, expected_document) in [
+    (b'{"metadata":{"count":0},"entities":[]}', [], {'metadata' : {'count' : 0}}),
+    (b'{ "entities" : [ ] , "metadata" : { } }', [], {'metadata' : {}}),
+    (b'{"entities":[{"name":"a\\"}"},{"name":"{\\"[]"}]}', [{'name' : 'a"}'}, {'name' : '{"[]'}], {}),
+    (b'{"entities":[1, "two", null, [3]]}', [1, 'two', None, [3]], {}),
+    ('{"entities":[{"name":"\u3042"}]}'.encode('utf-8'), [{'name' : '\u3042'}], {}),
+  ]:
+    for size in [1, 2, 3, 7, len(data)]:
+      (entities, parser) = parse_in_chunks(data, [size])
+      print(size, entities, parser.document)
+      assert entities == expected_entities
+      assert parser.document == expected_document
+
+  # fields : Keep only some keys.
+  (entities, _) = parse_in_chunks(b'{"entities":[{"name":"a","uuid":"1","big":[1,2]}]}', [5], fields=['name'])
+  assert entities == [{'name' : 'a'}]
+
+  # Truncated document fails on close.
+  for data in [b'{"entities":[{"name":"a"}', b'{"entities":[{"name":"a"}]', b'']:
+    try:
+      parse_in_chunks(data, [4])
+      assert False
+    except ValueError as e:
+      print(e)
+
+def test_iter_vms_stream(mock):
+  # Streamed pages are the same as normal pages.
+  session = make_client(mock)
+  streamed = list(session.iter_vms(page_size=7, include_config=True, stream=True))
+  paged = list(session.iter_vms(page_size=7, include_config=True))
+  assert len(streamed) == len(mock.vms)
+  assert streamed == paged
+
+
+
+###
+### Logging
+###
+
+def test_lazy_rest_body():
+  # Queued log records keep at most log_body_limit bytes of the body.
+  raw = json.dumps({'entities' : [{'name' : 'vm-{}'.format(i)} for i in range(10000)]}).encode('utf-8')
+  decoded = json.loads(raw)
+  body = _LazyRestBody(raw, decoded, 100)
+  print(body.log_size(), str(body)[-40:])
+  assert body.log_size() == 100
+  assert body._decoded is None
+  assert str(body).startswith(raw[:100].decode('utf-8'))
+  assert str(body).endswith('(truncated. {} bytes)'.format(len(raw)))
+
+  # No limit. Big decoded object isn't kept. Logged the same anyway.
+  body = _LazyRestBody(raw, decoded, None)
+  assert body.log_size() == len(raw) and body._decoded is None
+  assert str(body) == json.dumps(decoded, indent=2)
+  small = b'{"name": "a"}'
+  body = _LazyRestBody(small, {'name' : 'a'}, None)
+  assert body._decoded is not None
+  assert str(body) == json.dumps({'name' : 'a'}, indent=2)
+
+
+###
+### Metrics
+###
+
+def test_metrics_percentiles():
+  # 90 requests of 20ms and 10 of 500ms. p50 is in the bucket of 20ms, p95 in the one of 500ms.
+  metrics = RequestMetrics()
+  for i in range(90):
+    metrics.observe('v2.0', 'GET', '/vms/', 200, 0.02, 0, 100)
+  for i in range(10):
+    metrics.observe('v2.0', 'GET', '/vms/', 200, 0.5, 0, 100)
+  stats = metrics.snapshot()['GET v2.0 /vms/']
+  print(stats)
+  buckets = RequestMetrics.LATENCY_BUCKETS
+  assert stats['count'] == 100 and stats['errors'] == 0 and stats['bytes_in'] == 10000
+  assert buckets[7] < stats['p50'] <= buckets[8]
+  assert buckets[15] < stats['p95'] <= 0.5
+  assert stats['p95'] <= stats['p99'] <= stats['latency_max'] == 0.5
+  assert abs(stats['latency_avg'] - (90 * 0.02 + 10 * 0.5) / 100) < 1e-9
+
+  # Uniform 1ms to 1s. Within the bucket width (x1.5) of the exact value.
+  metrics = RequestMetrics()
+  for i in range(1, 1001):
+    metrics.observe('v2.0', 'GET', '/vms/', 200, i / 1000, 0, 0)
+  stats = metrics.snapshot()['GET v2.0 /vms/']
+  print(stats['p50'], stats['p95'], stats['p99'])
+  for (name, exact) in [('p50', 0.5), ('p95', 0.95), ('p99', 0.99)]:
+    assert exact / 1.5 <= stats[name] <= exact * 1.5
+
+def test_metrics_endpoints():
+  # uuids, numbers and queries are folded into one series per endpoint.
+  metrics = RequestMetrics()
+  for i in range(3):
+    metrics.observe('v2.0', 'GET', '/vms/{}?include_vm_disk_config=true'.format(uuid.uuid4()), 200, 0.01, 0, 10)
+  metrics.observe('v2.0', 'GET', '/vms/{}'.format(uuid.uuid4()), 500, 0.01, 0, 10)
+  metrics.observe('v2.0', 'GET', '/vms/{}/nics/'.format(uuid.uuid4()), None, 0.01, 0, 0)
+  metrics.observe('v1', 'GET', '/containers/12345', 200, 0.01, 0, 10)
+  metrics.observe_retry('v2.0', 'POST', '/vms/')
+  snapshot = metrics.snapshot()
+  print(list(snapshot.keys()))
+  assert sorted(snapshot.keys()) == ['GET v1 /containers/{id}', 'GET v2.0 /vms/{uuid}',
+    'GET v2.0 /vms/{uuid}/nics/', 'POST v2.0 /vms/']
+  assert snapshot['GET v2.0 /vms/{uuid}']['count'] == 4
+  assert snapshot['GET v2.0 /vms/{uuid}']['errors'] == 1
+  assert snapshot['GET v2.0 /vms/{uuid}/nics/']['errors'] == 1
+  assert snapshot['POST v2.0 /vms/']['retries'] == 1 and snapshot['POST v2.0 /vms/']['count'] == 0
+
+def test_metrics_prometheus():
+  # Every sample line parses. Histogram is cumulative and agrees with _sum and _count.
+  metrics = RequestMetrics()
+  latencies = [0.002, 0.02, 0.02, 0.3, 2.0]
+  for latency in latencies:
+    metrics.observe('v2.0', 'GET', '/vms/{}'.format(uuid.uuid4()), 200, latency, 0, 10)
+  metrics.observe('v1', 'GET', '/cluster', 200, 0.01, 0, 10)
+  text = metrics.to_prometheus(labels={'cluster' : 'mock "1"'})
+  print(text[:300])
+  assert text.endswith('\n')
+
+  sample = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)\{((?:[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\]|\\.)*",?)*)\} (\S+)$')
+  label = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+  series = {}
+  for line in text.splitlines():
+    if line.startswith('#'):
+      assert re.match(r'^# (HELP|TYPE) nutanix_rest_[a-z_]+ .+$', line), line
+      continue
+    match = sample.match(line)
+    assert match, line
+    (name, label_text, value) = match.groups()
+    labels = dict(label.findall(label_text))
+    assert labels['cluster'] == 'mock \\"1\\"'
+    endpoint = (labels['version'], labels['endpoint'])
+    series.setdefault(endpoint, []).append((name, labels.get('le'), float(value)))
+
+  assert sorted(series.keys()) == [('v1', '/cluster'), ('v2.0', '/vms/{uuid}')]
+  samples = series[('v2.0', '/vms/{uuid}')]
+  values = dict((name, value) for (name, le, value) in samples if le is None)
+  assert values['nutanix_rest_requests_total'] == len(latencies)
+  assert values['nutanix_rest_latency_seconds_count'] == len(latencies)
+  assert abs(values['nutanix_rest_latency_seconds_sum'] - sum(latencies)) < 1e-5
+  histogram = [(le, value) for (name, le, value) in samples if name == 'nutanix_rest_latency_seconds_bucket']
+  assert len(histogram) == len(RequestMetrics.LATENCY_BUCKETS) + 1
+  assert histogram[-1] == ('+Inf', len(latencies))
+  bounds = [float(le) for (le, value) in histogram[:-1]]
+  assert bounds == sorted(bounds)
+  counts = [value for (le, value) in histogram]
+  assert counts == sorted(counts)
+  for (le, value) in histogram[:-1]:
+    assert value == sum(1 for latency in latencies if latency <= float(le))
+
+
+###
+### Hooks
+###
+
+def test_hooks_errors():
+  # Failures of hooks in many threads are all counted.
+  request_hooks = _RequestHooks()
+  def broken(info):
+    raise ValueError('broken hook')
+  request_hooks.add('on_error', broken)
+  num_threads = 8
+  num_emits = 5000
+  def worker():
+    for i in range(num_emits):
+      request_hooks.emit('on_error', {})
+  threads = [threading.Thread(target=worker) for i in range(num_threads)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  stats = request_hooks.stats()
+  print(stats)
+  assert stats['errors'] == num_threads * num_emits and stats['on_error'] == 1
+
+
+if __name__ == '__main__':
+  logging.basicConfig(filename=TEST_LOG_NAME, level=TEST_LOG_LEVEL, format=TEST_LOG_FORMAT)
+  print('Test start')
+  mock = MockPrism(num_vms=20).start()
+  try:
+    test_entity_cache_ttl_zero(mock)
+    test_entity_cache_ttl(mock)
+    test_cluster_snapshot(mock)
+    test_lazy_validate(mock)
+    test_warm_up(mock)
+    test_coalesce_gets(mock)
+    test_retry_get_recovers(mock)
+    test_retry_max_attempts(mock)
+    test_retry_budget(mock)
+    test_retry_post_not_on_response(mock)
+    test_retry_waits_backoff(mock)
+    test_create_vms_from_image_wait(mock)
+    test_records(mock)
+    test_task_waiter(mock)
+    test_task_waiter_unknown(mock)
+    test_wait_tasks(mock)
+    test_setup_cluster_wait_tasks(mock)
+    test_iter_vms_stream(mock)
+  finally:
+    mock.stop()
+  test_lazy_validate_unreachable()
+  test_session_relogin()
+  test_single_flight_fence()
+  test_retry_post_on_connect_error()
+  test_retry_policy_errors()
+  test_retry_backoff()
+  test_json_entity_stream()
+  test_json_entity_stream_cases()
+  test_lazy_rest_body()
+  test_metrics_percentiles()
+  test_metrics_endpoints()
+  test_metrics_prometheus()
+  test_hooks_errors()
+  print('Test end')